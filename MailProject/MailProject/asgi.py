@@ -2,6 +2,9 @@
 ASGI config for MailProject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Production serves it with ``gunicorn -k uvicorn.workers.UvicornWorker`` so the
+inbox's new-mail event stream (mailapp.views.mail_events) can stay open
+without tying up a worker.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +16,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MailProject.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.conf import settings
+from mailapp.dbpool import prewarm
+from mailapp.disconnect import cancel_on_disconnect
+
+# Stop streamed responses (AI drafts, the event stream) as soon as their client goes away
+application = cancel_on_disconnect(django_application)
+
+# Open pooled database connections now rather than in the first requests. Each
+# gunicorn worker imports this after forking, so workers never share connections.
+if settings.DATABASE_POOL_PREWARM:
+    prewarm()
@@ -55,6 +55,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover every other middleware too
+    'mailapp.profiling.ProfilingMiddleware',
+    # Before the session middleware, so a session saved on the way out still counts as a write
+    'mailapp.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add WhiteNoise for static files
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -69,10 +73,17 @@ ROOT_URLCONF = 'MailProject.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, plus render timing for the profiling middleware
+        'BACKEND': 'mailapp.profiling.ProfiledDjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are kept per process; the dev server's autoreloader resets them on change
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
@@ -88,19 +99,48 @@ WSGI_APPLICATION = 'MailProject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# How web processes hold connections, see mailapp.dbpool:
+# 'persistent' keeps Django's per-thread connections, 'pool' shares a bounded pool between a
+# process's threads, 'pgbouncer' suits a DATABASE_URL pointing at pgbouncer in transaction mode
+DATABASE_POOL_MODE = os.getenv('DATABASE_POOL_MODE', 'persistent')
+# Open the pool's minimum connections when the server starts
+DATABASE_POOL_PREWARM = os.getenv('DATABASE_POOL_PREWARM', 'True').lower() == 'true'
+
+def database_from_url(url):
+    """A DATABASES entry for ``url``, with the SSL and DATABASE_POOL_MODE settings for Postgres"""
+    database = dj_database_url.parse(url, conn_max_age=600, conn_health_checks=True)
+    if 'postgresql' not in database['ENGINE']:
+        return database
+    # Add SSL settings for Neon
+    database['OPTIONS'] = {
+        'sslmode': os.getenv('DATABASE_SSLMODE', 'require'),
+    }
+    if DATABASE_POOL_MODE == 'pool':
+        database.update({
+            'ENGINE': 'mailapp.postgresql_pool',
+            # Connections go back to the pool at the end of each request
+            'CONN_MAX_AGE': 0,
+            'POOL': {
+                'MIN_SIZE': int(os.getenv('DATABASE_POOL_MIN_SIZE', '2')),
+                'MAX_SIZE': int(os.getenv('DATABASE_POOL_MAX_SIZE', '10')),
+                'TIMEOUT': float(os.getenv('DATABASE_POOL_TIMEOUT', '10')),
+            },
+        })
+    elif DATABASE_POOL_MODE == 'pgbouncer':
+        database.update({
+            # Connections to pgbouncer are cheap, and it owns the server connections
+            'CONN_MAX_AGE': 0,
+            # A cursor can't outlive its transaction when the next one may run on another server connection
+            'DISABLE_SERVER_SIDE_CURSORS': True,
+        })
+    return database
+
+
 # Use Neon PostgreSQL in production, SQLite in development
 if os.getenv('DATABASE_URL'):
     # Production database (Neon PostgreSQL)
     DATABASES = {
-        'default': dj_database_url.parse(
-            os.getenv('DATABASE_URL'),
-            conn_max_age=600,
-            conn_health_checks=True,
-        )
-    }
-    # Add SSL settings for Neon
-    DATABASES['default']['OPTIONS'] = {
-        'sslmode': 'require',
+        'default': database_from_url(os.getenv('DATABASE_URL')),
     }
 else:
     # Development database (SQLite)
@@ -111,6 +151,58 @@ else:
         }
     }
 
+# Read replicas, comma-separated; read-only views read from them (see mailapp/replicas.py)
+DATABASE_REPLICAS = []
+for url in filter(None, (url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(','))):
+    alias = f'replica{len(DATABASE_REPLICAS) + 1}'
+    DATABASES[alias] = database_from_url(url)
+    # Tests read the test database through the replica aliases instead of creating more
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['mailapp.replicas.ReplicaRouter']
+# After a request writes, its browser reads from the primary for this many seconds. Keep it above
+# MAIL_REPLICA_MAX_LAG + MAIL_REPLICA_CHECK_SECONDS so it outlasts any replica still in use
+MAIL_REPLICA_PIN_SECONDS = int(os.getenv('MAIL_REPLICA_PIN_SECONDS', '15'))
+# Replicas further behind than this many seconds are skipped
+MAIL_REPLICA_MAX_LAG = float(os.getenv('MAIL_REPLICA_MAX_LAG', '5'))
+# How often each process checks a replica's lag
+MAIL_REPLICA_CHECK_SECONDS = float(os.getenv('MAIL_REPLICA_CHECK_SECONDS', '5'))
+
+# Caches
+# Set REDIS_URL to share caches across gunicorn workers; otherwise each process keeps its own
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        },
+        'ai': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+            'KEY_PREFIX': 'ai',
+            'TIMEOUT': 3600,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'ai': {
+            # LocMemCache evicts least recently used entries past MAX_ENTRIES
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'ai-drafts',
+            'TIMEOUT': 3600,
+            'OPTIONS': {'MAX_ENTRIES': 1000},
+        },
+    }
+
+# Whether every server process sees the same cache. The local memory cache is per process, so an
+# invalidation there never reaches the other workers; caches they must agree on are kept short
+# and nothing is revalidated against them (see mailapp/directory.py and mailbox_cache.py). Defaults to true with Redis
+MAIL_SHARED_CACHE = os.getenv('MAIL_SHARED_CACHE', str(bool(os.getenv('REDIS_URL')))).lower() == 'true'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -169,6 +261,41 @@ LOGOUT_REDIRECT_URL = 'home'
 # Gemini AI Configuration
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')  # Loaded from .env file
 
+# Model backend used by the AI draft worker; 'mailapp.ai.FakeBackend' needs no API key
+AI_DRAFT_BACKEND = os.getenv('AI_DRAFT_BACKEND', 'mailapp.ai.GeminiBackend')
+
+# Most model calls allowed in flight at once, across all web and worker processes
+AI_MAX_CONCURRENT_CALLS = int(os.getenv('AI_MAX_CONCURRENT_CALLS', '8'))
+
+# New-mail push: 'memory' reaches listeners in this process only, 'redis' reaches every process
+MAIL_PUSH_BROKER = os.getenv('MAIL_PUSH_BROKER', 'redis' if os.getenv('REDIS_URL') else 'memory')
+MAIL_PUSH_REDIS_URL = os.getenv('MAIL_PUSH_REDIS_URL', os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+# Each event stream ends after this long and the browser reconnects
+MAIL_PUSH_STREAM_SECONDS = int(os.getenv('MAIL_PUSH_STREAM_SECONDS', '300'))
+MAIL_PUSH_HEARTBEAT_SECONDS = 20
+
+# Mail older than this is moved to the archive by `manage.py archive_mail`
+MAIL_ARCHIVE_AFTER_DAYS = int(os.getenv('MAIL_ARCHIVE_AFTER_DAYS', '365'))
+
+# Request profiling: requests slower than this are logged with their slowest queries
+MAIL_SLOW_REQUEST_MS = int(os.getenv('MAIL_SLOW_REQUEST_MS', '500'))
+# Send SQL, template and AI timings to the browser in a Server-Timing header
+MAIL_SERVER_TIMING = os.getenv('MAIL_SERVER_TIMING', 'True').lower() == 'true'
+# Development and staging only: append duplicate, N+1 and slow query findings to this file (JSON lines)
+MAIL_QUERY_REPORT = os.getenv('MAIL_QUERY_REPORT') or None
+# One query shape run this many times from the same line is reported as an N+1
+MAIL_QUERY_REPEAT_THRESHOLD = 3
+# Queries at least this slow are reported with their EXPLAIN plan
+MAIL_QUERY_EXPLAIN_MS = int(os.getenv('MAIL_QUERY_EXPLAIN_MS', '100'))
+
+# Per-user token buckets for expensive endpoints: 'N/s', 'N/m', 'N/h' or 'N/d'
+RATE_LIMITS = {
+    'ai_draft': '10/m',
+    'compose': '30/m',
+    'autosave': '30/m',
+    'export': '10/h',
+}
+
 # Production Security Settings
 if not DEBUG:
     SECURE_BROWSER_XSS_FILTER = True
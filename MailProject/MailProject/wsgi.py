@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MailProject.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings
+from mailapp.dbpool import prewarm
+
+# Open pooled database connections now rather than in the first requests. Each
+# gunicorn worker imports this after forking, so workers never share connections.
+if settings.DATABASE_POOL_PREWARM:
+    prewarm()
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Project, UserProfile, Mail, Draft
+from django.contrib.admin.views.main import ChangeList
+from .models import Project, UserProfile, MessageContent, Thread, Mail, ArchivedMail, ArchiveRun, Draft, AIDraftJob
 
 @admin.register(Project)
 class ProjectAdmin(admin.ModelAdmin):
@@ -17,16 +18,62 @@ class UserProfileAdmin(admin.ModelAdmin):
         return ", ".join([p.name for p in obj.projects.all()])
     get_projects.short_description = 'Projects'
 
+class MailChangeList(ChangeList):
+    def get_queryset(self, request):
+        # Only the change list uses the list projection; the change form needs the body
+        return super().get_queryset(request).for_list()
+
+@admin.register(Thread)
+class ThreadAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'project', 'created_at']
+    list_filter = ['project', 'created_at']
+    search_fields = ['subject']
+    readonly_fields = ['created_at']
+
 @admin.register(Mail)
 class MailAdmin(admin.ModelAdmin):
     list_display = ['subject', 'sender', 'recipient', 'project', 'sent_at', 'is_read']
     list_filter = ['project', 'sent_at', 'is_read']
-    search_fields = ['subject', 'body', 'sender__username', 'recipient__username']
-    readonly_fields = ['sent_at']
+    search_fields = ['subject', 'content__body', 'sender__username', 'recipient__username']
+    readonly_fields = ['sent_at', 'body']
+    raw_id_fields = ['in_reply_to']
+    
+    def get_changelist(self, request, **kwargs):
+        return MailChangeList
+
+@admin.register(ArchivedMail)
+class ArchivedMailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'sender', 'recipient', 'project', 'sent_at', 'archived_at']
+    list_filter = ['project', 'sent_at']
+    search_fields = ['subject', 'sender__username', 'recipient__username']
+    readonly_fields = ['sent_at', 'archived_at', 'body']
+    raw_id_fields = ['sender', 'recipient', 'project']
+    
+    def get_changelist(self, request, **kwargs):
+        return MailChangeList
+
+@admin.register(ArchiveRun)
+class ArchiveRunAdmin(admin.ModelAdmin):
+    list_display = ['id', 'cutoff', 'moved', 'last_id', 'started_at', 'finished_at']
+    readonly_fields = ['started_at']
 
 @admin.register(Draft)
 class DraftAdmin(admin.ModelAdmin):
     list_display = ['subject', 'author', 'project', 'recipient', 'created_at', 'updated_at']
     list_filter = ['project', 'created_at', 'updated_at']
-    search_fields = ['subject', 'body', 'author__username']
-    readonly_fields = ['created_at', 'updated_at']
+    search_fields = ['subject', 'content__body', 'author__username']
+    readonly_fields = ['created_at', 'updated_at', 'body']
+    raw_id_fields = ['in_reply_to']
+
+@admin.register(MessageContent)
+class MessageContentAdmin(admin.ModelAdmin):
+    list_display = ['content_hash', 'subject', 'created_at']
+    search_fields = ['content_hash', 'subject']
+    readonly_fields = ['content_hash', 'subject', 'body', 'created_at']
+
+@admin.register(AIDraftJob)
+class AIDraftJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'status', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['prompt', 'user__username']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
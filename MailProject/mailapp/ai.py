@@ -0,0 +1,469 @@
+"""
+AI draft generation.
+
+Model calls are slow. The compose page normally streams the reply as it
+is generated (``stream_draft`` behind a server-sent events view), so text
+shows up in well under a second; browsers without fetch streaming fall back
+to submitting an AIDraftJob and polling it while `manage.py run_ai_worker`
+drains the queue with a bounded thread pool. The model itself sits behind a
+small backend interface chosen by ``settings.AI_DRAFT_BACKEND``, so tests
+and local development can swap Gemini for ``FakeBackend``.
+
+Results are cached in the ``ai`` cache under a hash of the normalized
+prompt, so repeating a request (or two users asking the same thing) costs
+one model call. Identical prompts that are in flight at the same time are
+coalesced: threads in one process wait on a shared future, and processes
+sharing the cache wait on a short lease held by whoever called the model.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import AIDraftJob
+from .profiling import timed
+from .ratelimit import CapacityExceeded, ai_calls
+
+PROMPT_TEMPLATE = """
+Generate a professional email based on the following request: {prompt}
+
+Please format the response as JSON with the following structure:
+{{
+    "subject": "appropriate email subject",
+    "body": "email body content"
+}}
+
+Guidelines:
+- Keep the tone professional and courteous
+- Make the subject concise and relevant
+- Structure the body with proper greeting, content, and closing
+- Ensure the content is appropriate for a business/project communication
+"""
+
+
+class AINotConfigured(Exception):
+    pass
+
+
+class GeminiBackend:
+    model_name = 'gemini-2.0-flash'
+
+    def __init__(self):
+        api_key = getattr(settings, 'GEMINI_API_KEY', None)
+        if not api_key or api_key == 'your_gemini_api_key_here':
+            raise AINotConfigured('Gemini API key not configured. Please add your API key to settings.py')
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(self.model_name)
+
+    def generate(self, prompt):
+        return self.model.generate_content(prompt).text
+
+    def stream(self, prompt):
+        response = self.model.generate_content(prompt, stream=True)
+        for chunk in response:
+            if chunk.parts:
+                yield chunk.text
+
+
+class FakeBackend:
+    """Deterministic local stand-in for Gemini, for tests and offline development"""
+    chunk_size = 8
+
+    def generate(self, prompt):
+        request = prompt.split('following request:', 1)[-1].split('\n', 1)[0].strip()
+        return json.dumps({
+            'subject': request[:60].capitalize(),
+            'body': f'Hello,\n\n{request}\n\nBest regards',
+        })
+
+    def stream(self, prompt):
+        text = self.generate(prompt)
+        for start in range(0, len(text), self.chunk_size):
+            yield text[start:start + self.chunk_size]
+
+
+_backend = None
+
+
+def get_backend():
+    """Return the configured backend, built once per process and then reused"""
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.AI_DRAFT_BACKEND)()
+    return _backend
+
+
+def build_prompt(prompt):
+    return PROMPT_TEMPLATE.format(prompt=prompt)
+
+
+# A \u not followed by four hex digits (and not itself escaped), which json.loads rejects
+_BAD_UNICODE_ESCAPE = re.compile(r'(?<!\\)((?:\\\\)*)\\u(?![0-9a-fA-F]{4})')
+
+
+def parse_draft_response(text):
+    """Pull subject and body out of the model's reply, tolerating non-JSON answers"""
+    response_text = text.strip()
+    if response_text.startswith('```json'):
+        response_text = response_text.replace('```json', '').replace('```', '').strip()
+    elif response_text.startswith('```'):
+        response_text = response_text.replace('```', '').strip()
+    try:
+        ai_content = json.loads(_BAD_UNICODE_ESCAPE.sub(r'\1\\\\u', response_text))
+        return ai_content.get('subject', ''), ai_content.get('body', '')
+    except (json.JSONDecodeError, AttributeError):
+        pass
+
+    # If JSON parsing fails, look for a "Subject:" line
+    content = text.strip()
+    for line in content.split('\n'):
+        if line.strip().lower().startswith('subject:'):
+            return line.split(':', 1)[1].strip(), content.replace(line, '').strip()
+    return '', content
+
+
+CACHE_ALIAS = 'ai'
+CACHE_STATS = ('hits', 'misses', 'coalesced')
+LEASE_TIMEOUT = 60
+LEASE_POLL_INTERVAL = 0.2
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def normalize_prompt(prompt):
+    return re.sub(r'\s+', ' ', prompt).strip().lower()
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()
+
+
+def _record(stat):
+    cache = get_cache()
+    key = f'stats:{stat}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr(); losing one count is fine
+        pass
+
+
+def cache_stats():
+    """Hit, miss and coalesced-call counts, shared by every process using the cache"""
+    values = get_cache().get_many([f'stats:{stat}' for stat in CACHE_STATS])
+    return {stat: values.get(f'stats:{stat}', 0) for stat in CACHE_STATS}
+
+
+def get_cached_draft(prompt):
+    """Return the cached (subject, body) for ``prompt``, or None"""
+    cached = get_cache().get(f'draft:{prompt_hash(prompt)}')
+    return tuple(cached) if cached is not None else None
+
+
+def _generate_and_cache(prompt, key):
+    cache = get_cache()
+    lease_key = f'lease:{key}'
+    # The token identifies this caller's lease, so only it removes the lease
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + LEASE_TIMEOUT
+    # Another process is already calling the model for this prompt: wait for its
+    # result rather than paying for a second call, unless the lease runs out
+    while not cache.add(lease_key, token, timeout=LEASE_TIMEOUT):
+        time.sleep(LEASE_POLL_INTERVAL)
+        cached = cache.get(f'draft:{key}')
+        if cached is not None:
+            _record('coalesced')
+            return tuple(cached)
+        if time.monotonic() > deadline:
+            # Call the model without a lease; whoever holds it keeps it
+            token = None
+            break
+    try:
+        with ai_calls.slot(), timed('ai'):
+            text = get_backend().generate(build_prompt(prompt))
+        _record('misses')
+        result = parse_draft_response(text)
+        cache.set(f'draft:{key}', list(result))
+        return result
+    finally:
+        # A lease that expired during a slow call may belong to another caller by now
+        if token is not None and cache.get(lease_key) == token:
+            cache.delete(lease_key)
+
+
+_HEX4 = re.compile(r'[0-9a-fA-F]{4}')
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class DraftStreamParser:
+    """
+    Incremental counterpart of ``parse_draft_response``. ``feed()`` takes
+    model output as it arrives and returns ``(field, text)`` events: one
+    ``('subject', text)`` once the subject is complete, then ``('body', delta)``
+    pieces as the body grows. ``close()`` flushes what is left and returns
+    the authoritative ``(subject, body)`` parsed from the whole reply.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.mode = None
+        self.pos = 0
+        self.field = None
+        self.subject_sent = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.mode is None:
+            self._detect_mode()
+        if self.mode == 'json':
+            return self._feed_json()
+        if self.mode == 'text':
+            return self._feed_text(final=False)
+        return []
+
+    def close(self):
+        events = self._feed_text(final=True) if self.mode == 'text' else []
+        subject, body = parse_draft_response(self.text)
+        return events, (subject, body)
+
+    def _detect_mode(self):
+        stripped = self.text.lstrip()
+        for fence in ('```json', '```'):
+            if fence.startswith(stripped[:len(fence)]) and len(stripped) < len(fence):
+                return  # Could still be the start of a code fence
+            if stripped.startswith(fence):
+                stripped = stripped[len(fence):]
+                break
+        stripped = stripped.lstrip()
+        if not stripped:
+            return
+        self.mode = 'json' if stripped.startswith('{') else 'text'
+        self.pos = len(self.text) - len(stripped)
+
+    def _feed_json(self):
+        events = []
+        while True:
+            if self.field is None:
+                key = re.compile(r'"(subject|body)"\s*:\s*"').search(self.text, self.pos)
+                if key is None:
+                    return events
+                self.field, self.value, self.pos = key.group(1), '', key.end()
+            delta, complete = self._read_json_string()
+            if self.field == 'body' and delta:
+                events.append(('body', delta))
+            if not complete:
+                return events
+            if self.field == 'subject':
+                events.append(('subject', self.value))
+                self.subject_sent = True
+            self.field = None
+
+    def _read_json_string(self):
+        decoded = []
+        text, i = self.text, self.pos
+        while i < len(text):
+            char = text[i]
+            if char == '"':
+                self.pos = i + 1
+                self.value += ''.join(decoded)
+                return ''.join(decoded), True
+            if char == '\\':
+                if i + 1 >= len(text):
+                    break
+                escape = text[i + 1]
+                if escape == 'u':
+                    if i + 6 > len(text):
+                        break
+                    digits = text[i + 2:i + 6]
+                    if not _HEX4.fullmatch(digits):
+                        # Not valid JSON; keep "\u" as written and read what follows as usual
+                        decoded.append('\\u')
+                        i += 2
+                        continue
+                    decoded.append(chr(int(digits, 16)))
+                    i += 6
+                    continue
+                decoded.append(_JSON_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            decoded.append(char)
+            i += 1
+        self.pos = i
+        self.value += ''.join(decoded)
+        return ''.join(decoded), False
+
+    def _feed_text(self, final):
+        events = []
+        if not self.subject_sent:
+            # Wait for the first line to see whether it is a "Subject:" header
+            first_line, newline, _ = self.text[self.pos:].lstrip().partition('\n')
+            if not newline and not final:
+                return events
+            if first_line.strip().lower().startswith('subject:'):
+                events.append(('subject', first_line.split(':', 1)[1].strip()))
+                self.pos = self.text.index(first_line, self.pos) + len(first_line) + len(newline)
+            self.subject_sent = True
+        body = self.text[self.pos:]
+        if final:
+            body = body.rstrip().removesuffix('```').rstrip()
+        else:
+            # Hold back a possible closing code fence
+            body = body.rstrip('`')
+        if body:
+            events.append(('body', body))
+            self.pos += len(body)
+        return events
+
+
+def generate_draft(prompt):
+    """Run one prompt through the model, or answer it from the cache; returns (subject, body)"""
+    cached = get_cached_draft(prompt)
+    if cached is not None:
+        _record('hits')
+        return cached
+
+    key = prompt_hash(prompt)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        _record('coalesced')
+        return future.result()
+
+    try:
+        result = _generate_and_cache(prompt, key)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def stream_draft(prompt):
+    """
+    Generate a draft for a waiting client, yielding ``(event, data)`` pairs:
+    ``subject`` and ``body`` as text arrives, then ``done`` with the final
+    subject and body. Closing the generator (the client went away) closes
+    the upstream model stream, which cancels the call.
+    """
+    cached = get_cached_draft(prompt)
+    if cached is not None:
+        _record('hits')
+        subject, body = cached
+        yield 'subject', {'text': subject}
+        yield 'body', {'text': body}
+        yield 'done', {'subject': subject, 'body': body}
+        return
+
+    parser = DraftStreamParser()
+    with ai_calls.slot(), timed('ai'):
+        _record('misses')
+        upstream = get_backend().stream(build_prompt(prompt))
+        try:
+            for chunk in upstream:
+                for field, text in parser.feed(chunk):
+                    yield field, {'text': text}
+        finally:
+            upstream.close()
+    events, result = parser.close()
+    for field, text in events:
+        yield field, {'text': text}
+    get_cache().set(f'draft:{prompt_hash(prompt)}', list(result))
+    yield 'done', {'subject': result[0], 'body': result[1]}
+
+
+def submit_job(user, prompt):
+    """
+    Queue ``prompt`` for ``user``. A cached answer completes the job
+    immediately, and resubmitting a prompt that is still queued for the same
+    user returns the existing job instead of a duplicate.
+    """
+    key = prompt_hash(prompt)
+    cached = get_cached_draft(prompt)
+    if cached is not None:
+        _record('hits')
+        now = timezone.now()
+        return AIDraftJob.objects.create(
+            user=user, prompt=prompt, prompt_hash=key, status=AIDraftJob.STATUS_DONE,
+            subject=cached[0][:200], body=cached[1], started_at=now, finished_at=now,
+        )
+
+    existing = AIDraftJob.objects.filter(
+        user=user, prompt_hash=key,
+        status__in=[AIDraftJob.STATUS_PENDING, AIDraftJob.STATUS_RUNNING],
+    ).order_by('created_at').first()
+    if existing is not None:
+        return existing
+    return AIDraftJob.objects.create(user=user, prompt=prompt, prompt_hash=key)
+
+
+def claim_jobs(limit):
+    """
+    Atomically move up to ``limit`` of the oldest pending jobs to running.
+    SKIP LOCKED lets several workers drain the queue without blocking each
+    other; the conditional UPDATE keeps this safe where it is unsupported.
+    """
+    with transaction.atomic():
+        candidates = list(
+            AIDraftJob.objects.select_for_update(skip_locked=True)
+            .filter(status=AIDraftJob.STATUS_PENDING)
+            .order_by('created_at')
+            .values_list('pk', flat=True)[:limit]
+        )
+        claimed = []
+        for pk in candidates:
+            if AIDraftJob.objects.filter(pk=pk, status=AIDraftJob.STATUS_PENDING).update(
+                status=AIDraftJob.STATUS_RUNNING, started_at=timezone.now(),
+            ):
+                claimed.append(pk)
+    return list(AIDraftJob.objects.filter(pk__in=claimed))
+
+
+def run_job(job):
+    """Generate one job's draft and record the outcome. Safe to call from a worker thread."""
+    update_fields = ['subject', 'body', 'error', 'status', 'finished_at']
+    try:
+        subject, body = generate_draft(job.prompt)
+        job.subject, job.body, job.status = subject[:200], body, AIDraftJob.STATUS_DONE
+        job.finished_at = timezone.now()
+    except CapacityExceeded:
+        # Every model slot is taken; hand the job back to the queue for later
+        job.status, job.started_at = AIDraftJob.STATUS_PENDING, None
+        update_fields = ['status', 'started_at']
+    except Exception as e:
+        job.error, job.status = f'Error generating AI content: {e}', AIDraftJob.STATUS_FAILED
+        job.finished_at = timezone.now()
+    try:
+        job.save(update_fields=update_fields)
+    finally:
+        close_old_connections()
+    return job
+
+
+def requeue_stale_jobs(older_than=timedelta(minutes=5)):
+    """Put jobs left running by a crashed worker back in the queue"""
+    return AIDraftJob.objects.filter(
+        status=AIDraftJob.STATUS_RUNNING, started_at__lt=timezone.now() - older_than,
+    ).update(status=AIDraftJob.STATUS_PENDING, started_at=None)
@@ -6,4 +6,9 @@ class MailappConfig(AppConfig):
     name = 'mailapp'
     
     def ready(self):
+        from django.db.backends.signals import connection_created
+
         import mailapp.signals
+        from mailapp.profiling import install_query_timer
+
+        connection_created.connect(install_query_timer, dispatch_uid='mailapp_query_timer')
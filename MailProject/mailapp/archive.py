@@ -0,0 +1,106 @@
+"""
+Moving old mail out of the hot table.
+
+The inbox, sent list, conversations, counters and sync all query Mail, and
+nobody pages back through years of it. ``manage.py archive_mail`` moves
+mail sent before a cutoff into ArchivedMail in primary-key batches. Each
+batch copies the rows and deletes the originals in one transaction, so a
+mail is always in exactly one table. The delete goes through the usual
+Mail signals, so counters, search index and change log follow just as
+they would for a deleted mail; sync clients drop archived mail.
+
+Every batch also advances an ArchiveRun checkpoint inside the same
+transaction. An interrupted run resumes from its last id with the cutoff
+it started with, and never rescans what it already moved.
+
+Replies and reply drafts whose mail gets archived keep pointing at it
+through ``in_reply_to_archived_id``, because the foreign key can only
+point into the hot table. Threads carry over as they are, and a reply sent
+later still joins the archived mail's thread.
+
+Mailbox pages only ever read the hot table. ``read_mail`` falls back to the
+archive for a single mail, and search has an explicit "include archive"
+mode that adds the best archived matches, see ``search_archive``.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import changelog, counters
+from .models import ArchivedMail, ArchiveRun, Draft, Mail
+from .search import search
+
+ARCHIVE_BATCH_SIZE = 1000
+# Archived matches shown alongside hot results when the archive is included
+ARCHIVE_SEARCH_LIMIT = 20
+
+ARCHIVED_FIELDS = (
+    'id', 'sender_id', 'recipient_id', 'project_id', 'subject', 'content_id', 'preview',
+    'thread_id', 'in_reply_to_id', 'in_reply_to_archived_id', 'sent_at', 'is_read', 'search_document',
+)
+
+
+def current_run(older_than_days=None):
+    """The unfinished run to resume, or a new one for mail older than ``older_than_days``"""
+    run = ArchiveRun.objects.filter(finished_at__isnull=True).order_by('-id').first()
+    if run is None:
+        days = settings.MAIL_ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        run = ArchiveRun.objects.create(cutoff=timezone.now() - timedelta(days=days))
+    return run
+
+
+def move_to_archive(ids):
+    """Move the mails with these ids into the archive; returns how many moved"""
+    rows = list(Mail.objects.select_for_update().filter(pk__in=ids).order_by().values(*ARCHIVED_FIELDS))
+    if not rows:
+        return 0
+    for row in rows:
+        archived_parent = row.pop('in_reply_to_archived_id')
+        if row['in_reply_to_id'] is None:
+            row['in_reply_to_id'] = archived_parent
+    ArchivedMail.objects.bulk_create([ArchivedMail(**row) for row in rows])
+    moved = [row['id'] for row in rows]
+    # Before the delete sets their in_reply_to to NULL
+    Mail.objects.filter(in_reply_to_id__in=moved).exclude(pk__in=moved).update(
+        in_reply_to_archived_id=F('in_reply_to_id'),
+    )
+    Draft.objects.filter(in_reply_to_id__in=moved).update(in_reply_to_archived_id=F('in_reply_to_id'))
+    Mail.objects.filter(pk__in=moved).delete()
+    return len(rows)
+
+
+def archive(run, batch_size=ARCHIVE_BATCH_SIZE, max_batches=None):
+    """
+    Move mail sent before ``run.cutoff``, continuing after ``run.last_id``.
+    Stops after ``max_batches`` if given; the run is finished once nothing
+    is left. Returns the run.
+    """
+    candidates = Mail.objects.filter(sent_at__lt=run.cutoff)
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = list(
+            candidates.filter(pk__gt=run.last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            run.finished_at = timezone.now()
+            run.save(update_fields=['finished_at'])
+            break
+        with transaction.atomic(), counters.batched(), changelog.batched():
+            run.moved += move_to_archive(ids)
+            run.last_id = ids[-1]
+            run.save(update_fields=['last_id', 'moved'])
+        batches += 1
+    return run
+
+
+def find_archived(mail_id):
+    """The archived copy of mail ``mail_id``, or None"""
+    return ArchivedMail.objects.select_related('sender', 'recipient', 'project', 'content').filter(id=mail_id).first()
+
+
+def search_archive(archived, query, limit=ARCHIVE_SEARCH_LIMIT):
+    """The best ``limit`` matches for ``query`` among an ArchivedMail queryset"""
+    return list(search(archived, query).for_list().order_by('-search_rank', '-sent_at', '-id')[:limit])
@@ -0,0 +1,60 @@
+"""
+Draft autosave.
+
+The compose and edit pages post the form every 30 seconds. The first save
+creates a draft and hands back its id; later saves update that same draft.
+Each draft carries a ``version`` that works as an ETag: a client sends the
+version it last saw, and a save from a stale tab is refused with a conflict
+instead of silently overwriting newer text. Saves whose content hashes the
+same as what is stored are acknowledged without writing anything.
+"""
+import hashlib
+
+from django.db import transaction
+
+from .forms import DraftForm
+from .models import Draft
+
+
+class AutosaveConflict(Exception):
+    def __init__(self, draft):
+        super().__init__(f'Draft {draft.pk} is at version {draft.version}')
+        self.draft = draft
+
+
+class AutosaveInvalid(Exception):
+    def __init__(self, errors):
+        super().__init__('Invalid draft data')
+        self.errors = errors
+
+
+def draft_content_hash(draft):
+    content = '\x1f'.join([
+        str(draft.project_id or ''), str(draft.recipient_id or ''), draft.subject or '', draft.body or '',
+    ])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def autosave_draft(user, data, draft_id=None, expected_version=None):
+    """
+    Create or update a draft from posted form ``data``.
+    Returns ``(draft, saved)``; ``saved`` is False when nothing changed.
+    """
+    with transaction.atomic():
+        draft = None
+        if draft_id is not None:
+            draft = Draft.objects.select_for_update().get(id=draft_id, author=user)
+            if expected_version is not None and expected_version != draft.version:
+                raise AutosaveConflict(draft)
+
+        form = DraftForm(user=user, data=data, instance=draft)
+        if not form.is_valid():
+            raise AutosaveInvalid(form.errors)
+
+        # is_valid() has already copied the cleaned data onto the instance
+        draft = form.instance
+        if draft.pk and draft_content_hash(draft) == draft.content_hash:
+            return draft, False
+        draft.author = user
+        draft.save()
+        return draft, True
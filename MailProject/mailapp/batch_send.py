@@ -0,0 +1,81 @@
+"""
+Sending one message to many recipients.
+
+Membership is checked for every requested recipient with a single query,
+then one Mail per valid recipient is inserted with ``bulk_create`` in
+chunks, all inside one transaction so a failure sends nothing. Every mail
+points at the same MessageContent, so the body is written once, and shares
+one Thread, so replies from any recipient land in the same conversation.
+bulk_create skips model signals, so the content, thread, search document,
+mailbox counters, change log and push notifications that the signals
+normally handle are done here instead.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import changelog, counters, push
+from .content import intern_content, use_content
+from .models import Mail
+from .search import build_mail_document
+from .threads import start_thread
+
+SEND_CHUNK_SIZE = 500
+
+SENT = 'sent'
+NOT_A_MEMBER = 'not_a_member'
+SELF = 'self'
+
+RECIPIENT_FIELDS = ('id', 'username', 'first_name', 'last_name')
+
+
+def project_recipients(project, exclude):
+    return list(
+        User.objects.filter(userprofile__projects=project).exclude(id=exclude.id)
+        .only(*RECIPIENT_FIELDS).order_by('id')
+    )
+
+
+def send_to_many(sender, project, subject, body, recipient_ids=None, all_members=False,
+                 chunk_size=SEND_CHUNK_SIZE):
+    """
+    Send the same message from ``sender`` to each of ``recipient_ids``, or to
+    every other member of ``project`` when ``all_members`` is set.
+    Returns ``(mails, results)`` where ``results`` maps each requested
+    recipient id to SENT, NOT_A_MEMBER or SELF.
+    """
+    if all_members:
+        recipients = project_recipients(project, exclude=sender)
+        results = {}
+    else:
+        requested = list(dict.fromkeys(recipient_ids or []))
+        members = {
+            user.id: user
+            for user in User.objects.filter(id__in=requested, userprofile__projects=project).only(*RECIPIENT_FIELDS)
+        }
+        results = {
+            recipient_id: SELF if recipient_id == sender.id else NOT_A_MEMBER
+            for recipient_id in requested
+            if recipient_id == sender.id or recipient_id not in members
+        }
+        recipients = [members[recipient_id] for recipient_id in requested if recipient_id not in results]
+
+    if not recipients:
+        return [], results
+
+    with transaction.atomic():
+        # One shared body, however many deliveries
+        content = intern_content(subject, body)
+        thread = start_thread(subject, project)
+        mails = []
+        for recipient in recipients:
+            mail = Mail(sender=sender, recipient=recipient, project=project, subject=subject, thread=thread)
+            use_content(mail, content)
+            mail.search_document = build_mail_document(mail)
+            mails.append(mail)
+            results[recipient.id] = SENT
+        for start in range(0, len(mails), chunk_size):
+            Mail.objects.bulk_create(mails[start:start + chunk_size])
+        counters.record_delivered(mails)
+        changelog.record(changelog.mail_changes(mails))
+        push.notify_delivered(mails)
+    return mails, results
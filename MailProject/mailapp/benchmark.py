@@ -0,0 +1,271 @@
+"""
+View benchmarks on synthetic data.
+
+``generate_dataset`` fills the database with users, projects, memberships
+and mail shaped like a real tenant. There are a few big projects and many
+small ones, and a few people send and receive most of the mail (Zipf-like
+weights). Conversations have replies, and older mail is mostly read. Rows
+are written with bulk_create a chunk at a time, so millions of mails fit
+in memory.
+
+``run_scenarios`` then requests each core view as the busiest user through
+the test client. It times every request, counts its queries and reports
+latency percentiles per view. ``manage.py benchmark_views`` runs this at
+several data sizes inside a transaction it rolls back, saves the numbers
+as a baseline and compares later runs against it with ``compare``.
+"""
+import random
+import statistics
+import time
+from collections import deque
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import counters
+from .content import intern_contents, use_content
+from .models import Mail, Project, Thread, UserProfile
+from .search import build_mail_document
+from .threads import REPLY_PREFIX, prefixed
+from .transfer import original_timestamps
+
+GENERATE_CHUNK_SIZE = 5000
+HISTORY_DAYS = 730
+# Mail newer than this is mostly unread, older mail mostly read
+RECENT_DAYS = 30
+REPLY_RATIO = 0.3
+# Share of mail reusing an earlier body, like announcements and templates
+REPEATED_BODY_RATIO = 0.2
+# Higher means mail and memberships concentrate on fewer people and projects
+SKEW = 1.1
+# Recent mails per project that replies are drawn from
+REPLY_WINDOW = 50
+WARMUP_REQUESTS = 2
+SEARCH_WORD = 'update'
+
+WORDS = (
+    'project update review launch budget meeting design release plan status report draft schedule '
+    'client feedback deadline sprint team notes roadmap question follow agenda invoice contract '
+    'testing deploy issue fix summary proposal weekly monthly quarter goals priority risk'
+).split()
+FIRST_NAMES = 'Ada Ben Chloe Dev Emma Finn Grace Hugo Iris Jack Kai Lena Milo Nora Omar Priya Quinn Ravi Sara Tom'.split()
+LAST_NAMES = 'Adams Brown Chen Diaz Evans Fischer Garcia Hughes Ito Jones Khan Lopez Moore Nguyen Patel Reyes Smith'.split()
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Dataset:
+    def __init__(self, users, projects, mails, busiest):
+        self.users = users
+        self.projects = projects
+        self.mails = mails
+        self.busiest = busiest
+
+
+def zipf_weights(count, skew=SKEW):
+    return [1 / rank ** skew for rank in range(1, count + 1)]
+
+
+def weighted_sample(rng, population, weights, k):
+    """k distinct items, each picked with probability proportional to its weight"""
+    keyed = sorted(zip(population, weights), key=lambda item: rng.random() ** (1 / item[1]), reverse=True)
+    return [item for item, _ in keyed[:k]]
+
+
+def _sentence(rng, low, high):
+    return ' '.join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+
+def generate_dataset(mails, users=None, projects=None, seed=0, chunk_size=GENERATE_CHUNK_SIZE):
+    """
+    Create ``mails`` mails between ``users`` users in ``projects`` projects
+    (by default one user per 100 mails and one project per 20 users).
+    The same seed always produces the same data.
+    """
+    rng = random.Random(seed)
+    users = users or max(10, mails // 100)
+    projects = projects or max(3, users // 20)
+    prefix = f'bench{Project.objects.count()}'
+    now = timezone.now()
+
+    with original_timestamps():
+        people = []
+        for i in range(users):
+            user = User(username=f'{prefix}-user{i}', first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES))
+            user.set_unusable_password()
+            people.append(user)
+        User.objects.bulk_create(people, batch_size=chunk_size)
+        profiles = UserProfile.objects.bulk_create([UserProfile(user=user) for user in people], batch_size=chunk_size)
+        user_weights = zipf_weights(users)
+
+        teams = Project.objects.bulk_create([
+            Project(name=f'{prefix} {rng.choice(WORDS).title()} {i}', created_by=people[0], created_at=now)
+            for i in range(projects)
+        ])
+        # A few big projects and a long tail of small ones; busy people join more of them
+        members = []
+        for weight in zipf_weights(projects):
+            size = max(2, min(users, round(users * 0.5 * weight)))
+            members.append(weighted_sample(rng, range(users), user_weights, size))
+        joined = {index for team in members for index in team}
+        for index in range(users):
+            if index not in joined:
+                members[rng.randrange(projects)].append(index)
+        Through = UserProfile.projects.through
+        Through.objects.bulk_create(
+            [Through(userprofile_id=profiles[index].id, project_id=team.id)
+             for team, indexes in zip(teams, members) for index in indexes],
+            batch_size=chunk_size,
+        )
+
+        project_weights = [len(indexes) for indexes in members]
+        member_weights = [list(accumulate(user_weights[index] for index in indexes)) for indexes in members]
+        templates = [_sentence(rng, 30, 80) for _ in range(20)]
+        recent = [deque(maxlen=REPLY_WINDOW) for _ in teams]
+        start = now - timedelta(days=HISTORY_DAYS)
+        step = timedelta(days=HISTORY_DAYS) / max(mails, 1)
+
+        for chunk_start in range(0, mails, chunk_size):
+            planned = []
+            for i in range(chunk_start, min(chunk_start + chunk_size, mails)):
+                p = rng.choices(range(projects), weights=project_weights)[0]
+                sent_at = start + step * i
+                parent = rng.choice(recent[p]) if recent[p] and rng.random() < REPLY_RATIO else None
+                if parent is not None:
+                    # The reply goes back the other way, in the same conversation
+                    _, _, sender, recipient, subject = parent
+                    sender, recipient, subject = recipient, sender, prefixed(REPLY_PREFIX, subject)
+                else:
+                    sender = recipient = rng.choices(members[p], cum_weights=member_weights[p])[0]
+                    while recipient == sender:
+                        recipient = rng.choices(members[p], cum_weights=member_weights[p])[0]
+                    subject = _sentence(rng, 2, 6).capitalize()
+                body = rng.choice(templates) if rng.random() < REPEATED_BODY_RATIO else _sentence(rng, 15, 120)
+                unread_chance = 0.6 if now - sent_at < timedelta(days=RECENT_DAYS) else 0.03
+                planned.append((p, sender, recipient, subject, body, sent_at, rng.random() >= unread_chance, parent))
+
+            contents = intern_contents({(subject, body) for _, _, _, subject, body, _, _, _ in planned})
+            threads = {
+                i: Thread(project=teams[p], subject=subject, created_at=sent_at)
+                for i, (p, _, _, subject, _, sent_at, _, parent) in enumerate(planned) if parent is None
+            }
+            Thread.objects.bulk_create(threads.values())
+            chunk = []
+            for i, (p, sender, recipient, subject, body, sent_at, is_read, parent) in enumerate(planned):
+                mail = Mail(sender=people[sender], recipient=people[recipient], project=teams[p],
+                            subject=subject, sent_at=sent_at, is_read=is_read)
+                if parent is None:
+                    mail.thread = threads[i]
+                else:
+                    mail.in_reply_to_id, mail.thread_id = parent[0], parent[1]
+                use_content(mail, contents[(subject, body)])
+                mail.search_document = build_mail_document(mail)
+                chunk.append(mail)
+            Mail.objects.bulk_create(chunk)
+            for mail, (p, sender, recipient, subject, *_) in zip(chunk, planned):
+                recent[p].append((mail.id, mail.thread_id, sender, recipient, subject))
+
+    counters.reconcile()
+    busiest_id = (
+        Mail.objects.filter(project__in=teams).values('recipient').annotate(total=Count('id'))
+        .order_by('-total').values_list('recipient', flat=True).first()
+    )
+    busiest = next((user for user in people if user.id == busiest_id), people[0])
+    return Dataset(people, teams, mails, busiest)
+
+
+def scenarios(dataset):
+    """(name, method, url, data) for every request the benchmark makes"""
+    user = dataset.busiest
+    project = user.userprofile.projects.annotate(size=Count('members')).order_by('-size').first()
+    recipient = project.members.exclude(user=user).values_list('user_id', flat=True).first()
+    mail = Mail.objects.filter(recipient=user).order_by('-sent_at', '-id').first()
+    inbox = reverse('inbox')
+    steps = [
+        ('inbox', 'get', inbox, None),
+        ('inbox_search', 'get', f'{inbox}?search={SEARCH_WORD}', None),
+        ('inbox_threads', 'get', f'{inbox}?view=threads', None),
+        ('sent', 'get', reverse('sent'), None),
+        ('compose', 'get', reverse('compose'), None),
+        ('compose_send', 'post', reverse('compose'), {
+            'action': 'send', 'project': project.id, 'recipient': recipient,
+            'subject': 'Benchmark', 'body': 'Measuring the send path',
+        }),
+        ('project_users', 'get', f"{reverse('get_project_users')}?project_id={project.id}", None),
+    ]
+    if mail is not None:
+        steps.insert(4, ('read_mail', 'get', reverse('read_mail', args=[mail.id]), None))
+    return steps
+
+
+def percentiles(timings):
+    # quantiles() needs two points; a single timing is every percentile
+    cuts = statistics.quantiles(timings, n=100, method='inclusive') if len(timings) > 1 else timings * 99
+    return {
+        'p50_ms': round(cuts[49], 2),
+        'p95_ms': round(cuts[94], 2),
+        'p99_ms': round(cuts[98], 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+    }
+
+
+def summarize(timings, query_counts):
+    return {**percentiles(timings), 'queries': max(query_counts)}
+
+
+def run_scenarios(dataset, repeat, warmup=WARMUP_REQUESTS):
+    """Time each scenario ``repeat`` times after ``warmup`` untimed requests; returns {name: summary}"""
+    client = Client(HTTP_HOST='localhost')
+    client.force_login(dataset.busiest)
+    results = {}
+    for name, method, url, data in scenarios(dataset):
+        timings, query_counts = [], []
+        for attempt in range(warmup + repeat):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                if method == 'post':
+                    response = client.post(url, data, secure=True)
+                else:
+                    response = client.get(url, secure=True)
+                elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code >= 400:
+                raise BenchmarkError(f'{name} answered {response.status_code}')
+            if attempt >= warmup:
+                timings.append(elapsed)
+                query_counts.append(len(captured))
+        results[name] = summarize(timings, query_counts)
+    return results
+
+
+def compare(baseline, current, tolerance):
+    """
+    Lines describing each view's change from ``baseline`` to ``current``
+    (both {size: {view: summary}}), and how many regressed: any extra query,
+    or a p95 more than ``tolerance`` (a fraction) slower.
+    """
+    lines, regressions = [], 0
+    for size, views in current.items():
+        for view, now in views.items():
+            before = baseline.get(size, {}).get(view)
+            if before is None:
+                lines.append(f'{size:>8}  {view:<14}  new')
+                continue
+            slower = now['p95_ms'] > before['p95_ms'] * (1 + tolerance)
+            more_queries = now['queries'] > before['queries']
+            regressed = slower or more_queries
+            regressions += regressed
+            lines.append(
+                f"{size:>8}  {view:<14}  p95 {before['p95_ms']:>8.1f} -> {now['p95_ms']:>8.1f} ms"
+                f"  queries {before['queries']:>3} -> {now['queries']:>3}"
+                f"{'  REGRESSION' if regressed else ''}"
+            )
+    return lines, regressions
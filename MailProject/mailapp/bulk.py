@@ -0,0 +1,108 @@
+"""
+Set-based mailbox actions.
+
+Selections are always scoped to the requesting user's inbox in the WHERE
+clause, so ids belonging to someone else simply never match. Work is done
+in primary-key chunks, each one a single UPDATE or DELETE inside its own
+transaction, so a huge "mark everything read" neither holds long locks nor
+loads every row into memory.
+
+Mail has no folders; a mail's project is what groups it, so "move" puts
+mail in another project. The row is shared with the sender, whose Sent
+view shows the new project too.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import changelog, counters
+from .models import Mail
+from .search import search
+
+BULK_ACTIONS = ('mark_read', 'mark_unread', 'delete', 'move')
+BULK_CHUNK_SIZE = 500
+
+
+def select_mailbox(user, ids=None, project_id=None, search_query=None, older_than_days=None):
+    """Build the inbox selection an action applies to"""
+    mails = Mail.objects.filter(recipient=user)
+    if ids is not None:
+        mails = mails.filter(pk__in=ids)
+    if project_id is not None:
+        mails = mails.filter(project_id=project_id)
+    if search_query:
+        mails = search(mails, search_query)
+    if older_than_days is not None:
+        mails = mails.filter(sent_at__lt=timezone.now() - timedelta(days=older_than_days))
+    return mails
+
+
+def _chunks(queryset, chunk_size):
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def _set_read(ids, is_read):
+    # Lock the rows that will actually flip so the counter deltas are exact
+    flipping = list(
+        Mail.objects.select_for_update()
+        .filter(pk__in=ids, is_read=not is_read)
+        .order_by()
+        .values_list('id', 'recipient_id', 'project_id', 'sender_id', named=True)
+    )
+    if not flipping:
+        return 0
+    Mail.objects.filter(pk__in=[row.id for row in flipping]).update(is_read=is_read)
+    step = -1 if is_read else 1
+    for row in flipping:
+        counters.apply_delta(row.recipient_id, row.project_id, unread=step)
+    changelog.record(changelog.mail_changes(flipping))
+    return len(flipping)
+
+
+def _move(ids, project_id):
+    moving = list(
+        Mail.objects.select_for_update()
+        .filter(pk__in=ids)
+        .exclude(project_id=project_id)
+        .order_by()
+        .values_list('id', 'recipient_id', 'project_id', 'sender_id', 'is_read', named=True)
+    )
+    if not moving:
+        return 0
+    Mail.objects.filter(pk__in=[row.id for row in moving]).update(project_id=project_id)
+    for row in moving:
+        unread = 0 if row.is_read else 1
+        counters.apply_delta(row.recipient_id, row.project_id, total=-1, unread=-unread)
+        counters.apply_delta(row.recipient_id, project_id, total=1, unread=unread)
+    changelog.record(changelog.mail_changes(moving))
+    return len(moving)
+
+
+def apply_bulk_action(queryset, action, chunk_size=BULK_CHUNK_SIZE, project_id=None):
+    """
+    Apply ``action`` to every mail in ``queryset``; returns the number of
+    rows changed. "move" puts the mail in ``project_id``, which the caller
+    must have checked the user belongs to.
+    """
+    if action not in BULK_ACTIONS:
+        raise ValueError(f'Unknown bulk action: {action}')
+    if action == 'move' and project_id is None:
+        raise ValueError('Moving mail needs a project_id')
+    changed = 0
+    for ids in _chunks(queryset, chunk_size):
+        with transaction.atomic(), counters.batched(), changelog.batched():
+            if action == 'delete':
+                _, deleted = Mail.objects.filter(pk__in=ids).delete()
+                changed += deleted.get(Mail._meta.label, 0)
+            elif action == 'move':
+                changed += _move(ids, project_id)
+            else:
+                changed += _set_read(ids, action == 'mark_read')
+    return changed
@@ -0,0 +1,229 @@
+"""
+Mailbox change log and incremental sync.
+
+Every change a client would need to mirror a mailbox appends a
+MailboxChange row for each affected user: new mail, read-state flips,
+edits and deletes (for both the recipient and the sender, since the sent
+view shows read state too) and every draft change. The
+row id only grows, so it doubles as the sync cursor: a client asks for
+everything after the last id it saw and gets the current state of each
+object that changed, plus the ids of those that were deleted, without
+re-reading the rest of the mailbox.
+
+Ids are handed out when rows are inserted, not when they commit. On
+Postgres a transaction holding id 9 can commit after one holding id 10,
+by which time a client may have synced past 10. Each sync therefore also
+sends the objects of the entries at or below the cursor from the last
+``SYNC_OVERLAP_SECONDS``, which catches such a late entry as long as the
+transaction that wrote it finished within the window. Objects are sent
+as their current state, so getting one twice changes nothing.
+
+Saves and deletes are logged by the signals. Code that bypasses them
+(``update()``, ``bulk_create``) calls ``record`` itself, as it does for the
+mailbox counters, and ``batched()`` turns the entries of a bulk action into
+one INSERT. Entries for a user who is being deleted are skipped. Logging
+also invalidates the users' cached mailbox pages once the change commits.
+
+``compact`` drops entries superseded by a newer one for the same object,
+which keeps the log about the size of the mailboxes without changing what
+any cursor syncs to.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import BigIntegerField, Exists, OuterRef, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .mailbox_cache import invalidate_mailboxes
+from .models import Draft, Mail, MailboxChange
+
+MAIL = MailboxChange.KIND_MAIL
+DRAFT = MailboxChange.KIND_DRAFT
+UPSERT = MailboxChange.ACTION_UPSERT
+DELETE = MailboxChange.ACTION_DELETE
+
+SYNC_LIMIT = 200
+# Longer than any transaction that logs changes; the bulk paths commit a chunk at a time
+SYNC_OVERLAP_SECONDS = 30
+COMPACT_CHUNK_SIZE = 1000
+
+# The mail answered, still reported once it has been archived
+IN_REPLY_TO = Coalesce('in_reply_to_id', 'in_reply_to_archived_id', output_field=BigIntegerField())
+# Fields a client may ask for, mapped to the ORM lookups that load them
+MAIL_FIELDS = {
+    'id': 'id',
+    'thread_id': 'thread_id',
+    'in_reply_to_id': IN_REPLY_TO,
+    'project_id': 'project_id',
+    'sender_id': 'sender_id',
+    'sender': 'sender__username',
+    'recipient_id': 'recipient_id',
+    'recipient': 'recipient__username',
+    'subject': 'subject',
+    'preview': 'preview',
+    'body': 'content__body',
+    'sent_at': 'sent_at',
+    'is_read': 'is_read',
+}
+DRAFT_FIELDS = {
+    'id': 'id',
+    'project_id': 'project_id',
+    'recipient_id': 'recipient_id',
+    'in_reply_to_id': IN_REPLY_TO,
+    'subject': 'subject',
+    'preview': 'preview',
+    'body': 'content__body',
+    'version': 'version',
+    'updated_at': 'updated_at',
+}
+DEFAULT_MAIL_FIELDS = ('id', 'thread_id', 'project_id', 'sender_id', 'recipient_id', 'subject', 'preview', 'sent_at', 'is_read')
+DEFAULT_DRAFT_FIELDS = ('id', 'project_id', 'recipient_id', 'subject', 'preview', 'version', 'updated_at')
+
+
+# Entries collected inside a batched() block
+_pending = ContextVar('pending_mailbox_changes', default=None)
+# Users whose delete is cascading right now; logging for them would violate the foreign key
+_departing = ContextVar('departing_users', default=frozenset())
+
+
+@contextmanager
+def batched():
+    """Collect the entries recorded inside the block and write them with one INSERT on exit"""
+    changes = []
+    token = _pending.set(changes)
+    try:
+        yield
+    finally:
+        _pending.reset(token)
+    log_changes(changes)
+
+
+def user_departing(user_id):
+    _departing.set(_departing.get() | {user_id})
+
+
+def user_departed(user_id):
+    _departing.set(_departing.get() - {user_id})
+
+
+def record(changes):
+    """Log ``(user_id, kind, object_id, action)`` entries now, or at the end of the enclosing batched() block"""
+    departing = _departing.get()
+    changes = [change for change in changes if change[0] not in departing]
+    pending = _pending.get()
+    if pending is not None:
+        pending.extend(changes)
+    else:
+        log_changes(changes)
+
+
+def log_changes(changes):
+    if changes:
+        MailboxChange.objects.bulk_create(
+            [MailboxChange(user_id=user_id, kind=kind, object_id=object_id, action=action)
+             for user_id, kind, object_id, action in changes],
+            batch_size=500,
+        )
+        # Cached pages of these mailboxes are stale once the change is visible
+        user_ids = {change[0] for change in changes}
+        transaction.on_commit(lambda: invalidate_mailboxes(user_ids))
+
+
+def mail_changes(mails, action=UPSERT):
+    """Entries for ``mails`` in both the recipient's and the sender's mailbox"""
+    changes = []
+    for mail in mails:
+        changes.append((mail.recipient_id, MAIL, mail.id, action))
+        if mail.sender_id != mail.recipient_id:
+            changes.append((mail.sender_id, MAIL, mail.id, action))
+    return changes
+
+
+def parse_fields(value, lookups, default):
+    """
+    Turn a comma-separated ``fields`` parameter into a tuple of known names,
+    always starting with 'id'. Raises ValueError naming any unknown field.
+    """
+    if not value:
+        return default
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in lookups]
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    return ('id',) + tuple(dict.fromkeys(name for name in names if name != 'id'))
+
+
+def _select(queryset, fields, lookups):
+    # values_list plus renaming, since names like 'sender' clash with model fields as annotations
+    rows = queryset.order_by('id').values_list(*(lookups[name] for name in fields))
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def changes_since(user, cursor, mail_fields=DEFAULT_MAIL_FIELDS, draft_fields=DEFAULT_DRAFT_FIELDS,
+                  limit=SYNC_LIMIT):
+    """
+    What changed in ``user``'s mailbox after ``cursor``, as a dict with the
+    next ``cursor``, ``has_more``, the current ``mails`` and ``drafts``
+    (restricted to the given fields, which must include 'id') and the ids
+    ``deleted`` since.
+    """
+    user_changes = MailboxChange.objects.filter(user=user)
+    entries = list(
+        user_changes.filter(id__gt=cursor).order_by('id')
+        .values_list('id', 'kind', 'object_id', 'action')[:limit + 1]
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    # Recent entries the client may have synced past before they committed; the newest, if there are many
+    overlap = list(
+        user_changes.filter(id__lte=cursor, created_at__gte=timezone.now() - timedelta(seconds=SYNC_OVERLAP_SECONDS))
+        .order_by('-id').values_list('id', 'kind', 'object_id', 'action')[:limit]
+    ) if cursor else []
+
+    # Several entries for one object collapse into its latest state
+    latest = {}
+    for change_id, kind, object_id, action in reversed(overlap):
+        latest[(kind, object_id)] = action
+    for change_id, kind, object_id, action in entries:
+        latest[(kind, object_id)] = action
+    wanted = {MAIL: [], DRAFT: []}
+    deleted = {MAIL: [], DRAFT: []}
+    for (kind, object_id), action in latest.items():
+        (deleted if action == DELETE else wanted)[kind].append(object_id)
+
+    mails = _select(
+        Mail.objects.filter(Q(recipient=user) | Q(sender=user), id__in=wanted[MAIL]), mail_fields, MAIL_FIELDS,
+    ) if wanted[MAIL] else []
+    drafts = _select(
+        Draft.objects.filter(author=user, id__in=wanted[DRAFT]), draft_fields, DRAFT_FIELDS,
+    ) if wanted[DRAFT] else []
+    # Anything that vanished without a delete entry yet is gone all the same
+    deleted[MAIL] += sorted(set(wanted[MAIL]) - {mail['id'] for mail in mails})
+    deleted[DRAFT] += sorted(set(wanted[DRAFT]) - {draft['id'] for draft in drafts})
+
+    return {
+        'cursor': entries[-1][0] if entries else cursor,
+        'has_more': has_more,
+        'mails': mails,
+        'drafts': drafts,
+        'deleted': {'mails': deleted[MAIL], 'drafts': deleted[DRAFT]},
+    }
+
+
+def compact(chunk_size=COMPACT_CHUNK_SIZE):
+    """Delete entries that a newer entry for the same user and object supersedes; returns the count"""
+    newer = MailboxChange.objects.filter(
+        user_id=OuterRef('user_id'), kind=OuterRef('kind'), object_id=OuterRef('object_id'), id__gt=OuterRef('id'),
+    )
+    superseded = MailboxChange.objects.filter(Exists(newer))
+    removed = 0
+    last_id = 0
+    while True:
+        ids = list(superseded.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return removed
+        removed += MailboxChange.objects.filter(id__in=ids).delete()[0]
+        last_id = ids[-1]
@@ -0,0 +1,95 @@
+"""
+Shared message content.
+
+Subjects and bodies live in MessageContent rows addressed by a hash of
+their text, and Mail and Draft rows point at them. Sending one message to
+a whole project, or sending a draft, writes the body once; every delivery
+row only carries its own subject, a short preview and the content id.
+
+Content rows are never updated: changing a draft's text points it at a
+different row. Rows nothing points at any more are removed by
+``manage.py prune_message_contents``.
+"""
+import hashlib
+
+from django.db import IntegrityError, transaction
+from django.db.models import ProtectedError
+
+from .models import PREVIEW_LENGTH, MessageContent
+
+
+def message_hash(subject, body):
+    return hashlib.sha256(f'{subject}\x1f{body}'.encode()).hexdigest()
+
+
+def intern_content(subject, body):
+    """Return the MessageContent for this subject and body, creating it if needed"""
+    content_hash = message_hash(subject, body)
+    content = MessageContent.objects.filter(content_hash=content_hash).first()
+    if content is not None:
+        return content
+    try:
+        with transaction.atomic():
+            return MessageContent.objects.create(content_hash=content_hash, subject=subject, body=body)
+    except IntegrityError:
+        # Someone stored the same text first
+        return MessageContent.objects.get(content_hash=content_hash)
+
+
+def intern_contents(texts):
+    """
+    ``intern_content`` for many ``(subject, body)`` pairs at once, with a
+    few queries however many there are. Returns {(subject, body): MessageContent}.
+    """
+    by_hash = {message_hash(subject, body): (subject, body) for subject, body in texts}
+    found = {content.content_hash: content for content in MessageContent.objects.filter(content_hash__in=by_hash)}
+    missing = [
+        MessageContent(content_hash=content_hash, subject=subject, body=body)
+        for content_hash, (subject, body) in by_hash.items() if content_hash not in found
+    ]
+    if missing:
+        # Rows someone else stored meanwhile are skipped and read back below
+        MessageContent.objects.bulk_create(missing, ignore_conflicts=True)
+        found.update(
+            (content.content_hash, content)
+            for content in MessageContent.objects.filter(content_hash__in=[c.content_hash for c in missing])
+        )
+    return {text: found[content_hash] for content_hash, text in by_hash.items()}
+
+
+def use_content(message, content):
+    """Point a Mail or Draft at ``content`` and refresh its preview"""
+    message.content = content
+    message.body = content.body
+    message.preview = content.body[:PREVIEW_LENGTH]
+
+
+def attach_content(message):
+    """Make sure ``message`` points at content matching its current subject and body"""
+    subject, body = message.subject or '', message.body or ''
+    content_field = message._meta.get_field('content')
+    if content_field.is_cached(message) and message.content.content_hash == message_hash(subject, body):
+        message.preview = body[:PREVIEW_LENGTH]
+        return
+    use_content(message, intern_content(subject, body))
+
+
+def prune_orphans(chunk_size=1000):
+    """Delete content rows no mail or draft refers to; returns how many went"""
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = list(
+            MessageContent.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        try:
+            with transaction.atomic():
+                deleted += MessageContent.objects.filter(
+                    id__in=ids, mails__isnull=True, drafts__isnull=True, archived_mails__isnull=True,
+                ).delete()[0]
+        except (IntegrityError, ProtectedError):
+            # A row in this chunk was reused while we looked; leave it for the next run
+            pass
+        last_id = ids[-1]
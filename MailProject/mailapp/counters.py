@@ -0,0 +1,153 @@
+"""
+Denormalized inbox counters.
+
+MailboxCounter holds (total, unread) per recipient and project so the inbox
+header and project dropdown never have to COUNT(*) the mail table. Counters
+are adjusted with single UPDATE ... SET x = x + n statements, so concurrent
+deliveries never lose increments. ``reconcile`` recomputes them from Mail
+in case anything bypassed the signals (raw SQL, admin bulk actions).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
+
+from . import changelog
+from .models import Mail, MailboxCounter
+
+# Deltas collected inside a batched() block, keyed by (user_id, project_id)
+_pending = ContextVar('pending_counter_deltas', default=None)
+
+
+@contextmanager
+def batched():
+    """
+    Collect counter changes made inside the block (including those from the
+    Mail signals) and apply them as one UPDATE per counter on exit.
+    """
+    deltas = {}
+    token = _pending.set(deltas)
+    try:
+        yield
+    finally:
+        _pending.reset(token)
+    apply_deltas(deltas)
+
+
+def apply_delta(user_id, project_id, total=0, unread=0):
+    """Atomically add ``total``/``unread`` (either may be negative) to one counter"""
+    pending = _pending.get()
+    if pending is not None:
+        old_total, old_unread = pending.get((user_id, project_id), (0, 0))
+        pending[(user_id, project_id)] = (old_total + total, old_unread + unread)
+        return
+    updated = MailboxCounter.objects.filter(user_id=user_id, project_id=project_id).update(
+        total=Greatest(F('total') + total, 0),
+        unread=Greatest(F('unread') + unread, 0),
+    )
+    if updated or (total <= 0 and unread <= 0):
+        # Never create a row for a decrement; the project may be mid-delete
+        return
+    try:
+        with transaction.atomic():
+            MailboxCounter.objects.create(user_id=user_id, project_id=project_id,
+                                          total=max(total, 0), unread=max(unread, 0))
+    except IntegrityError:
+        # Another request created the row first; apply the delta to theirs
+        apply_delta(user_id, project_id, total, unread)
+
+
+def apply_deltas(deltas):
+    """Apply many deltas, given as {(user_id, project_id): (total, unread)}"""
+    for (user_id, project_id), (total, unread) in deltas.items():
+        if total or unread:
+            apply_delta(user_id, project_id, total, unread)
+
+
+def record_delivered(mails, chunk_size=500):
+    """
+    Count freshly created mails, e.g. after a bulk_create that skipped signals.
+    Recipients that got the same increment in the same project share one
+    UPDATE, so fanning a message out to a whole project costs a few
+    statements rather than one per recipient.
+    """
+    deltas = {}
+    for mail in mails:
+        key = (mail.recipient_id, mail.project_id)
+        total, unread = deltas.get(key, (0, 0))
+        deltas[key] = (total + 1, unread + (0 if mail.is_read else 1))
+    if _pending.get() is not None:
+        apply_deltas(deltas)
+        return
+
+    groups = {}
+    for (user_id, project_id), delta in deltas.items():
+        groups.setdefault((project_id, delta), []).append(user_id)
+    for (project_id, (total, unread)), user_ids in groups.items():
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            # Make sure every row exists first so the UPDATE can't miss a concurrent create
+            MailboxCounter.objects.bulk_create(
+                [MailboxCounter(user_id=user_id, project_id=project_id) for user_id in chunk],
+                ignore_conflicts=True,
+            )
+            MailboxCounter.objects.filter(project_id=project_id, user_id__in=chunk).update(
+                total=F('total') + total, unread=F('unread') + unread,
+            )
+
+
+def mark_mail_read(mail):
+    """
+    Mark ``mail`` read with a conditional UPDATE, decrementing the unread
+    counter only if this call flipped the flag. Returns True if it did.
+    """
+    with transaction.atomic():
+        flipped = Mail.objects.filter(pk=mail.pk, is_read=False).update(is_read=True)
+        if flipped:
+            apply_delta(mail.recipient_id, mail.project_id, unread=-1)
+            changelog.record(changelog.mail_changes([mail]))
+    mail.is_read = True
+    return bool(flipped)
+
+
+def mailbox_summary(user):
+    """Return {project_id: MailboxCounter} for ``user`` in a single query"""
+    return {counter.project_id: counter for counter in MailboxCounter.objects.filter(user=user)}
+
+
+def reconcile(user=None):
+    """
+    Recompute counters from the mail table and fix any that drifted.
+    Returns the number of counters created, updated or removed.
+    """
+    mails = Mail.objects.order_by()
+    counters = MailboxCounter.objects.all()
+    if user is not None:
+        mails = mails.filter(recipient=user)
+        counters = counters.filter(user=user)
+
+    actual = {
+        (row['recipient_id'], row['project_id']): (row['total'], row['unread'])
+        for row in mails.values('recipient_id', 'project_id').annotate(
+            total=Count('id'), unread=Count('id', filter=Q(is_read=False)),
+        )
+    }
+    with transaction.atomic():
+        stored = {(c.user_id, c.project_id): c for c in counters.select_for_update()}
+        stale = [counter.pk for key, counter in stored.items() if key not in actual]
+        to_update = []
+        for key, counter in stored.items():
+            if key in actual and (counter.total, counter.unread) != actual[key]:
+                counter.total, counter.unread = actual[key]
+                to_update.append(counter)
+        MailboxCounter.objects.filter(pk__in=stale).delete()
+        MailboxCounter.objects.bulk_update(to_update, ['total', 'unread'])
+        missing = [
+            MailboxCounter(user_id=user_id, project_id=project_id, total=total, unread=unread)
+            for (user_id, project_id), (total, unread) in actual.items()
+            if (user_id, project_id) not in stored
+        ]
+        MailboxCounter.objects.bulk_create(missing)
+    return len(stale) + len(to_update) + len(missing)
@@ -0,0 +1,193 @@
+"""
+Database connection pooling.
+
+Opening a Postgres connection to Neon costs a TLS handshake and
+authentication, tens of milliseconds before the first query. Django keeps
+one connection per thread for ``CONN_MAX_AGE`` seconds. Under ASGI every
+request's sync code runs in a new thread, though, so those connections
+are never reused, and each worker's stray connections count against the
+server's connection limit. ``settings.DATABASE_POOL_MODE`` picks one of
+three ways to hold connections:
+
+* ``persistent`` (the default): Django's own per-thread connections.
+* ``pool``: the ``mailapp.postgresql_pool`` backend borrows connections
+  from a ``ConnectionPool`` shared by the process's threads and returns
+  them at the end of each request. A few stay open between requests, and
+  the pool never holds more than its maximum size, however many requests
+  are in flight.
+* ``pgbouncer``: for a DATABASE_URL that points at pgbouncer (or Neon's
+  pooled endpoint) in transaction pooling mode. Consecutive transactions
+  may run on different server connections, so nothing may depend on
+  session state. Server-side cursors are disabled, exports fetch in keyset
+  batches instead (see ``pagination.keyset_rows``), and connections to
+  pgbouncer, which are cheap, are opened per request.
+
+``prewarm`` opens each pool's minimum number of connections when the
+server starts, so the first requests don't pay for them.
+"""
+import threading
+import time
+from collections import deque
+
+from django.db import connections
+
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 10
+# Seconds a request waits for a free connection before failing
+POOL_TIMEOUT = 10.0
+# Connections are replaced after this many seconds, like CONN_MAX_AGE
+POOL_MAX_AGE = 600.0
+# Connections idle for longer are checked before reuse; the server or a proxy may have dropped them
+POOL_CHECK_AFTER = 30.0
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of DB-API connections. ``connect`` opens
+    one. ``reset`` readies a returned connection for its next user,
+    ``check`` tests an idle one, and ``close`` closes one; any of them
+    raising means the connection is thrown away.
+    """
+
+    def __init__(self, connect, reset=None, check=None, close=None, min_size=POOL_MIN_SIZE,
+                 max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT, max_age=POOL_MAX_AGE, check_after=POOL_CHECK_AFTER):
+        self._connect = connect
+        self._reset = reset
+        self._check = check
+        self._close = close or (lambda connection: connection.close())
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_after = check_after
+        # Idle connections as (connection, opened_at, returned_at), most recently returned last
+        self._idle = deque()
+        self._opened_at = {}
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """A connection for the caller's exclusive use; waits up to ``timeout`` when all are lent out"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f'No database connection free after {self.timeout:g}s ({self.max_size} in use)')
+                    self._condition.wait(remaining)
+                if not self._idle:
+                    self._size += 1
+                    break
+                # The warmest connection first, so the spare ones age out
+                connection, opened_at, returned_at = self._idle.pop()
+            if time.monotonic() - returned_at < self.check_after or self._run(self._check, connection):
+                return connection
+            self._discard(connection)
+        return self._open()
+
+    def release(self, connection, discard=False):
+        """Give ``connection`` back; ``discard`` closes it instead, e.g. after a connection error"""
+        opened_at = self._opened_at.get(id(connection), 0)
+        if discard or time.monotonic() - opened_at > self.max_age or not self._run(self._reset, connection):
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, opened_at, time.monotonic()))
+            self._condition.notify()
+
+    def prewarm(self, size=None):
+        """Open connections until ``size`` (default ``min_size``) are open; returns how many were opened"""
+        wanted = self.min_size if size is None else size
+        opened = []
+        while True:
+            with self._condition:
+                if self._size >= min(wanted, self.max_size):
+                    break
+                self._size += 1
+            opened.append(self._open())
+        for connection in opened:
+            self.release(connection)
+        return len(opened)
+
+    def close_idle(self):
+        """Close every idle connection, e.g. before the process forks or exits"""
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+    def stats(self):
+        with self._condition:
+            return {'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle)}
+
+    def _open(self):
+        # The slot is already counted in _size
+        try:
+            connection = self._connect()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        self._opened_at[id(connection)] = time.monotonic()
+        return connection
+
+    def _discard(self, connection):
+        self._run(self._close, connection)
+        with self._condition:
+            self._opened_at.pop(id(connection), None)
+            self._size -= 1
+            self._condition.notify()
+
+    @staticmethod
+    def _run(hook, connection):
+        if hook is None:
+            return True
+        try:
+            hook(connection)
+        except Exception:
+            return False
+        return True
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, create=None):
+    """The pool for database ``alias``; built with ``create()`` the first time"""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None and create is not None:
+            pool = _pools[alias] = create()
+        return pool
+
+
+def _prewarm(opened):
+    for alias in connections:
+        if connections.settings[alias].get('POOL') is None:
+            continue
+        # Connecting once builds the pool from the backend's settings
+        connection = connections[alias]
+        connection.ensure_connection()
+        connection.close()
+        opened[alias] = get_pool(alias).prewarm()
+
+
+def prewarm():
+    """
+    Fill every pooled database's pool to its minimum size; returns {alias:
+    connections opened}. The work happens on a thread of its own, so this is
+    safe to call while an event loop is running, as uvicorn does while
+    importing the application.
+    """
+    opened = {}
+    thread = threading.Thread(target=_prewarm, args=(opened,), name='db-prewarm')
+    thread.start()
+    thread.join()
+    return opened
@@ -0,0 +1,89 @@
+"""
+Project membership directory.
+
+The recipient dropdown, the compose and draft forms and every autosave all
+need "who is in this project". Each project's member list (id and display
+name) is cached under a per-project version number, and the signals bump
+that version whenever membership or a member's name changes, so stale lists
+are simply never read again and age out of the cache on their own.
+
+Versions start from the current time in milliseconds rather than 1, so a
+version key that was evicted and recreated can never collide with an old
+cached list.
+
+A version bump only reaches the processes that share the cache. Without
+``MAIL_SHARED_CACHE`` (the local memory cache with several workers) lists
+are kept for seconds rather than a day, so a removed member drops off
+everywhere quickly, and the recipient endpoint sends no ETag.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from .models import Project
+
+MEMBERS_TIMEOUT = 24 * 60 * 60
+# How long a list lives when other processes can't see the version bumps
+LOCAL_MEMBERS_TIMEOUT = 10
+
+
+def _version_key(project_id):
+    return f'directory:version:{project_id}'
+
+
+def project_version(project_id):
+    key = _version_key(project_id)
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def invalidate_project(project_id):
+    try:
+        cache.incr(_version_key(project_id))
+    except ValueError:
+        # No version yet, so nothing can have been cached under it
+        pass
+
+
+def display_name(user):
+    full_name = f"{user['first_name']} {user['last_name']}".strip()
+    return f"{full_name} ({user['username']})" if full_name else user['username']
+
+
+def project_members(project_id):
+    """
+    Members of ``project_id`` as ``[{'id': ..., 'name': ...}]``,
+    or None if there is no such project.
+    """
+    key = f'directory:members:{project_id}:{project_version(project_id)}'
+    cached = cache.get(key)
+    if cached is not None:
+        return cached['members']
+
+    if Project.objects.filter(id=project_id).exists():
+        users = User.objects.filter(userprofile__projects=project_id).order_by('id').values(
+            'id', 'username', 'first_name', 'last_name',
+        )
+        members = [{'id': user['id'], 'name': display_name(user)} for user in users]
+    else:
+        members = None
+    timeout = MEMBERS_TIMEOUT if settings.MAIL_SHARED_CACHE else LOCAL_MEMBERS_TIMEOUT
+    cache.set(key, {'members': members}, timeout=timeout)
+    return members
+
+
+def recipients_for(project_id, user):
+    """Everyone in the project except ``user``, as a User queryset for form fields"""
+    try:
+        members = project_members(int(project_id))
+    except (TypeError, ValueError):
+        members = None
+    if not members:
+        return User.objects.none()
+    return User.objects.filter(id__in=[member['id'] for member in members if member['id'] != user.id])
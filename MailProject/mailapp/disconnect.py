@@ -0,0 +1,49 @@
+"""
+Stopping streamed responses when the client goes away.
+
+Django 4.2 stops reading ASGI messages once it has the request body, so it
+never hears that a client disconnected, and uvicorn quietly drops whatever
+is sent after that. A streamed AI draft would keep calling the model, and
+an inbox event stream would stay subscribed, for nobody.
+
+``cancel_on_disconnect`` wraps the ASGI application. Once the body is read
+it listens for ``http.disconnect`` and cancels the request when it comes;
+the cancellation closes the response's iterator, and ``iterate_in_thread``
+closes the sync iterator behind it. Django 5.0 does this itself, so this
+can go with the upgrade.
+"""
+import asyncio
+
+
+def cancel_on_disconnect(app):
+    async def application(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+        body_read = asyncio.Event()
+
+        async def receive_request():
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        async def wait_for_disconnect():
+            await body_read.wait()
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        request = asyncio.ensure_future(app(scope, receive_request, send))
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await asyncio.wait([request, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+            if not request.done():
+                request.cancel()
+                try:
+                    await request
+                except asyncio.CancelledError:
+                    pass
+        if not request.cancelled():
+            request.result()
+    return application
@@ -2,6 +2,8 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from .models import Project, Mail, Draft
+from .directory import recipients_for
+from .threads import participant_mail
 
 class CustomUserCreationForm(UserCreationForm):
     email = forms.EmailField(required=True)
@@ -61,7 +63,27 @@ class CustomUserCreationForm(UserCreationForm):
         
         return cleaned_data
 
-class ComposeMailForm(forms.ModelForm):
+class MessageBodyMixin:
+    """The body lives in MessageContent, so ModelForm won't copy it to and from the instance itself"""
+    
+    def _init_body(self):
+        if self.instance.pk and 'body' not in self.initial:
+            self.initial['body'] = self.instance.body
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        if 'body' in cleaned_data:
+            self.instance.body = cleaned_data['body']
+        return cleaned_data
+
+class InReplyToMixin:
+    """A hidden ``in_reply_to`` field limited to mail the user sent or received"""
+    
+    def _init_in_reply_to(self, user):
+        self.fields['in_reply_to'].widget = forms.HiddenInput()
+        self.fields['in_reply_to'].queryset = participant_mail(user) if user else Mail.objects.none()
+
+class ComposeMailForm(InReplyToMixin, MessageBodyMixin, forms.ModelForm):
     project = forms.ModelChoiceField(
         queryset=Project.objects.none(),
         empty_label="Select Project"
@@ -72,16 +94,21 @@ class ComposeMailForm(forms.ModelForm):
         empty_label="Select Recipient"
     )
     
+    body = forms.CharField(
+        widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 10, 'placeholder': 'Enter your message'})
+    )
+    
     class Meta:
         model = Mail
-        fields = ['project', 'recipient', 'subject', 'body']
+        fields = ['project', 'recipient', 'subject', 'body', 'in_reply_to']
         widgets = {
             'subject': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter subject'}),
-            'body': forms.Textarea(attrs={'class': 'form-control', 'rows': 10, 'placeholder': 'Enter your message'}),
         }
     
     def __init__(self, user=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._init_body()
+        self._init_in_reply_to(user)
         
         if user:
             # Get projects the user is a member of
@@ -94,15 +121,8 @@ class ComposeMailForm(forms.ModelForm):
             
             # If there's data (POST request), populate recipient queryset based on selected project
             if self.data and 'project' in self.data and self.data.get('project'):
-                try:
-                    project_id = int(self.data.get('project'))
-                    project = Project.objects.get(id=project_id)
-                    recipients = User.objects.filter(
-                        userprofile__projects=project
-                    ).exclude(id=user.id)  # Exclude sender from recipients
-                    self.fields['recipient'].queryset = recipients
-                except (ValueError, TypeError, Project.DoesNotExist):
-                    self.fields['recipient'].queryset = User.objects.none()
+                # Members come from the directory cache; the sender is excluded
+                self.fields['recipient'].queryset = recipients_for(self.data.get('project'), user)
             else:
                 # Initially empty recipient field - will be populated via AJAX based on project selection
                 self.fields['recipient'].queryset = User.objects.none()
@@ -118,7 +138,7 @@ class ComposeMailForm(forms.ModelForm):
                     'id': 'id_project'
                 })
 
-class DraftForm(forms.ModelForm):
+class DraftForm(InReplyToMixin, MessageBodyMixin, forms.ModelForm):
     project = forms.ModelChoiceField(
         queryset=Project.objects.none(),
         empty_label="Select Project"
@@ -130,16 +150,22 @@ class DraftForm(forms.ModelForm):
         required=False
     )
     
+    body = forms.CharField(
+        required=False,
+        widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 10, 'placeholder': 'Enter your message'})
+    )
+    
     class Meta:
         model = Draft
-        fields = ['project', 'recipient', 'subject', 'body']
+        fields = ['project', 'recipient', 'subject', 'body', 'in_reply_to']
         widgets = {
             'subject': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter subject'}),
-            'body': forms.Textarea(attrs={'class': 'form-control', 'rows': 10, 'placeholder': 'Enter your message'}),
         }
     
     def __init__(self, user=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._init_body()
+        self._init_in_reply_to(user)
         
         # Add Bootstrap classes
         for field_name, field in self.fields.items():
@@ -152,15 +178,38 @@ class DraftForm(forms.ModelForm):
             
             # If there's data (POST request), populate recipient queryset based on selected project
             if hasattr(self, 'data') and self.data and 'project' in self.data:
-                try:
-                    project_id = int(self.data.get('project'))
-                    project = Project.objects.get(id=project_id)
-                    recipients = User.objects.filter(
-                        userprofile__projects=project
-                    ).exclude(id=user.id)  # Exclude sender from recipients
-                    self.fields['recipient'].queryset = recipients
-                except (ValueError, TypeError, Project.DoesNotExist):
-                    self.fields['recipient'].queryset = User.objects.none()
+                self.fields['recipient'].queryset = recipients_for(self.data.get('project'), user)
             else:
                 # Initially empty recipient field - will be populated via AJAX based on project selection
                 self.fields['recipient'].queryset = User.objects.none()
+
+class RecipientIdsField(forms.Field):
+    """A list of user ids posted as repeated ``recipients`` values"""
+    widget = forms.MultipleHiddenInput
+    
+    def to_python(self, value):
+        if not value:
+            return []
+        try:
+            return [int(recipient_id) for recipient_id in value]
+        except (TypeError, ValueError):
+            raise forms.ValidationError('Enter a list of user ids.')
+
+class BatchMailForm(forms.Form):
+    """One message for several recipients, or for every other member of the project"""
+    project = forms.ModelChoiceField(queryset=Project.objects.none())
+    recipients = RecipientIdsField(required=False)
+    all_members = forms.BooleanField(required=False)
+    subject = forms.CharField(max_length=200)
+    body = forms.CharField(widget=forms.Textarea)
+    
+    def __init__(self, user=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if user and hasattr(user, 'userprofile'):
+            self.fields['project'].queryset = user.userprofile.projects.all()
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('all_members') and not cleaned_data.get('recipients'):
+            raise forms.ValidationError('Choose at least one recipient or send to all project members.')
+        return cleaned_data
@@ -0,0 +1,74 @@
+"""
+Per-user mailbox versions for conditional GETs.
+
+Each user has a version number in the cache that changes whenever anything
+their mailbox pages show changes: mail or drafts (every change log entry),
+project membership, project names or their own name. ``inbox``, ``sent``
+and ``read_mail`` derive their ETag and Last-Modified from it, so a browser
+revalidating an unchanged page gets ``304 Not Modified`` without a single
+query or template render.
+
+Invalidating just deletes the version, and the next read starts a new one
+from the current time in microseconds. That makes versions unique and
+increasing without a round trip per user, so a broadcast to a thousand
+recipients costs one ``delete_many``. A version lost to eviction only
+costs one full render.
+
+An invalidation only reaches the processes sharing the cache, so pages get
+no ETag or Last-Modified unless ``MAIL_SHARED_CACHE`` is set. Otherwise a
+worker that missed the change would keep answering 304 with a stale page.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+
+
+def _version_key(user_id):
+    return f'mailbox:version:{user_id}'
+
+
+def mailbox_version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns() // 1000
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def invalidate_mailboxes(user_ids):
+    keys = [_version_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        cache.delete_many(keys)
+
+
+def _cacheable(request):
+    # Without a shared cache, other processes may still hold a version this one invalidated
+    if not settings.MAIL_SHARED_CACHE:
+        return False
+    # Flash messages are shown once, so a page carrying them must not be reused
+    return request.user.is_authenticated and not len(get_messages(request))
+
+
+def page_etag(request, *args, **kwargs):
+    """ETag for a mailbox page, for use with @condition"""
+    if not _cacheable(request):
+        return None
+    # Pages embed the CSRF token, so a new token must not revalidate an old page
+    raw = ':'.join([
+        str(request.user.pk), str(mailbox_version(request.user.pk)),
+        request.get_full_path(), request.META.get('CSRF_COOKIE', ''),
+    ])
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def page_last_modified(request, *args, **kwargs):
+    """Last-Modified for a mailbox page: when its version was started"""
+    if not _cacheable(request):
+        return None
+    return datetime.fromtimestamp(mailbox_version(request.user.pk) / 1_000_000, tz=timezone.utc)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mailapp.archive import ARCHIVE_BATCH_SIZE, archive, current_run
+from mailapp.models import ArchiveRun
+
+
+class Command(BaseCommand):
+    help = 'Move mail older than a given age into the archive, resuming an interrupted run if there is one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help='Archive mail sent more than this many days ago (default: MAIL_ARCHIVE_AFTER_DAYS). '
+                                 'Ignored when resuming, which keeps the original cutoff')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                            help=f'Mails moved per transaction (default: {ARCHIVE_BATCH_SIZE})')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches; the next run carries on from there')
+        parser.add_argument('--restart', action='store_true',
+                            help='Abandon an unfinished run and start a new one with a fresh cutoff')
+
+    def handle(self, *args, **options):
+        if options['restart']:
+            # Everything it moved stays archived; only its checkpoint is retired
+            ArchiveRun.objects.filter(finished_at__isnull=True).update(finished_at=timezone.now())
+        run = current_run(options['older_than_days'])
+        if run.last_id:
+            self.stdout.write(f'Resuming run {run.id} after mail {run.last_id} ({run.moved} moved so far)')
+        self.stdout.write(f'Archiving mail sent before {run.cutoff:%Y-%m-%d %H:%M}')
+
+        run = archive(run, options['batch_size'], options['max_batches'])
+        if run.finished_at:
+            self.stdout.write(self.style.SUCCESS(f'Done: {run.moved} mail(s) archived'))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'Stopped after mail {run.last_id} with {run.moved} mail(s) archived; run again to continue'
+            ))
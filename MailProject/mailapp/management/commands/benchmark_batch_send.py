@@ -0,0 +1,64 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from mailapp.batch_send import send_to_many
+from mailapp.models import Mail, Project, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Time sending one message to N project members, batched versus one save() per recipient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000',
+                            help='Comma-separated recipient counts (default: 10,100,1000)')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per size; the median is reported (default: 3)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        self.stdout.write(f'{"recipients":>10}  {"batched ms":>10}  {"queries":>7}  {"per-mail ms":>11}  {"queries":>7}')
+        # Everything happens in one transaction that is rolled back, so the database is left untouched
+        with transaction.atomic():
+            for size in sizes:
+                sender, project, recipients = self.make_project(size)
+                batched = self.measure(options['repeat'], lambda: send_to_many(
+                    sender, project, 'Benchmark', 'Hello everyone', all_members=True,
+                ))
+                single = self.measure(options['repeat'], lambda: [
+                    Mail.objects.create(sender=sender, recipient=recipient, project=project,
+                                        subject='Benchmark', body='Hello everyone')
+                    for recipient in recipients
+                ])
+                self.stdout.write(
+                    f'{size:>10}  {batched[0]:>10.1f}  {batched[1]:>7}  {single[0]:>11.1f}  {single[1]:>7}'
+                )
+            transaction.set_rollback(True)
+
+    def make_project(self, size):
+        suffix = Project.objects.count()
+        sender = User.objects.create_user(username=f'bench-sender-{suffix}')
+        project = Project.objects.create(name=f'Benchmark {suffix}', created_by=sender)
+        recipients = User.objects.bulk_create(
+            [User(username=f'bench-{suffix}-{i}') for i in range(size)]
+        )
+        profiles = UserProfile.objects.bulk_create([UserProfile(user=user) for user in recipients])
+        Through = UserProfile.projects.through
+        Through.objects.bulk_create(
+            [Through(userprofile_id=profile.id, project_id=project.id) for profile in profiles]
+            + [Through(userprofile_id=sender.userprofile.id, project_id=project.id)]
+        )
+        return sender, project, recipients
+
+    def measure(self, repeat, send):
+        timings = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                send()
+                timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings), len(queries)
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from copy import deepcopy
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, connections
+from django.test import Client
+from django.urls import reverse
+
+from mailapp.benchmark import generate_dataset, percentiles
+from mailapp.dbpool import get_pool, prewarm
+
+DEFAULT_RESULTS = settings.BASE_DIR / 'benchmarks' / 'connections.json'
+
+
+class Command(BaseCommand):
+    help = ('Time inbox requests the way the ASGI server runs them, each on a new thread, to compare '
+            'DATABASE_POOL_MODE settings. Run once per mode; the results collect in one file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Timed inbox requests (default: 200)')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Requests in flight at once (default: 4)')
+        parser.add_argument('--mails', type=int, default=2000,
+                            help='Mails in the generated mailbox, removed again afterwards (default: 2000)')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed for the data generator (default: 0)')
+        parser.add_argument('--label', default=None,
+                            help='Name for this run in the results (default: DATABASE_POOL_MODE)')
+        parser.add_argument('--output', default=str(DEFAULT_RESULTS),
+                            help=f'JSON file the results are merged into (default: {DEFAULT_RESULTS})')
+        parser.add_argument('--no-prewarm', action='store_true',
+                            help='Start with an empty pool, as when DATABASE_POOL_PREWARM is off')
+
+    def handle(self, *args, **options):
+        label = options['label'] or settings.DATABASE_POOL_MODE
+        # The request threads need the data committed, so it is deleted afterwards instead of rolled back
+        dataset = generate_dataset(options['mails'], seed=options['seed'])
+        try:
+            client = Client(HTTP_HOST='localhost')
+            client.force_login(dataset.busiest)
+            cookies = client.cookies
+            if not options['no_prewarm']:
+                prewarm()
+            timings = self.run_requests(cookies, options['requests'], options['concurrency'])
+        finally:
+            User.objects.filter(pk__in=[user.pk for user in dataset.users]).delete()
+
+        result = {
+            **percentiles(timings), 'vendor': connection.vendor, 'requests': options['requests'],
+            'concurrency': options['concurrency'], 'mails': options['mails'],
+        }
+        pool = get_pool(connection.alias)
+        if pool is not None:
+            result['pool'] = pool.stats()
+
+        try:
+            with open(options['output']) as saved:
+                results = json.load(saved)
+        except (OSError, ValueError):
+            results = {}
+        results[label] = result
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+        self.stdout.write(f'{"mode":<14}  {"vendor":<10}  {"p50 ms":>8}  {"p95 ms":>8}  {"p99 ms":>8}')
+        for name, run in sorted(results.items()):
+            self.stdout.write(
+                f"{name:<14}  {run['vendor']:<10}  {run['p50_ms']:>8.1f}  {run['p95_ms']:>8.1f}  {run['p99_ms']:>8.1f}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Saved {label} to {options['output']}"))
+
+    def run_requests(self, cookies, requests, concurrency):
+        url = reverse('inbox')
+        timings = []
+        slots = threading.BoundedSemaphore(concurrency)
+        lock = threading.Lock()
+
+        def one_request():
+            try:
+                client = Client(HTTP_HOST='localhost')
+                client.cookies = deepcopy(cookies)
+                started = time.perf_counter()
+                response = client.get(url, secure=True)
+                # What request_finished does outside the test client: give back or keep the connection
+                close_old_connections()
+                elapsed = (time.perf_counter() - started) * 1000
+                if response.status_code == 200:
+                    with lock:
+                        timings.append(elapsed)
+            finally:
+                # The thread ends here, and a real server thread's connections would go with it
+                connections.close_all()
+                slots.release()
+
+        threads = []
+        for _ in range(requests):
+            slots.acquire()
+            thread = threading.Thread(target=one_request)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if len(timings) < requests:
+            self.stderr.write(f'{requests - len(timings)} request(s) failed and were left out')
+        return timings
@@ -0,0 +1,66 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from mailapp.benchmark import generate_dataset, run_scenarios, compare
+
+DEFAULT_BASELINE = settings.BASE_DIR / 'benchmarks' / 'baseline.json'
+
+
+class Command(BaseCommand):
+    help = ('Time the core mail views against synthetic mailboxes of several sizes, '
+            'optionally saving the results as a baseline or comparing against one')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help='Comma-separated mail counts to generate (default: 1000,10000)')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Timed requests per view and size (default: 20)')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed for the data generator, so runs see the same data (default: 0)')
+        parser.add_argument('--save', nargs='?', const=str(DEFAULT_BASELINE), default=None,
+                            help=f'Write the results as a baseline (default path: {DEFAULT_BASELINE})')
+        parser.add_argument('--compare', nargs='?', const=str(DEFAULT_BASELINE), default=None,
+                            help='Compare against a saved baseline and fail on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed p95 slowdown before it counts as a regression (default: 0.25)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = {}
+        self.stdout.write(f'{"mails":>8}  {"view":<14}  {"p50 ms":>8}  {"p95 ms":>8}  {"p99 ms":>8}  {"queries":>7}')
+        # Rate limits would throttle the repeated sends; the data is rolled back after each size
+        with override_settings(RATE_LIMITS={}):
+            for size in sizes:
+                with transaction.atomic():
+                    dataset = generate_dataset(size, seed=options['seed'])
+                    results[str(size)] = run_scenarios(dataset, options['repeat'])
+                    transaction.set_rollback(True)
+                for view, summary in results[str(size)].items():
+                    self.stdout.write(
+                        f"{size:>8}  {view:<14}  {summary['p50_ms']:>8.1f}  {summary['p95_ms']:>8.1f}"
+                        f"  {summary['p99_ms']:>8.1f}  {summary['queries']:>7}"
+                    )
+
+        if options['save']:
+            with open(options['save'], 'w') as output:
+                json.dump({'repeat': options['repeat'], 'seed': options['seed'], 'results': results},
+                          output, indent=2, sort_keys=True)
+                output.write('\n')
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {options['save']}"))
+
+        if options['compare']:
+            try:
+                with open(options['compare']) as baseline:
+                    saved = json.load(baseline)['results']
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f'Could not read baseline: {e}')
+            lines, regressions = compare(saved, results, options['tolerance'])
+            for line in lines:
+                self.stdout.write(line)
+            if regressions:
+                raise CommandError(f'{regressions} view(s) regressed against the baseline')
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from mailapp.changelog import compact
+
+
+class Command(BaseCommand):
+    help = 'Delete mailbox change log entries superseded by a newer entry for the same object'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Entries deleted per statement (default: 1000)')
+
+    def handle(self, *args, **options):
+        removed = compact(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} superseded change log entr{"y" if removed == 1 else "ies"}'))
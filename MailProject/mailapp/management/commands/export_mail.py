@@ -0,0 +1,37 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp.models import Project
+from mailapp.transfer import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportScope, export_mailbox
+
+
+class Command(BaseCommand):
+    help = "Stream a user's or a project's mail and drafts as JSON Lines (for import_mail) or mbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username whose sent and received mail is exported')
+        parser.add_argument('--project', help='Project name whose mail is exported; with --user, only that user\'s mail in it')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl',
+                            help='jsonl (default, importable) or mbox (mail only)')
+        parser.add_argument('--output', default='-',
+                            help='File to write, or - for standard output (default)')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help=f'Rows fetched from the database at a time (default: {EXPORT_CHUNK_SIZE})')
+
+    def handle(self, *args, **options):
+        if not options['user'] and not options['project']:
+            raise CommandError('Give --user, --project or both')
+        try:
+            user = User.objects.get(username=options['user']) if options['user'] else None
+            project = Project.objects.get(name=options['project']) if options['project'] else None
+        except (User.DoesNotExist, Project.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        stream = export_mailbox(ExportScope(user=user, project=project), options['format'], options['chunk_size'])
+        if options['output'] == '-':
+            for part in stream:
+                self.stdout.write(part, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            output.writelines(stream)
+        self.stderr.write(self.style.SUCCESS(f"Exported to {options['output']}"))
@@ -0,0 +1,28 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp.transfer import IMPORT_BATCH_SIZE, InvalidExport, import_mailbox
+
+
+class Command(BaseCommand):
+    help = 'Import a JSON Lines file written by export_mail, mapping users by username and projects by name'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Export file to read, or - for standard input')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help=f'Rows inserted per transaction (default: {IMPORT_BATCH_SIZE})')
+
+    def handle(self, *args, **options):
+        try:
+            if options['path'] == '-':
+                stats = import_mailbox(sys.stdin, options['batch_size'])
+            else:
+                with open(options['path'], encoding='utf-8') as lines:
+                    stats = import_mailbox(lines, options['batch_size'])
+        except (OSError, InvalidExport) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['mails']} mail(s) and {stats['drafts']} draft(s); "
+            f"created {stats['users']} user(s) and {stats['projects']} project(s)"
+        ))
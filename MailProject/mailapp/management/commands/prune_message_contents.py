@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from mailapp.content import prune_orphans
+
+
+class Command(BaseCommand):
+    help = 'Delete stored message contents that no mail or draft refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Content rows checked per transaction (default: 1000)')
+
+    def handle(self, *args, **options):
+        deleted = prune_orphans(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} unused message content(s)'))
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp.querycheck import summarize
+
+
+class Command(BaseCommand):
+    help = 'Summarize a duplicate/N+1/slow query report written with MAIL_QUERY_REPORT, worst problems first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=None,
+                            help='Report file (default: MAIL_QUERY_REPORT)')
+        parser.add_argument('--top', type=int, default=20,
+                            help='Problems to show (default: 20)')
+        parser.add_argument('--fail-on-findings', action='store_true',
+                            help='Exit with an error if the report has any findings, e.g. after a CI test run')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.MAIL_QUERY_REPORT
+        if not path:
+            raise CommandError('No report given and MAIL_QUERY_REPORT is not set')
+        try:
+            with open(path) as report:
+                totals = summarize(report)
+        except FileNotFoundError:
+            raise CommandError(f'No report at {path}')
+
+        if not totals:
+            self.stdout.write(self.style.SUCCESS('No duplicate, repeated or slow queries recorded'))
+            return
+        for total in totals[:options['top']]:
+            self.stdout.write(
+                f"{total['kind']:<9}  {total['requests']:>5} request(s)  {total['occurrences']:>6} time(s)  "
+                f"{total['origin'] or 'outside mailapp'}  [{', '.join(sorted(total['views']))}]"
+            )
+            self.stdout.write(f"    {total['sql'][:300]}")
+        if options['fail_on_findings']:
+            raise CommandError(f'{len(totals)} query problem(s) found')
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from mailapp.models import Mail, Draft
+from mailapp.search import CONTENT_TABLE, build_mail_document, build_draft_document, sqlite_has_fts5
+
+
+class Command(BaseCommand):
+    help = 'Recompute the full-text search documents for mail and drafts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Rows updated per transaction (default: 1000)')
+        parser.add_argument('--model', choices=['mail', 'draft', 'all'], default='all')
+        parser.add_argument('--start-id', type=int, default=0,
+                            help='Resume a previous run from this primary key')
+
+    def handle(self, *args, **options):
+        targets = []
+        if options['model'] in ('mail', 'all'):
+            targets.append((Mail, ['sender', 'recipient'], build_mail_document))
+        if options['model'] in ('draft', 'all'):
+            targets.append((Draft, ['recipient'], build_draft_document))
+
+        for model, related, build in targets:
+            total = self.backfill(model, related, build, options['chunk_size'], options['start_id'])
+            self.stdout.write(self.style.SUCCESS(f'Indexed {total} {model._meta.verbose_name_plural}'))
+
+        connection = connections['default']
+        if connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+            # Rebuild the FTS tables from their content tables in case they drifted
+            with connection.cursor() as cursor:
+                for table in [model._meta.db_table for model, _, _ in targets] + [CONTENT_TABLE]:
+                    fts = f'{table}_fts'
+                    cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    def backfill(self, model, related, build, chunk_size, start_id):
+        total = 0
+        last_id = start_id
+        while True:
+            # Walk the primary key so each chunk is an index range scan
+            chunk = list(
+                model.objects.filter(id__gt=last_id).select_related(*related).order_by('id')[:chunk_size]
+            )
+            if not chunk:
+                return total
+            changed = []
+            for obj in chunk:
+                document = build(obj)
+                if obj.search_document != document:
+                    obj.search_document = document
+                    changed.append(obj)
+            with transaction.atomic():
+                model.objects.bulk_update(changed, ['search_document'])
+            total += len(chunk)
+            last_id = chunk[-1].id
+            self.stdout.write(f'{model.__name__}: {total} rows processed (last id {last_id})')
@@ -0,0 +1,21 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from mailapp.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-user mailbox counters from the mail table and fix any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only reconcile this username')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User '{options['user']}' does not exist")
+        fixed = reconcile(user)
+        self.stdout.write(self.style.SUCCESS(f'Reconciled mailbox counters ({fixed} corrected)'))
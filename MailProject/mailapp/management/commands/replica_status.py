@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+
+from mailapp.replicas import replica_lag
+
+
+class Command(BaseCommand):
+    help = 'Check how far behind the primary each read replica in DATABASE_REPLICA_URLS is, and whether views would use it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-if-unusable', action='store_true',
+                            help='Exit with an error if any replica is unreachable or too far behind, e.g. in a health check')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            self.stdout.write('No replicas configured; every query goes to the primary')
+            return
+
+        unusable = 0
+        for alias in settings.DATABASE_REPLICAS:
+            database = connections.settings[alias]
+            where = f"{database['ENGINE'].rsplit('.', 1)[-1]} {database.get('HOST') or database['NAME']}"
+            try:
+                lag = replica_lag(alias)
+            except DatabaseError as exc:
+                unusable += 1
+                self.stdout.write(self.style.ERROR(f'{alias:<10}  {where}  unreachable: {exc}'))
+                continue
+            if lag is None:
+                unusable += 1
+                self.stdout.write(self.style.ERROR(f'{alias:<10}  {where}  lag unknown, nothing replayed yet'))
+            elif lag > settings.MAIL_REPLICA_MAX_LAG:
+                unusable += 1
+                self.stdout.write(self.style.WARNING(
+                    f'{alias:<10}  {where}  {lag:.1f} s behind, over MAIL_REPLICA_MAX_LAG ({settings.MAIL_REPLICA_MAX_LAG:g} s)'
+                ))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{alias:<10}  {where}  {lag:.1f} s behind, in use'))
+        if unusable and options['fail_if_unusable']:
+            raise CommandError(f'{unusable} replica(s) not usable')
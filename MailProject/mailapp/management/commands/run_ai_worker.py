@@ -0,0 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management.base import BaseCommand
+
+from mailapp.ai import claim_jobs, requeue_stale_jobs, run_job
+from mailapp.models import AIDraftJob
+
+
+class Command(BaseCommand):
+    help = 'Process queued AI draft jobs with a bounded pool of worker threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Maximum model calls in flight at once (default: 4)')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty (default: 1)')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue and exit instead of running forever')
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale job(s)')
+
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ai-worker') as pool:
+            while True:
+                free = concurrency - len(in_flight)
+                jobs = claim_jobs(free) if free else []
+                for job in jobs:
+                    in_flight.add(pool.submit(run_job, job))
+
+                if not in_flight:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, in_flight = wait(in_flight, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                in_flight = set(in_flight)
+                deferred = False
+                for future in done:
+                    job = future.result()
+                    self.stdout.write(f'Job {job.id}: {job.status}')
+                    deferred = deferred or job.status == AIDraftJob.STATUS_PENDING
+                if deferred:
+                    # Model calls are at the global cap; back off before claiming again
+                    time.sleep(options['poll_interval'])
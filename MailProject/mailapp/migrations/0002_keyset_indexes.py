@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='draft',
+            index=models.Index(fields=['author', '-updated_at', '-id'], name='draft_author_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['recipient', '-sent_at', '-id'], name='mail_recipient_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['sender', '-sent_at', '-id'], name='mail_sender_sent_idx'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+SEARCH_TABLES = ['mailapp_mail', 'mailapp_draft']
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def create_search_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for table in SEARCH_TABLES:
+            schema_editor.execute(
+                f"CREATE INDEX {table}_search_gin ON {table} "
+                f"USING gin (to_tsvector('english', search_document))"
+            )
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        for table in SEARCH_TABLES:
+            fts = f'{table}_fts'
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5(search_document, content='{table}', "
+                f"content_rowid='id', tokenize='porter unicode61')"
+            )
+            schema_editor.execute(
+                f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {fts}(rowid, search_document) VALUES (new.id, new.search_document); END"
+            )
+            schema_editor.execute(
+                f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, search_document) VALUES ('delete', old.id, old.search_document); END"
+            )
+            schema_editor.execute(
+                f"CREATE TRIGGER {fts}_update AFTER UPDATE OF search_document ON {table} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, search_document) VALUES ('delete', old.id, old.search_document); "
+                f"INSERT INTO {fts}(rowid, search_document) VALUES (new.id, new.search_document); END"
+            )
+
+
+def drop_search_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for table in SEARCH_TABLES:
+            schema_editor.execute(f'DROP INDEX IF EXISTS {table}_search_gin')
+    elif connection.vendor == 'sqlite':
+        for table in SEARCH_TABLES:
+            fts = f'{table}_fts'
+            for suffix in ('insert', 'delete', 'update'):
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {fts}_{suffix}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {fts}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0002_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='draft',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='mail',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        # Existing rows are indexed by `manage.py rebuild_search_index`
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
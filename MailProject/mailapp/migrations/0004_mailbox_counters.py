@@ -0,0 +1,57 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_counters(apps, schema_editor):
+    Mail = apps.get_model('mailapp', 'Mail')
+    MailboxCounter = apps.get_model('mailapp', 'MailboxCounter')
+    rows = Mail.objects.order_by().values('recipient_id', 'project_id').annotate(
+        total=models.Count('id'),
+        unread=models.Count('id', filter=models.Q(is_read=False)),
+    )
+    MailboxCounter.objects.bulk_create(
+        [MailboxCounter(user_id=row['recipient_id'], project_id=row['project_id'],
+                        total=row['total'], unread=row['unread']) for row in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailapp', '0003_search_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('unread', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['recipient', 'project'], name='mail_unread_idx'),
+        ),
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_counters', to='mailapp.project'),
+        ),
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_counters', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='mailboxcounter',
+            constraint=models.UniqueConstraint(fields=('user', 'project'), name='unique_mailbox_counter'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
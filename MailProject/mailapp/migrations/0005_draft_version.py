@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0004_mailbox_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='draft',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='draft',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
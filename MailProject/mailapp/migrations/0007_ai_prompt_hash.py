@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0006_ai_draft_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aidraftjob',
+            name='prompt_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+CONTENT_TABLE = 'mailapp_messagecontent'
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def create_content_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    table, fts = CONTENT_TABLE, f'{CONTENT_TABLE}_fts'
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE INDEX {table}_search_gin ON {table} USING gin (to_tsvector('english', body))"
+        )
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {fts} USING fts5(body, content='{table}', "
+            f"content_rowid='id', tokenize='porter unicode61')"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, body) VALUES ('delete', old.id, old.body); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_update AFTER UPDATE OF body ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, body) VALUES ('delete', old.id, old.body); "
+            f"INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END"
+        )
+
+
+def drop_content_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    table, fts = CONTENT_TABLE, f'{CONTENT_TABLE}_fts'
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {table}_search_gin')
+    elif connection.vendor == 'sqlite':
+        for suffix in ('insert', 'delete', 'update'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {fts}_{suffix}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {fts}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0007_ai_prompt_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageContent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('subject', models.CharField(blank=True, max_length=200)),
+                ('body', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='mail',
+            name='content',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='mails', to='mailapp.messagecontent'),
+        ),
+        migrations.AddField(
+            model_name='mail',
+            name='preview',
+            field=models.CharField(blank=True, default='', editable=False, max_length=160),
+        ),
+        migrations.AddField(
+            model_name='draft',
+            name='content',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='drafts', to='mailapp.messagecontent'),
+        ),
+        migrations.AddField(
+            model_name='draft',
+            name='preview',
+            field=models.CharField(blank=True, default='', editable=False, max_length=160),
+        ),
+        migrations.RunPython(create_content_search_index, drop_content_search_index),
+    ]
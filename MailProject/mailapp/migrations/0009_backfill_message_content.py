@@ -0,0 +1,86 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:20
+
+import hashlib
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+PREVIEW_LENGTH = 160
+
+
+def message_hash(subject, body):
+    return hashlib.sha256(f'{subject}\x1f{body}'.encode()).hexdigest()
+
+
+def user_names(user):
+    if user is None:
+        return []
+    return [user.username, user.first_name, user.last_name]
+
+
+def backfill_model(apps, model_name, related, people):
+    Model = apps.get_model('mailapp', model_name)
+    MessageContent = apps.get_model('mailapp', 'MessageContent')
+    last_id = 0
+    while True:
+        # One transaction per batch, so a large table never holds one long lock
+        with transaction.atomic():
+            rows = list(
+                Model.objects.filter(id__gt=last_id).select_related(*related).order_by('id')[:BATCH_SIZE]
+            )
+            if not rows:
+                return
+            texts = {message_hash(row.subject, row.body): (row.subject, row.body) for row in rows}
+            known = dict(MessageContent.objects.filter(content_hash__in=texts).values_list('content_hash', 'id'))
+            MessageContent.objects.bulk_create(
+                [
+                    MessageContent(content_hash=content_hash, subject=subject, body=body)
+                    for content_hash, (subject, body) in texts.items() if content_hash not in known
+                ],
+                ignore_conflicts=True,
+            )
+            known = dict(MessageContent.objects.filter(content_hash__in=texts).values_list('content_hash', 'id'))
+            for row in rows:
+                row.content_id = known[message_hash(row.subject, row.body)]
+                row.preview = row.body[:PREVIEW_LENGTH]
+                # Bodies are now indexed once per content row, not per mail
+                parts = [row.subject] + [name for person in people(row) for name in user_names(person)]
+                row.search_document = ' '.join(part for part in parts if part)
+            Model.objects.bulk_update(rows, ['content', 'preview', 'search_document'])
+            last_id = rows[-1].id
+
+
+def backfill_contents(apps, schema_editor):
+    backfill_model(apps, 'Mail', ['sender', 'recipient'], lambda mail: [mail.sender, mail.recipient])
+    backfill_model(apps, 'Draft', ['recipient'], lambda draft: [draft.recipient])
+
+
+def restore_bodies(apps, schema_editor):
+    for model_name in ('Mail', 'Draft'):
+        Model = apps.get_model('mailapp', model_name)
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    Model.objects.filter(id__gt=last_id, content__isnull=False)
+                    .select_related('content').order_by('id')[:BATCH_SIZE]
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    row.body = row.content.body
+                Model.objects.bulk_update(rows, ['body'])
+                last_id = rows[-1].id
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own; rerunning picks up where a failed run stopped
+    atomic = False
+
+    dependencies = [
+        ('mailapp', '0008_message_content'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_contents, restore_bodies),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0009_backfill_message_content'),
+    ]
+
+    operations = [
+        # Give the columns a default first so unapplying can re-add them to existing rows
+        migrations.AlterField(
+            model_name='draft',
+            name='body',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AlterField(
+            model_name='mail',
+            name='body',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='draft',
+            name='body',
+        ),
+        migrations.RemoveField(
+            model_name='mail',
+            name='body',
+        ),
+        migrations.AlterField(
+            model_name='draft',
+            name='content',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='drafts', to='mailapp.messagecontent'),
+        ),
+        migrations.AlterField(
+            model_name='mail',
+            name='content',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='mails', to='mailapp.messagecontent'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def backfill_threads(apps, schema_editor):
+    Mail = apps.get_model('mailapp', 'Mail')
+    Thread = apps.get_model('mailapp', 'Thread')
+    while True:
+        # One transaction per batch; rows that already have a thread are skipped on a rerun
+        with transaction.atomic():
+            mails = list(
+                Mail.objects.filter(thread__isnull=True).only('id', 'project_id', 'subject', 'sent_at')
+                .order_by('id')[:BATCH_SIZE]
+            )
+            if not mails:
+                return
+            # Mail sent before threading existed has no reply links, so each one starts its own thread
+            threads = Thread.objects.bulk_create(
+                [Thread(project_id=mail.project_id, subject=mail.subject) for mail in mails]
+            )
+            for mail, thread in zip(mails, threads):
+                thread.created_at = mail.sent_at
+                mail.thread_id = thread.id
+            Thread.objects.bulk_update(threads, ['created_at'])
+            Mail.objects.bulk_update(mails, ['thread'])
+
+
+def clear_threads(apps, schema_editor):
+    # Detach first: deleting a thread cascades to its mail
+    apps.get_model('mailapp', 'Mail').objects.update(thread=None)
+    apps.get_model('mailapp', 'Thread').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('mailapp', '0011_mail_threads'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_threads, clear_threads),
+    ]
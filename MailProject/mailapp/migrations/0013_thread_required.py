@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0012_backfill_mail_threads'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mail',
+            name='thread',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='mails', to='mailapp.thread'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['thread', 'sent_at', 'id'], name='mail_thread_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['recipient', 'thread', 'sent_at', 'is_read'], name='mail_recipient_thread_idx'),
+        ),
+    ]
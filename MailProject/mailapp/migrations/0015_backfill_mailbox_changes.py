@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:10
+
+from django.db import migrations, transaction
+from django.db.models import Max
+
+BATCH_SIZE = 1000
+
+
+def log_existing(apps, model_name, kind, owners):
+    Model = apps.get_model('mailapp', model_name)
+    MailboxChange = apps.get_model('mailapp', 'MailboxChange')
+    # Resume after the last object a previous, interrupted run logged
+    last_id = MailboxChange.objects.filter(kind=kind).aggregate(last=Max('object_id'))['last'] or 0
+    while True:
+        with transaction.atomic():
+            rows = list(Model.objects.filter(id__gt=last_id).order_by('id').values(*(['id'] + owners))[:BATCH_SIZE])
+            if not rows:
+                return
+            MailboxChange.objects.bulk_create([
+                MailboxChange(user_id=row[owner], kind=kind, object_id=row['id'], action='upsert')
+                for row in rows for owner in owners
+            ])
+            last_id = rows[-1]['id']
+
+
+def backfill_changes(apps, schema_editor):
+    # Existing mail and drafts become the first entries, so syncing from cursor 0 loads everything
+    log_existing(apps, 'Mail', 'mail', ['recipient_id', 'sender_id'])
+    log_existing(apps, 'Draft', 'draft', ['author_id'])
+
+
+def clear_changes(apps, schema_editor):
+    apps.get_model('mailapp', 'MailboxChange').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('mailapp', '0014_mailbox_change_log'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_changes, clear_changes),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import mailapp.models
+
+ARCHIVE_TABLE = 'mailapp_archivedmail'
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def create_archive_search_index(apps, schema_editor):
+    # Same index as the hot table's, so "include archive" searches stay indexed
+    connection = schema_editor.connection
+    table, fts = ARCHIVE_TABLE, f'{ARCHIVE_TABLE}_fts'
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f"CREATE INDEX {table}_search_gin ON {table} "
+            f"USING gin (to_tsvector('english', search_document))"
+        )
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {fts} USING fts5(search_document, content='{table}', "
+            f"content_rowid='id', tokenize='porter unicode61')"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, search_document) VALUES (new.id, new.search_document); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, search_document) VALUES ('delete', old.id, old.search_document); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_update AFTER UPDATE OF search_document ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, search_document) VALUES ('delete', old.id, old.search_document); "
+            f"INSERT INTO {fts}(rowid, search_document) VALUES (new.id, new.search_document); END"
+        )
+
+
+def drop_archive_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    table, fts = ARCHIVE_TABLE, f'{ARCHIVE_TABLE}_fts'
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {table}_search_gin')
+    elif connection.vendor == 'sqlite':
+        for suffix in ('insert', 'delete', 'update'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {fts}_{suffix}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {fts}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailapp', '0015_backfill_mailbox_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cutoff', models.DateTimeField()),
+                ('last_id', models.PositiveBigIntegerField(default=0)),
+                ('moved', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedMail',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('subject', models.CharField(max_length=200)),
+                ('preview', models.CharField(blank=True, default='', editable=False, max_length=160)),
+                ('in_reply_to_id', models.BigIntegerField(blank=True, null=True)),
+                ('sent_at', models.DateTimeField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('search_document', models.TextField(blank=True, default='', editable=False)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('content', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='archived_mails', to='mailapp.messagecontent')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_mails', to='mailapp.project')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_received_mails', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_sent_mails', to=settings.AUTH_USER_MODEL)),
+                ('thread', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_mails', to='mailapp.thread')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['recipient', '-sent_at', '-id'], name='archivedmail_recipient_idx'), models.Index(fields=['sender', '-sent_at', '-id'], name='archivedmail_sender_idx')],
+            },
+            bases=(mailapp.models.ContentBodyMixin, models.Model),
+        ),
+        migrations.RunPython(create_archive_search_index, drop_archive_search_index),
+    ]
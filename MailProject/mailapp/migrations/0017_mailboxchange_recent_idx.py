@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0016_mail_archive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mailboxchange',
+            index=models.Index(fields=['user', 'created_at'], name='mailboxchange_recent_idx'),
+        ),
+    ]
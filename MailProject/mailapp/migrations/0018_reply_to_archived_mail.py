@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailapp', '0017_mailboxchange_recent_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='draft',
+            name='in_reply_to_archived_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='mail',
+            name='in_reply_to_archived_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
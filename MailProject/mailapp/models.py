@@ -2,6 +2,10 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+# Characters of body loaded for list-view previews; longer than any template
+# truncates to, so truncatechars still knows when to add an ellipsis
+PREVIEW_LENGTH = 160
+
 class Project(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
@@ -21,32 +25,259 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s profile"
 
-class Mail(models.Model):
+class MessageContent(models.Model):
+    """
+    A subject and body stored once, however many mails and drafts use it.
+    Rows are immutable and addressed by ``content_hash``, see mailapp.content.
+    """
+    content_hash = models.CharField(max_length=64, unique=True)
+    subject = models.CharField(max_length=200, blank=True)
+    body = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.content_hash[:12]}: {self.subject or 'No subject'}"
+
+class Thread(models.Model):
+    """A conversation: a message and every reply or forward that follows from it"""
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='threads')
+    subject = models.CharField(max_length=200)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return self.subject
+
+class ContentBodyMixin:
+    """
+    ``body`` reads through to the shared MessageContent. Assigning it (or
+    passing ``body=`` to the constructor) is picked up on the next full
+    save, which points the row at the matching content.
+    """
+    _body = None
+    
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self.content.body if self.content_id else ''
+        return self._body
+    
+    @body.setter
+    def body(self, value):
+        self._body = value
+    
+    def refresh_from_db(self, *args, **kwargs):
+        self._body = None
+        super().refresh_from_db(*args, **kwargs)
+
+class MailQuerySet(models.QuerySet):
+    def for_list(self):
+        """Projection for mailbox listings: related rows joined, stored preview instead of the body"""
+        return self.select_related('sender', 'recipient', 'project').only(
+            'id', 'subject', 'preview', 'sent_at', 'is_read',
+            'sender', 'sender__username', 'sender__first_name', 'sender__last_name',
+            'recipient', 'recipient__username', 'recipient__first_name', 'recipient__last_name',
+            'project', 'project__name', 'thread',
+        )
+
+class Mail(ContentBodyMixin, models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_mails')
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_mails')
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='mails')
     subject = models.CharField(max_length=200)
-    body = models.TextField()
+    # Shared subject and body; a broadcast stores one body for all its recipients
+    content = models.ForeignKey(MessageContent, on_delete=models.PROTECT, related_name='mails', editable=False)
+    # First characters of the body, so listings never read the content table
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='', editable=False)
+    # Set from in_reply_to, or a new thread for a new conversation, see mailapp.threads
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='mails', editable=False)
+    in_reply_to = models.ForeignKey('self', on_delete=models.SET_NULL, related_name='replies', null=True, blank=True)
+    # in_reply_to once the mail answered has been archived, see mailapp.archive
+    in_reply_to_archived_id = models.BigIntegerField(null=True, blank=True, editable=False)
     sent_at = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    # Denormalized text for full-text search, see mailapp.search
+    search_document = models.TextField(blank=True, default='', editable=False)
+    
+    objects = MailQuerySet.as_manager()
     
     def __str__(self):
         return f"From {self.sender.username} to {self.recipient.username}: {self.subject}"
     
     class Meta:
         ordering = ['-sent_at']
+        indexes = [
+            # Keyset pagination keys for the inbox and sent listings
+            models.Index(fields=['recipient', '-sent_at', '-id'], name='mail_recipient_sent_idx'),
+            models.Index(fields=['sender', '-sent_at', '-id'], name='mail_sender_sent_idx'),
+            # Only unread rows, for counter reconciliation and unread filters
+            models.Index(fields=['recipient', 'project'], condition=models.Q(is_read=False), name='mail_unread_idx'),
+            # A whole conversation in order is one range scan
+            models.Index(fields=['thread', 'sent_at', 'id'], name='mail_thread_sent_idx'),
+            # Threaded inbox: group a recipient's mail by thread without touching the table
+            models.Index(fields=['recipient', 'thread', 'sent_at', 'is_read'], name='mail_recipient_thread_idx'),
+        ]
 
-class Draft(models.Model):
+class ArchivedMail(ContentBodyMixin, models.Model):
+    """
+    Mail moved out of the hot table by ``manage.py archive_mail``, see
+    mailapp.archive. Rows keep the id, timestamps and read state they had
+    as Mail and are never changed afterwards.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_sent_mails')
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_received_mails')
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='archived_mails')
+    subject = models.CharField(max_length=200)
+    content = models.ForeignKey(MessageContent, on_delete=models.PROTECT, related_name='archived_mails', editable=False)
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='', editable=False)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='archived_mails', editable=False)
+    # The mail this answered, which may itself be archived or gone
+    in_reply_to_id = models.BigIntegerField(null=True, blank=True)
+    sent_at = models.DateTimeField()
+    is_read = models.BooleanField(default=False)
+    search_document = models.TextField(blank=True, default='', editable=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = MailQuerySet.as_manager()
+    
+    def __str__(self):
+        return f"From {self.sender.username} to {self.recipient.username}: {self.subject} (archived)"
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['recipient', '-sent_at', '-id'], name='archivedmail_recipient_idx'),
+            models.Index(fields=['sender', '-sent_at', '-id'], name='archivedmail_sender_idx'),
+        ]
+
+class ArchiveRun(models.Model):
+    """Progress of one archival pass, so an interrupted run resumes where it stopped"""
+    cutoff = models.DateTimeField()
+    # Highest Mail id this run has looked at; everything at or below it is done
+    last_id = models.PositiveBigIntegerField(default=0)
+    moved = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Archive of mail before {self.cutoff:%Y-%m-%d} ({self.moved} moved)"
+
+class DraftQuerySet(models.QuerySet):
+    def for_list(self):
+        """Projection for the drafts listing"""
+        return self.select_related('project', 'recipient').only(
+            'id', 'subject', 'preview', 'created_at', 'updated_at', 'author',
+            'project', 'project__name',
+            'recipient', 'recipient__username', 'recipient__first_name', 'recipient__last_name',
+        )
+
+class Draft(ContentBodyMixin, models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='drafts')
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='drafts')
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='draft_recipients', null=True, blank=True)
     subject = models.CharField(max_length=200, blank=True)
-    body = models.TextField(blank=True)
+    content = models.ForeignKey(MessageContent, on_delete=models.PROTECT, related_name='drafts', editable=False)
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='', editable=False)
+    # A reply saved as a draft keeps its place in the conversation
+    in_reply_to = models.ForeignKey(Mail, on_delete=models.SET_NULL, related_name='reply_drafts', null=True, blank=True)
+    in_reply_to_archived_id = models.BigIntegerField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    search_document = models.TextField(blank=True, default='', editable=False)
+    # Bumped whenever the content changes; autosave uses it as the ETag
+    version = models.PositiveIntegerField(default=1, editable=False)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+    
+    objects = DraftQuerySet.as_manager()
     
     def __str__(self):
         return f"Draft by {self.author.username}: {self.subject or 'No subject'}"
     
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['author', '-updated_at', '-id'], name='draft_author_updated_idx'),
+        ]
+
+class MailboxCounter(models.Model):
+    """Per-user, per-project inbox totals, maintained by mailapp.counters"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mailbox_counters')
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='mailbox_counters')
+    total = models.PositiveIntegerField(default=0)
+    unread = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.user.username} / {self.project.name}: {self.unread}/{self.total} unread"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'project'], name='unique_mailbox_counter'),
+        ]
+
+class AIDraftJob(models.Model):
+    """A queued AI draft generation request, processed by `manage.py run_ai_worker`"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ai_draft_jobs')
+    prompt = models.TextField()
+    # Hash of the normalized prompt, used to dedupe repeated submissions
+    prompt_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    subject = models.CharField(max_length=200, blank=True)
+    body = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"AI draft job {self.id} for {self.user.username} ({self.status})"
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            # The worker drains the oldest pending jobs first
+            models.Index(fields=['status', 'created_at'], name='aidraftjob_queue_idx'),
+        ]
+
+class MailboxChange(models.Model):
+    """One entry in a user's mailbox change log, written by mailapp.changelog; the id is the sync cursor"""
+    KIND_MAIL = 'mail'
+    KIND_DRAFT = 'draft'
+    KIND_CHOICES = [
+        (KIND_MAIL, 'Mail'),
+        (KIND_DRAFT, 'Draft'),
+    ]
+    ACTION_UPSERT = 'upsert'
+    ACTION_DELETE = 'delete'
+    ACTION_CHOICES = [
+        (ACTION_UPSERT, 'Created or updated'),
+        (ACTION_DELETE, 'Deleted'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mailbox_changes')
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.user_id}: {self.kind} {self.object_id} {self.action}"
+    
+    class Meta:
+        indexes = [
+            # "Changes after cursor N for this user" is one range scan
+            models.Index(fields=['user', 'id'], name='mailboxchange_cursor_idx'),
+            # Each sync re-reads the user's last few seconds of entries
+            models.Index(fields=['user', 'created_at'], name='mailboxchange_recent_idx'),
+            # Compaction finds superseded entries for the same object
+            models.Index(fields=['user', 'kind', 'object_id', 'id'], name='mailboxchange_object_idx'),
+        ]
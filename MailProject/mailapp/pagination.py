@@ -0,0 +1,210 @@
+"""
+Keyset (cursor) pagination for the mailbox list views.
+
+Offset pagination costs a full COUNT(*) plus an OFFSET scan that grows with
+the page depth. Keyset pagination instead remembers the sort key of the last
+row on a page and asks for the rows strictly after it, so every page is a
+bounded index range scan no matter how deep the user goes.
+"""
+import base64
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+
+# Above this many rows the header count is estimated instead of counted
+APPROXIMATE_COUNT_THRESHOLD = 1000
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder drops microseconds, which would make keys collide
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values, direction):
+    payload = json.dumps({'k': values, 'd': direction}, cls=CursorEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        values, direction = payload['k'], payload['d']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor(token)
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise InvalidCursor(token)
+    return values, direction
+
+
+def keyset_after(fields, key, descending):
+    """Build (a, b) < (x, y) as a Q, since the ORM has no row comparison"""
+    condition = Q()
+    for index in range(len(fields) - 1, -1, -1):
+        lookup = 'lt' if descending[index] else 'gt'
+        step = Q(**{f'{fields[index]}__{lookup}': key[index]})
+        if index < len(fields) - 1:
+            step |= Q(**{fields[index]: key[index]}) & condition
+        condition = step
+    return condition
+
+
+def keyset_rows(queryset, ordering, chunk_size):
+    """
+    Every row of a values() ``queryset`` in ``ordering`` (ascending field
+    names, the last one unique), fetched ``chunk_size`` rows per query.
+    Unlike ``iterator()``, this needs no server-side cursor, which would
+    not survive transaction pooling.
+    """
+    queryset = queryset.order_by(*ordering)
+    descending = [False] * len(ordering)
+    key = None
+    while True:
+        page = queryset if key is None else queryset.filter(keyset_after(ordering, key, descending))
+        rows = list(page[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        key = [rows[-1][name] for name in ordering]
+
+
+class KeysetPage:
+    """One page of results, exposing the bits of the Page API our templates use"""
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+
+class KeysetPaginator:
+    """
+    Paginate ``queryset`` on ``ordering``, a tuple of order_by() field names
+    such as ('-sent_at', '-id'). The last field must be unique so the key is
+    a total order.
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-sent_at', '-id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = [name.lstrip('-') for name in ordering]
+        self.ordering = list(ordering)
+        self.reverse_ordering = [name[1:] if name.startswith('-') else f'-{name}' for name in ordering]
+
+    def _key(self, obj):
+        return [getattr(obj, name) for name in self.fields]
+
+    def _parse_key(self, values):
+        if len(values) != len(self.fields):
+            raise InvalidCursor(values)
+        try:
+            return [self._field(name).to_python(value) for name, value in zip(self.fields, values)]
+        except Exception:
+            raise InvalidCursor(values)
+
+    def _field(self, name):
+        # Keys may be annotations, such as search_rank on search results
+        annotation = self.queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return self.queryset.model._meta.get_field(name)
+
+    def _after(self, key, descending):
+        return keyset_after(self.fields, key, descending)
+
+    def get_page(self, cursor=None):
+        direction = 'next'
+        key = None
+        if cursor:
+            try:
+                values, direction = decode_cursor(cursor)
+                key = self._parse_key(values)
+            except InvalidCursor:
+                direction, key = 'next', None
+
+        descending = [name.startswith('-') for name in self.ordering]
+        if direction == 'prev':
+            queryset = self.queryset.order_by(*self.reverse_ordering)
+            if key is not None:
+                queryset = queryset.filter(self._after(key, [not d for d in descending]))
+        else:
+            queryset = self.queryset.order_by(*self.ordering)
+            if key is not None:
+                queryset = queryset.filter(self._after(key, descending))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if direction == 'prev':
+            rows.reverse()
+            has_next, has_previous = key is not None, has_more
+        else:
+            has_next, has_previous = has_more, key is not None
+
+        next_cursor = encode_cursor(self._key(rows[-1]), 'next') if rows and has_next else None
+        previous_cursor = encode_cursor(self._key(rows[0]), 'prev') if rows and has_previous else None
+        return KeysetPage(rows, has_next, has_previous, next_cursor, previous_cursor)
+
+
+class ApproximateCount:
+    def __init__(self, value, is_estimate=False):
+        self.value = value
+        self.is_estimate = is_estimate
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return f'~{self.value}' if self.is_estimate else str(self.value)
+
+
+def _planner_estimate(queryset):
+    """Ask the Postgres planner for its row estimate instead of counting"""
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def approximate_count(queryset, threshold=APPROXIMATE_COUNT_THRESHOLD):
+    """
+    Count exactly while the result is small, and fall back to the planner's
+    estimate once it is large enough that an exact COUNT(*) would be costly.
+    The bounded count stops after ``threshold + 1`` rows.
+    """
+    queryset = queryset.order_by().values('pk')
+    bounded = queryset[:threshold + 1].count()
+    if bounded <= threshold:
+        return ApproximateCount(bounded)
+    if connections[queryset.db].vendor == 'postgresql':
+        try:
+            return ApproximateCount(max(_planner_estimate(queryset), bounded), is_estimate=True)
+        except Exception:
+            pass
+    return ApproximateCount(queryset.count())
@@ -0,0 +1,58 @@
+"""
+PostgreSQL backend whose connections come from a ``mailapp.dbpool.ConnectionPool``.
+
+Configured by ``DATABASE_POOL_MODE = 'pool'``: ENGINE ``mailapp.postgresql_pool``
+with a ``POOL`` dict of MIN_SIZE, MAX_SIZE and TIMEOUT in the database settings.
+Everything but opening and closing is the stock backend.
+"""
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from mailapp.dbpool import POOL_MAX_SIZE, POOL_MIN_SIZE, POOL_TIMEOUT, ConnectionPool, get_pool
+
+if base.is_psycopg3:
+    TRANSACTION_IDLE = base.Database.pq.TransactionStatus.IDLE
+else:
+    TRANSACTION_IDLE = base.Database.extensions.TRANSACTION_STATUS_IDLE
+
+
+def _reset(connection):
+    # Whatever the last user left open is rolled back, so no transaction outlives its request
+    if connection.closed:
+        raise ConnectionError('connection closed')
+    if connection.info.transaction_status != TRANSACTION_IDLE:
+        connection.rollback()
+
+
+def _check(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _pool(self, conn_params=None):
+        def create():
+            options = self.settings_dict.get('POOL') or {}
+            stock = super(DatabaseWrapper, self).get_new_connection
+            return ConnectionPool(
+                lambda: stock(dict(conn_params)), reset=_reset, check=_check,
+                min_size=options.get('MIN_SIZE', POOL_MIN_SIZE),
+                max_size=options.get('MAX_SIZE', POOL_MAX_SIZE),
+                timeout=options.get('TIMEOUT', POOL_TIMEOUT),
+            )
+        return get_pool(self.alias, create if conn_params is not None else None)
+
+    def get_new_connection(self, conn_params):
+        connection = self._pool(conn_params).acquire()
+        # The stock backend records this while connecting, and this wrapper may not have opened the connection
+        self.isolation_level = IsolationLevel(
+            self.settings_dict['OPTIONS'].get('isolation_level', IsolationLevel.READ_COMMITTED)
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # Back to the pool rather than closed; a connection that saw errors and no longer works is dropped
+                broken = self.errors_occurred and not self.is_usable()
+                self._pool().release(self.connection, discard=broken)
@@ -0,0 +1,50 @@
+"""
+User profiles and their projects.
+
+Every user has a UserProfile, created along with the user (see signals),
+and is put in a project of their own if they don't join one.
+``provision_user`` makes sure of both. Registration and login call it, so
+no page has to, and GETs stay free of writes. It only writes when something
+is missing, so running it again changes nothing.
+
+Views read the profile through ``request_profile``. It loads the profile
+and its projects once per request and attaches them to ``request.user``,
+so the view, its forms and the base.html sidebar share the same rows.
+"""
+from django.db import IntegrityError, transaction
+
+from .models import Project, UserProfile
+
+
+def provision_user(user):
+    """Give ``user`` a profile and, unless they belong to a project, a default project; returns the profile"""
+    profile, _ = UserProfile.objects.get_or_create(user=user)
+    if not profile.projects.exists():
+        try:
+            with transaction.atomic():
+                # A user who left their default project gets the same one back
+                project, _ = Project.objects.get_or_create(
+                    name=f"{user.username}'s Project", created_by=user,
+                    defaults={'description': 'Default project'},
+                )
+                profile.projects.add(project)
+        except IntegrityError:
+            # Someone else already owns a project by that name; the user can join or create one
+            pass
+    return profile
+
+
+def request_profile(request):
+    """The signed-in user's profile with its projects prefetched, loaded at most once per request"""
+    profile = getattr(request, '_mailapp_profile', None)
+    if profile is None:
+        profiles = UserProfile.objects.prefetch_related('projects')
+        try:
+            profile = profiles.get(user=request.user)
+        except UserProfile.DoesNotExist:
+            # Users from before profiles existed get theirs on first use
+            profile = profiles.get(pk=provision_user(request.user).pk)
+        profile.project_ids = {project.id for project in profile.projects.all()}
+        request.user.userprofile = profile
+        request._mailapp_profile = profile
+    return profile
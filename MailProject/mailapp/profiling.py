@@ -0,0 +1,370 @@
+"""
+Request profiling.
+
+``ProfilingMiddleware`` wraps every request and measures wall time, the
+number of queries, and the time spent in SQL, template rendering and model
+(AI) calls. The numbers go out in a ``Server-Timing`` header, so the
+browser's network panel shows where a slow inbox load went. They also feed
+per-view histograms that ``/api/ops/metrics/`` serves to staff in the
+Prometheus text format. A request slower than ``MAIL_SLOW_REQUEST_MS`` is
+logged with its slowest queries.
+
+Queries are timed by an execute wrapper that is added to every database
+connection when it opens. A context variable ties each query to its
+request, and it follows the request into sync_to_async threads. Templates
+are timed by the ``ProfiledDjangoTemplates`` backend, and code that calls
+the model wraps the call in ``timed('ai')``. A streamed response (an AI
+draft, an export) adds the time its body took to the view's totals when
+it ends; its Server-Timing only covers the time until the headers.
+Histograms are kept in process memory, like prometheus_client's default
+registry, so each worker process reports its own numbers.
+
+In development and staging, ``MAIL_QUERY_REPORT`` also turns on the
+duplicate and slow query report in ``querycheck``.
+"""
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from django.utils.decorators import sync_and_async_middleware
+
+from .querycheck import QueryInspector
+
+logger = logging.getLogger(__name__)
+
+TIMED_KINDS = ('sql', 'template', 'ai')
+# Slowest queries kept per request for the slow request log
+TOP_QUERIES = 5
+QUERY_LOG_LENGTH = 500
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_current = ContextVar('mailapp_request_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self, inspector=None):
+        self.inspector = inspector
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.seconds = dict.fromkeys(TIMED_KINDS, 0.0)
+        self._slowest = []
+        self._open = set()
+
+    def add_query(self, sql, duration):
+        self.queries += 1
+        self.seconds['sql'] += duration
+        # A min-heap, so the fastest of the kept queries is the one pushed out
+        entry = (duration, self.queries, sql)
+        if len(self._slowest) < TOP_QUERIES:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def top_queries(self):
+        """(seconds, sql) for the slowest queries, slowest first"""
+        return [(duration, sql) for duration, _, sql in sorted(self._slowest, reverse=True)]
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def current_profile():
+    """The profile of the request being handled, or None outside a request"""
+    return _current.get()
+
+
+@contextmanager
+def timed(kind):
+    """Add the time spent in the block to the current request's ``kind`` total; nested blocks count once"""
+    profile = _current.get()
+    if profile is None or kind in profile._open:
+        yield
+        return
+    profile._open.add(kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.seconds[kind] += time.perf_counter() - started
+        profile._open.discard(kind)
+
+
+def record_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        profile.add_query(sql, duration)
+        if profile.inspector is not None:
+            profile.inspector.add(context['connection'].alias, sql, params, duration)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver: time this connection's queries from now on"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class ProfiledTemplate(Template):
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return super().render(context, request)
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing each top-level render for the current request"""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return ProfiledTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {total}'
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.seconds = dict.fromkeys(TIMED_KINDS, 0.0)
+
+
+class Metrics:
+    """Per-view request histograms for this process"""
+
+    def __init__(self):
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def _view(self, view):
+        metrics = self._views.get(view)
+        if metrics is None:
+            metrics = self._views[view] = ViewMetrics()
+        return metrics
+
+    def observe(self, view, profile, elapsed):
+        with self._lock:
+            metrics = self._view(view)
+            metrics.duration.observe(elapsed)
+            metrics.queries.observe(profile.queries)
+            for kind, seconds in profile.seconds.items():
+                metrics.seconds[kind] += seconds
+
+    def add_seconds(self, view, seconds):
+        """Time a streamed response spent after it was observed, by kind"""
+        with self._lock:
+            metrics = self._view(view)
+            for kind, extra in seconds.items():
+                metrics.seconds[kind] += extra
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+    def render(self):
+        """The histograms in the Prometheus text exposition format"""
+        with self._lock:
+            views = sorted(self._views.items())
+            lines = [
+                '# HELP mailapp_request_duration_seconds Wall time of requests, by view.',
+                '# TYPE mailapp_request_duration_seconds histogram',
+            ]
+            for view, metrics in views:
+                lines.extend(metrics.duration.lines('mailapp_request_duration_seconds', _labels(view=view)))
+            lines += [
+                '# HELP mailapp_request_queries Database queries per request, by view.',
+                '# TYPE mailapp_request_queries histogram',
+            ]
+            for view, metrics in views:
+                lines.extend(metrics.queries.lines('mailapp_request_queries', _labels(view=view)))
+            lines += [
+                '# HELP mailapp_request_component_seconds_total Time requests spent in SQL, templates and AI calls, by view.',
+                '# TYPE mailapp_request_component_seconds_total counter',
+            ]
+            for view, metrics in views:
+                for kind, seconds in metrics.seconds.items():
+                    lines.append(f'mailapp_request_component_seconds_total{{{_labels(view=view, component=kind)}}} {seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def _labels(**labels):
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return ','.join(f'{name}="{value}"' for name, value in escaped)
+
+
+def render_counters(rate_limits, ai_cache):
+    """Rate limit and AI cache counters (see ``ops_counters``) in the Prometheus text format"""
+    lines = [
+        '# HELP mailapp_rate_limit_requests_total Requests allowed and refused by each rate limit.',
+        '# TYPE mailapp_rate_limit_requests_total counter',
+    ]
+    for name, counts in sorted(rate_limits.items()):
+        for outcome in ('allowed', 'limited'):
+            lines.append(f'mailapp_rate_limit_requests_total{{{_labels(limit=name, outcome=outcome)}}} {counts[outcome]}')
+    lines += [
+        '# HELP mailapp_ai_calls_active Model calls in flight across all processes.',
+        '# TYPE mailapp_ai_calls_active gauge',
+        f"mailapp_ai_calls_active {rate_limits.get('ai_calls', {}).get('active', 0)}",
+        '# HELP mailapp_ai_cache_requests_total AI draft cache hits, misses and coalesced calls.',
+        '# TYPE mailapp_ai_cache_requests_total counter',
+    ]
+    for outcome, count in ai_cache.items():
+        lines.append(f'mailapp_ai_cache_requests_total{{{_labels(outcome=outcome)}}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(profile, elapsed):
+    return ', '.join([
+        f'total;dur={elapsed * 1000:.1f}',
+        f'db;dur={profile.seconds["sql"] * 1000:.1f};desc="{profile.queries} queries"',
+        f'tpl;dur={profile.seconds["template"] * 1000:.1f}',
+        f'ai;dur={profile.seconds["ai"] * 1000:.1f}',
+    ])
+
+
+def view_name(request):
+    match = request.resolver_match
+    # Unmatched paths share one label, so stray URLs can't grow the histograms without bound
+    return match.view_name if match is not None else 'unmatched'
+
+
+def _start():
+    return RequestProfile(QueryInspector() if settings.MAIL_QUERY_REPORT else None)
+
+
+def _finish(request, response, profile):
+    elapsed = profile.elapsed()
+    view = view_name(request)
+    metrics.observe(view, profile, elapsed)
+    if settings.MAIL_SERVER_TIMING:
+        response['Server-Timing'] = server_timing(profile, elapsed)
+    if elapsed * 1000 >= settings.MAIL_SLOW_REQUEST_MS:
+        queries = ''.join(
+            f'\n  {duration * 1000:8.1f} ms  {sql[:QUERY_LOG_LENGTH]}' for duration, sql in profile.top_queries()
+        )
+        logger.warning(
+            'Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, templates %.0f ms, AI %.0f ms%s',
+            request.method, request.path, view, elapsed * 1000, profile.queries,
+            profile.seconds['sql'] * 1000, profile.seconds['template'] * 1000, profile.seconds['ai'] * 1000,
+            queries,
+        )
+
+
+def _follow_stream(request, response, profile):
+    """
+    Keep ``profile`` current while a streamed body is produced, and add the
+    SQL and AI time spent there to the view's totals once it ends. The
+    headers, Server-Timing included, have gone out before any of it.
+    """
+    view = view_name(request)
+    observed = dict(profile.seconds)
+
+    def finished():
+        metrics.add_seconds(view, {kind: profile.seconds[kind] - observed[kind] for kind in TIMED_KINDS})
+
+    content = response.streaming_content
+    response.streaming_content = (_profiled_async if response.is_async else _profiled)(content, profile, finished)
+
+
+def _profiled(content, profile, finished):
+    try:
+        while True:
+            token = _current.set(profile)
+            try:
+                part = next(content, None)
+            finally:
+                _current.reset(token)
+            if part is None:
+                return
+            yield part
+    finally:
+        finished()
+
+
+async def _profiled_async(content, profile, finished):
+    try:
+        while True:
+            token = _current.set(profile)
+            try:
+                part = await anext(content, None)
+            finally:
+                _current.reset(token)
+            if part is None:
+                return
+            yield part
+    finally:
+        finished()
+
+
+@sync_and_async_middleware
+def ProfilingMiddleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            profile = _start()
+            token = _current.set(profile)
+            try:
+                response = await get_response(request)
+            finally:
+                _current.reset(token)
+            _finish(request, response, profile)
+            if response.streaming:
+                _follow_stream(request, response, profile)
+            if profile.inspector is not None:
+                # EXPLAIN runs queries, which can't happen on the event loop
+                await sync_to_async(profile.inspector.report)(request, view_name(request))
+            return response
+    else:
+        def middleware(request):
+            profile = _start()
+            token = _current.set(profile)
+            try:
+                response = get_response(request)
+            finally:
+                _current.reset(token)
+            _finish(request, response, profile)
+            if response.streaming:
+                _follow_stream(request, response, profile)
+            if profile.inspector is not None:
+                profile.inspector.report(request, view_name(request))
+            return response
+    return middleware
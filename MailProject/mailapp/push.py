@@ -0,0 +1,201 @@
+"""
+New-mail push notifications.
+
+When mail is delivered, a small message is published on the recipient's
+channel once the transaction commits. The inbox page listens on an
+ASGI server-sent events stream and, on each message, fetches only the new
+rows from the "since cursor" endpoint instead of reloading the page. The
+message carries no mail content, so a dropped notification costs nothing:
+the next one, a reconnect or the polling fallback picks up every row after
+the client's cursor.
+
+The broker is chosen by ``settings.MAIL_PUSH_BROKER``. ``'memory'`` fans
+out inside one process, which is all a single ASGI worker (or a test run)
+needs. ``'redis'`` publishes through Redis pub/sub (``MAIL_PUSH_REDIS_URL``),
+so a mail saved by any web or worker process reaches listeners connected
+to any other.
+"""
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+
+def channel_for(user_id):
+    return f'mail:user:{user_id}'
+
+
+class InProcessSubscription:
+    """Async context manager delivering one channel's messages to the current event loop"""
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = None
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.broker._add(self.channel, self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.broker._remove(self.channel, self)
+
+    def deliver(self, message):
+        # Publishers are sync views and signal handlers on other threads
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class InProcessBroker:
+    """Pub/sub between threads and event loops of this process"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def _add(self, channel, subscription):
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+
+    def _remove(self, channel, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(channel, None)
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.deliver(message)
+            except RuntimeError:
+                # The subscriber's loop has closed; it unsubscribes on its way out
+                pass
+
+    def subscribe(self, channel):
+        return InProcessSubscription(self, channel)
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+
+class RedisSubscription:
+    def __init__(self, url, channel):
+        self.url = url
+        self.channel = channel
+
+    async def __aenter__(self):
+        import redis.asyncio
+
+        self.client = redis.asyncio.Redis.from_url(self.url)
+        self.pubsub = self.client.pubsub()
+        await self.pubsub.subscribe(self.channel)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.pubsub.unsubscribe(self.channel)
+        await self.pubsub.close()
+        await self.client.close()
+
+    async def get(self):
+        while True:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is not None:
+                return json.loads(message['data'])
+
+
+class RedisBroker:
+    """Pub/sub through Redis, shared by every process"""
+
+    def __init__(self, url):
+        self.url = url
+        self._client = None
+
+    def publish(self, channel, message):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        self._client.publish(channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.url, channel)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            if settings.MAIL_PUSH_BROKER == 'redis':
+                _broker = RedisBroker(settings.MAIL_PUSH_REDIS_URL)
+            else:
+                _broker = InProcessBroker()
+        return _broker
+
+
+def reset_broker():
+    """Forget the broker so the next call rebuilds it from settings"""
+    global _broker
+    with _broker_lock:
+        _broker = None
+
+
+def _publish(messages):
+    broker = get_broker()
+    for channel, message in messages:
+        try:
+            broker.publish(channel, message)
+        except Exception:
+            # Push is best effort; clients still catch up from their cursor
+            pass
+
+
+def notify_delivered(mails):
+    """Tell each recipient about their new mail once the current transaction commits"""
+    latest = {}
+    for mail in mails:
+        # One message per recipient is enough, since the client fetches everything after its cursor
+        latest[mail.recipient_id] = max(mail.id, latest.get(mail.recipient_id, 0))
+    messages = [
+        (channel_for(recipient_id), {'type': 'mail', 'id': mail_id})
+        for recipient_id, mail_id in latest.items()
+    ]
+    if messages:
+        transaction.on_commit(lambda: _publish(messages))
+
+
+async def mail_event_stream(user_id):
+    """
+    Server-sent events for ``user_id``: a ``mail`` event per notification,
+    comments as keepalives, and an end after ``MAIL_PUSH_STREAM_SECONDS``
+    so EventSource reconnects and no connection lives forever.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.MAIL_PUSH_STREAM_SECONDS
+    async with get_broker().subscribe(channel_for(user_id)) as subscription:
+        yield 'retry: 5000\n\n'
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                message = await asyncio.wait_for(
+                    subscription.get(), timeout=min(remaining, settings.MAIL_PUSH_HEARTBEAT_SECONDS),
+                )
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                continue
+            yield f'event: mail\ndata: {json.dumps(message)}\n\n'
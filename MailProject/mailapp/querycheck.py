@@ -0,0 +1,151 @@
+"""
+Duplicate, N+1 and slow query reports for development and staging.
+
+When ``MAIL_QUERY_REPORT`` names a file, the profiling middleware gives
+each request a ``QueryInspector``. The inspector keeps every statement the
+request runs, together with the innermost ``mailapp`` frame that ran it. At
+the end of the request it looks for three problems:
+
+- duplicates: the same SQL with the same parameters run more than once;
+- repeats: one SQL shape, with only the literal values differing, run at
+  least ``MAIL_QUERY_REPEAT_THRESHOLD`` times from the same line (an N+1);
+- slow queries: anything over ``MAIL_QUERY_EXPLAIN_MS``, reported with the
+  database's EXPLAIN plan.
+
+Requests with findings are appended to the report as one JSON line each,
+with SQL but never parameters. ``manage.py query_report`` sums a report up
+across requests. Keeping every statement and walking the stack for each one
+is too costly for production, so the report is off unless configured.
+"""
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.utils import timezone
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames in these files are the instrumentation itself, never the origin of a query
+SKIPPED_FILES = {os.path.join(APP_DIR, 'profiling.py'), os.path.join(APP_DIR, 'querycheck.py')}
+
+_IN_LIST = re.compile(r'\bIN \((?:%s|\?)(?:, (?:%s|\?))*\)', re.IGNORECASE)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r'\s+')
+
+_write_lock = threading.Lock()
+
+
+def fingerprint(sql):
+    """``sql`` with literals and IN lists collapsed, so queries differing only in values match"""
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _LITERAL.sub('?', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def query_origin():
+    """'path:line in function' for the innermost mailapp frame on the stack, or None"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename not in SKIPPED_FILES:
+            path = os.path.relpath(filename, os.path.dirname(APP_DIR))
+            return f'{path}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def explain(alias, sql, params):
+    """The database's plan for ``sql`` as text"""
+    connection = connections[alias]
+    try:
+        # A savepoint, so a failed EXPLAIN cannot break the transaction around it
+        with transaction.atomic(using=alias), connection.cursor() as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            rows = cursor.fetchall()
+    except DatabaseError as e:
+        return f'EXPLAIN failed: {e}'
+    return '\n'.join(' '.join(str(column) for column in row) for row in rows)
+
+
+class QueryInspector:
+    def __init__(self):
+        self.statements = []
+
+    def add(self, alias, sql, params, duration):
+        self.statements.append((alias, sql, params, duration, query_origin()))
+
+    def findings(self):
+        """{'duplicates': [...], 'repeats': [...], 'slow': [...]}, each finding a dict"""
+        by_statement = defaultdict(list)
+        by_shape = defaultdict(list)
+        for alias, sql, params, duration, origin in self.statements:
+            by_statement[(alias, sql, repr(params))].append(origin)
+            by_shape[(alias, fingerprint(sql), origin)].append(repr(params))
+
+        duplicates = [
+            {'sql': sql, 'count': len(origins), 'origins': sorted(Counter(origins).items(), key=_by_count)}
+            for (_, sql, _), origins in by_statement.items() if len(origins) > 1
+        ]
+        repeats = [
+            {'sql': shape, 'count': len(params), 'origin': origin}
+            for (_, shape, origin), params in by_shape.items()
+            if len(params) >= settings.MAIL_QUERY_REPEAT_THRESHOLD and len(set(params)) > 1
+        ]
+        slow = [
+            {'sql': sql, 'ms': round(duration * 1000, 1), 'origin': origin,
+             'plan': explain(alias, sql, params) if sql.lstrip()[:6].upper() == 'SELECT' else None}
+            for alias, sql, params, duration, origin in self.statements
+            if duration * 1000 >= settings.MAIL_QUERY_EXPLAIN_MS
+        ]
+        return {
+            'duplicates': sorted(duplicates, key=lambda finding: -finding['count']),
+            'repeats': sorted(repeats, key=lambda finding: -finding['count']),
+            'slow': sorted(slow, key=lambda finding: -finding['ms']),
+        }
+
+    def report(self, request, view):
+        """Append this request's findings, if any, to ``MAIL_QUERY_REPORT``; returns them"""
+        findings = self.findings()
+        if any(findings.values()):
+            record = {
+                'at': timezone.now().isoformat(), 'method': request.method, 'path': request.path,
+                'view': view, 'queries': len(self.statements), **findings,
+            }
+            line = json.dumps(record, default=str) + '\n'
+            with _write_lock, open(settings.MAIL_QUERY_REPORT, 'a') as report:
+                report.write(line)
+        return findings
+
+
+def _by_count(item):
+    origin, count = item
+    return -count, origin or ''
+
+
+def summarize(lines):
+    """
+    Findings from report lines added up per problem: a list of dicts with
+    the kind, SQL, origin, the number of requests and occurrences, and
+    the views involved, the most frequent first.
+    """
+    totals = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        problems = [('duplicate', finding['sql'], origin, count)
+                    for finding in record['duplicates'] for origin, count in finding['origins']]
+        problems += [('repeat', finding['sql'], finding['origin'], finding['count']) for finding in record['repeats']]
+        problems += [('slow', fingerprint(finding['sql']), finding['origin'], 1) for finding in record['slow']]
+        for kind, sql, origin, count in problems:
+            total = totals.setdefault((kind, sql, origin), {
+                'kind': kind, 'sql': sql, 'origin': origin, 'requests': 0, 'occurrences': 0, 'views': set(),
+            })
+            total['requests'] += 1
+            total['occurrences'] += count
+            total['views'].add(record['view'])
+    return sorted(totals.values(), key=lambda total: (-total['requests'], -total['occurrences']))
@@ -0,0 +1,173 @@
+"""
+Per-user rate limits and a global cap on concurrent AI calls.
+
+Each limited view gets a token bucket per user, stored in the default cache
+so every gunicorn worker sees the same bucket. A bucket holds up to N
+tokens and refills at N per period (``settings.RATE_LIMITS``, e.g.
+``'30/m'``), so short bursts are fine but a stuck loop or a script is cut
+off with ``429 Too Many Requests`` and a ``Retry-After`` header.
+
+Updates are a plain read-modify-write on one cache key, so two requests
+racing on the same bucket can both spend the last token. That slack is
+acceptable for throttling and avoids a lock round trip on every request.
+
+``ai_calls`` bounds how many model calls run at once across all processes,
+covering both the streaming view and the worker. Buckets and the cap are
+only shared when the cache is (``REDIS_URL``); with the local memory
+cache each process enforces its own. Allowed, limited and
+rejected counts are kept in the cache and reported by ``stats()``.
+"""
+import math
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.shortcuts import render
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+COUNTERS = ('allowed', 'limited')
+# Seconds after the last acquire or release that a concurrency count is forgotten
+SLOT_TIMEOUT = 300
+
+
+class CapacityExceeded(Exception):
+    pass
+
+
+def parse_rate(rate):
+    """Turn ``'30/m'`` into ``(30, 60)``: capacity and the seconds it takes to refill"""
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+def _count(name, outcome):
+    key = f'ratelimit:stats:{name}:{outcome}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def take_token(name, identity, rate):
+    """
+    Spend one token from ``identity``'s bucket for ``name``.
+    Returns 0 if allowed, otherwise the seconds until a token is available.
+    """
+    capacity, period = parse_rate(rate)
+    refill_per_second = capacity / period
+    key = f'ratelimit:{name}:{identity}'
+    now = time.time()
+
+    tokens, updated = cache.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated) * refill_per_second)
+    if tokens < 1:
+        _count(name, 'limited')
+        return math.ceil((1 - tokens) / refill_per_second)
+    # The bucket is back to full one period after the last request, so it can expire then
+    cache.set(key, (tokens - 1, now), timeout=period)
+    _count(name, 'allowed')
+    return 0
+
+
+def rate_limit(name, methods=('POST',)):
+    """
+    Throttle a view per user with the bucket configured as ``settings.RATE_LIMITS[name]``.
+    Views sharing a name share a bucket. Only ``methods`` are counted.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            rate = settings.RATE_LIMITS.get(name)
+            if rate and request.method in methods and request.user.is_authenticated:
+                retry_after = take_token(name, request.user.pk, rate)
+                if retry_after:
+                    return limited_response(request, retry_after)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def limited_response(request, retry_after):
+    message = f'Too many requests. Please try again in {retry_after} seconds.'
+    if request.path.startswith('/api/') or request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        response = JsonResponse({'error': message, 'retry_after': retry_after}, status=429)
+    else:
+        response = render(request, 'mailapp/rate_limited.html', {'message': message}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class ConcurrencyLimit:
+    """A counting semaphore shared by every process through the cache"""
+
+    def __init__(self, name, setting, default):
+        self.name = name
+        self.setting = setting
+        self.default = default
+        self.key = f'concurrency:{name}'
+
+    @property
+    def limit(self):
+        return getattr(settings, self.setting, self.default)
+
+    def acquire(self):
+        # The timeout clears slots leaked by a process that died mid-call. Every
+        # acquire and release pushes it back, so it only runs out once calls stop
+        cache.add(self.key, 0, timeout=SLOT_TIMEOUT)
+        try:
+            active = cache.incr(self.key)
+        except ValueError:
+            return True
+        cache.touch(self.key, SLOT_TIMEOUT)
+        if active > self.limit:
+            self.release()
+            _count(self.name, 'limited')
+            return False
+        _count(self.name, 'allowed')
+        return True
+
+    def release(self):
+        try:
+            active = cache.decr(self.key)
+        except ValueError:
+            return
+        if active < 0:
+            # The count expired and restarted while this call ran; below zero it would let extra calls in
+            try:
+                cache.incr(self.key, -active)
+            except ValueError:
+                pass
+        else:
+            cache.touch(self.key, SLOT_TIMEOUT)
+
+    def active(self):
+        return max(cache.get(self.key, 0), 0)
+
+    @contextmanager
+    def slot(self):
+        if not self.acquire():
+            raise CapacityExceeded('The AI assistant is busy right now. Please try again shortly.')
+        try:
+            yield
+        finally:
+            self.release()
+
+
+ai_calls = ConcurrencyLimit('ai_calls', 'AI_MAX_CONCURRENT_CALLS', 8)
+
+
+def stats():
+    """Allowed and limited counts for every configured limit, plus AI calls in progress"""
+    names = list(settings.RATE_LIMITS) + [ai_calls.name]
+    keys = [f'ratelimit:stats:{name}:{outcome}' for name in names for outcome in COUNTERS]
+    values = cache.get_many(keys)
+    result = {
+        name: {outcome: values.get(f'ratelimit:stats:{name}:{outcome}', 0) for outcome in COUNTERS}
+        for name in names
+    }
+    result[ai_calls.name]['active'] = ai_calls.active()
+    return result
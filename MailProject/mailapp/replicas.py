@@ -0,0 +1,243 @@
+"""
+Read replica routing.
+
+Every list page, search and sync call used to read from the primary
+database. ``DATABASE_REPLICA_URLS`` adds replicas (as aliases ``replica1``,
+``replica2``, ...), and views decorated with ``replica_reads`` read from one
+of them on GET and HEAD. Everything else, including every write and the
+session and user lookups made before the view runs, stays on ``default``.
+
+A replica trails the primary, so someone who has just sent a mail could
+open Sent and not find it. Any request that writes (``db_for_write`` is
+asked for a database) gets a ``mail_primary`` cookie. For the next
+``MAIL_REPLICA_PIN_SECONDS`` that browser reads from the primary only.
+Reads later in the same request also go to the primary once it has written.
+
+Each process checks a replica's lag at most every
+``MAIL_REPLICA_CHECK_SECONDS``. It skips replicas that are further behind
+than ``MAIL_REPLICA_MAX_LAG`` or can't be reached, and reads from the
+primary when none is left. A view that loses its replica mid-request is run
+again against the primary. ``manage.py replica_status`` shows what the
+checks see.
+
+To try this locally, copy db.sqlite3 and point a replica at the copy, e.g.
+``DATABASE_REPLICA_URLS=sqlite:///replica.sqlite3``. The copy only changes
+when it is copied again, which makes it a replica that has fallen far
+behind.
+"""
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, OperationalError, connections
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.http import parse_http_date_safe
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'mail_primary'
+READ_METHODS = ('GET', 'HEAD')
+
+# Seconds since the last replayed transaction; 0 once everything received has been replayed,
+# so an idle primary doesn't make its replica look stale
+POSTGRES_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+_routing = ContextVar('mailapp_replica_routing', default=None)
+
+
+class RoutingState:
+    """Where the current request's reads go; shared with the threads that run its sync code"""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.replica = None
+        self.wrote = False
+
+
+def replica_lag(alias):
+    """How many seconds replica ``alias`` is behind the primary; None if it can't tell"""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        # A SQLite copy has nothing to replay
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(POSTGRES_LAG_SQL)
+        lag = cursor.fetchone()[0]
+    return None if lag is None else float(lag)
+
+
+class ReplicaHealth:
+    """The last lag check of each replica in this process"""
+
+    def __init__(self):
+        self._checks = {}
+        self._lock = threading.Lock()
+
+    def is_usable(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checks.get(alias)
+        if checked is not None and now - checked['at'] < settings.MAIL_REPLICA_CHECK_SECONDS:
+            return checked['usable']
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError as exc:
+            lag, error = None, exc
+        else:
+            error = None
+        usable = lag is not None and lag <= settings.MAIL_REPLICA_MAX_LAG
+        self._record(alias, usable, lag, error)
+        return usable
+
+    def mark_down(self, alias, error):
+        """Skip ``alias`` until its next check, e.g. after it failed a query"""
+        self._record(alias, False, None, error)
+
+    def status(self):
+        with self._lock:
+            return {alias: dict(checked) for alias, checked in self._checks.items()}
+
+    def reset(self):
+        with self._lock:
+            self._checks.clear()
+
+    def _record(self, alias, usable, lag, error):
+        with self._lock:
+            previous = self._checks.get(alias)
+            self._checks[alias] = {'at': time.monotonic(), 'usable': usable, 'lag': lag, 'error': error}
+        if not usable and (previous is None or previous['usable']):
+            if error is not None:
+                logger.warning('Reading from the primary instead of replica %s: %s', alias, error)
+            else:
+                logger.warning('Reading from the primary instead of replica %s: %s s behind', alias, lag)
+        elif usable and previous is not None and not previous['usable']:
+            logger.info('Replica %s is back in use', alias)
+
+
+health = ReplicaHealth()
+
+
+def choose_replica():
+    """A replica close enough behind the primary, or None to read from the primary"""
+    usable = [alias for alias in settings.DATABASE_REPLICAS if health.is_usable(alias)]
+    return random.choice(usable) if usable else None
+
+
+class ReplicaRouter:
+    """Reads inside ``replica_reads`` go to the chosen replica; everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        if state is not None and state.replica is not None and not state.wrote:
+            return state.replica
+        # Not None, or related objects of rows read from a replica would be fetched from it too
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Rows from a replica are the primary's rows
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary
+        return False if db in settings.DATABASE_REPLICAS else None
+
+
+def _drop_unsettled_validators(response):
+    """
+    A replica may not yet have the changes that the response's ETag and
+    Last-Modified stand for, and a later 304 would keep the stale page.
+    Keep them only if those changes are older than any replica in use can
+    be behind.
+    """
+    if response.status_code == 304:
+        # Answered from the cached version, without reading the replica
+        return
+    last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+    settled = time.time() - settings.MAIL_REPLICA_MAX_LAG - settings.MAIL_REPLICA_CHECK_SECONDS
+    # Last-Modified is rounded down to the second
+    if last_modified is None or last_modified + 1 > settled:
+        response.headers.pop('ETag', None)
+        response.headers.pop('Last-Modified', None)
+
+
+def replica_reads(view):
+    """
+    Let a read-only view read from a replica on GET and HEAD. Put it below
+    ``login_required``, so the session and user are still read from the
+    primary, and above ``condition``. Leave it off views that write on GET,
+    like opening a conversation, and off views asked for right after a
+    change, like ``mail_since`` after a new-mail push.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        state = _routing.get()
+        if state is None or state.pinned or state.wrote or request.method not in READ_METHODS:
+            return view(request, *args, **kwargs)
+        replica = state.replica = choose_replica()
+        if replica is None:
+            return view(request, *args, **kwargs)
+        try:
+            response = view(request, *args, **kwargs)
+        except OperationalError as exc:
+            # The view only reads, so it can run again on the primary
+            health.mark_down(replica, exc)
+            state.replica = None
+            return view(request, *args, **kwargs)
+        finally:
+            state.replica = None
+        _drop_unsettled_validators(response)
+        return response
+    return wrapped
+
+
+def _pin(response, state):
+    if state.wrote and settings.DATABASE_REPLICAS:
+        response.set_cookie(
+            PIN_COOKIE, '1', max_age=settings.MAIL_REPLICA_PIN_SECONDS, httponly=True,
+            secure=settings.SESSION_COOKIE_SECURE, samesite='Lax',
+        )
+
+
+@sync_and_async_middleware
+def ReplicaMiddleware(get_response):
+    """Tracks whether a request writes, and pins its browser to the primary for a while if it did"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+            token = _routing.set(state)
+            try:
+                response = await get_response(request)
+            finally:
+                _routing.reset(token)
+            _pin(response, state)
+            return response
+    else:
+        def middleware(request):
+            state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+            token = _routing.set(state)
+            try:
+                response = get_response(request)
+            finally:
+                _routing.reset(token)
+            _pin(response, state)
+            return response
+    return middleware
@@ -0,0 +1,201 @@
+"""
+Full-text search over mail and drafts.
+
+Every Mail and Draft carries a denormalized ``search_document`` (subject
+and participant names) kept current by the pre_save signals. Bodies are
+indexed once per MessageContent row rather than once per delivery. The
+database-specific indexes are created by migrations 0003, 0008 and 0016:
+
+* PostgreSQL: GIN indexes on ``to_tsvector('english', <column>)``
+* SQLite: FTS5 tables kept in sync by triggers
+
+``search(queryset, query)`` filters a Mail or Draft queryset to the matches
+and annotates a ``search_rank`` (higher is better). Each search term must
+match either the row's own document or its content's body, and every term
+is matched as a prefix, so "proj upd" finds "project update". On
+PostgreSQL, stop words ("on", "the") are left out of the query.
+"""
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'english'
+CONTENT_TABLE = 'mailapp_messagecontent'
+# Indexed column of each searchable table
+SEARCH_TABLES = {
+    'mailapp_mail': 'search_document',
+    'mailapp_draft': 'search_document',
+    'mailapp_archivedmail': 'search_document',
+    CONTENT_TABLE: 'body',
+}
+
+
+def _user_names(user):
+    if user is None:
+        return []
+    return [user.username, user.first_name, user.last_name]
+
+
+def build_mail_document(mail):
+    parts = [mail.subject] + _user_names(mail.sender) + _user_names(mail.recipient)
+    return ' '.join(part for part in parts if part)
+
+
+def build_draft_document(draft):
+    parts = [draft.subject] + _user_names(draft.recipient)
+    return ' '.join(part for part in parts if part)
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def sqlite_fts_triggers(table, column='search_document'):
+    fts = f'{table}_fts'
+    return {
+        f'{fts}_insert': (
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        ),
+        f'{fts}_delete': (
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END"
+        ),
+        f'{fts}_update': (
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+            f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        ),
+    }
+
+
+def repair_sqlite_fts(connection):
+    """
+    SQLite migrations rebuild a table (create, copy, drop, rename) for most
+    schema changes, which silently drops its triggers. Recreate any missing
+    FTS sync triggers and resync the index. Runs after every migrate.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for table, column in SEARCH_TABLES.items():
+            fts = f'{table}_fts'
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [fts])
+            if cursor.fetchone() is None:
+                continue
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [table])
+            existing = {row[0] for row in cursor.fetchall()}
+            triggers = sqlite_fts_triggers(table, column)
+            if existing.issuperset(triggers):
+                continue
+            for sql in triggers.values():
+                cursor.execute(sql)
+            cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+class PostgresSearchBackend:
+    def searchable_terms(self, connection, terms):
+        """
+        The terms that leave something to match. to_tsquery drops stop words
+        such as "on" or "the", and the empty query left over matches no row,
+        so "meeting on friday" would find nothing.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT term FROM unnest(%s::text[]) AS term "
+                f"WHERE numnode(to_tsquery('{SEARCH_CONFIG}', term || ':*')) > 0",
+                [terms],
+            )
+            kept = {row[0] for row in cursor.fetchall()}
+        return [term for term in terms if term in kept]
+
+    def search(self, queryset, terms):
+        connection = connections[queryset.db]
+        terms = self.searchable_terms(connection, terms)
+        if not terms:
+            return queryset.none()
+        quote = connection.ops.quote_name
+        table, content = quote(queryset.model._meta.db_table), quote(CONTENT_TABLE)
+        # Must match the indexed expressions exactly for the GIN indexes to be used
+        vector = f"to_tsvector('{SEARCH_CONFIG}', {table}.search_document)"
+        content_vector = f"to_tsvector('{SEARCH_CONFIG}', {content}.body)"
+        any_term = ' | '.join(f'{term}:*' for term in terms)
+        queryset = queryset.annotate(
+            search_rank=RawSQL(
+                f"(ts_rank({vector}, to_tsquery('{SEARCH_CONFIG}', %s)) + COALESCE(("
+                f"SELECT ts_rank({content_vector}, to_tsquery('{SEARCH_CONFIG}', %s)) FROM {content} "
+                f"WHERE {content}.id = {table}.content_id), 0))::float8",
+                (any_term, any_term), output_field=FloatField(),
+            ),
+        )
+        for term in terms:
+            queryset = queryset.filter(RawSQL(
+                f"({vector} @@ to_tsquery('{SEARCH_CONFIG}', %s) OR {table}.content_id IN ("
+                f"SELECT id FROM {content} WHERE {content_vector} @@ to_tsquery('{SEARCH_CONFIG}', %s)))",
+                (f'{term}:*', f'{term}:*'), output_field=BooleanField(),
+            ))
+        return queryset
+
+
+class SQLiteSearchBackend:
+    def search(self, queryset, terms):
+        table = queryset.model._meta.db_table
+        fts_table, content_fts = f'{table}_fts', f'{CONTENT_TABLE}_fts'
+        any_term = ' OR '.join(f'"{term}"*' for term in terms)
+        # bm25() is lower for better matches, so negate it to rank descending
+        queryset = queryset.annotate(
+            search_rank=RawSQL(
+                f'COALESCE((SELECT -bm25({fts_table}) FROM {fts_table} '
+                f'WHERE {fts_table} MATCH %s AND rowid = "{table}"."id"), 0) + '
+                f'COALESCE((SELECT -bm25({content_fts}) FROM {content_fts} '
+                f'WHERE {content_fts} MATCH %s AND rowid = "{table}"."content_id"), 0)',
+                (any_term, any_term), output_field=FloatField(),
+            ),
+        )
+        for term in terms:
+            match = f'"{term}"*'
+            queryset = queryset.filter(
+                Q(id__in=RawSQL(f'SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH %s', (match,)))
+                | Q(content_id__in=RawSQL(f'SELECT rowid FROM {content_fts} WHERE {content_fts} MATCH %s', (match,)))
+            )
+        return queryset
+
+
+class SubstringSearchBackend:
+    """Unindexed fallback for databases without full-text support"""
+
+    def search(self, queryset, terms):
+        for term in terms:
+            queryset = queryset.filter(Q(search_document__icontains=term) | Q(content__body__icontains=term))
+        return queryset.annotate(search_rank=RawSQL('0.0', (), output_field=FloatField()))
+
+
+_backends = {}
+
+
+def get_backend(using='default'):
+    if using not in _backends:
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            _backends[using] = PostgresSearchBackend()
+        elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+            _backends[using] = SQLiteSearchBackend()
+        else:
+            _backends[using] = SubstringSearchBackend()
+    return _backends[using]
+
+
+def search(queryset, query):
+    """Filter ``queryset`` to rows matching ``query``, annotated with ``search_rank``"""
+    terms = search_terms(query)
+    if not terms:
+        return queryset.none()
+    return get_backend(queryset.db).search(queryset, terms)
@@ -1,16 +1,156 @@
-from django.db.models.signals import post_save
+from django.db import connections
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from django.contrib.auth.signals import user_logged_in
+from .models import Project, UserProfile, Mail, Draft
+from .search import build_mail_document, build_draft_document, repair_sqlite_fts
+from .autosave import draft_content_hash
+from .content import attach_content
+from .threads import assign_thread
+from .mailbox_cache import invalidate_mailboxes
+from .profiles import provision_user
+from . import changelog, counters, directory, push
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
 
+@receiver(user_logged_in)
+def provision_on_login(sender, request, user, **kwargs):
+    # Users who never got a profile or a project get them here, not on every page view
+    provision_user(user)
+
+@receiver(pre_save, sender=Mail)
+@receiver(pre_save, sender=Draft)
+def attach_message_content(sender, instance, update_fields=None, **kwargs):
+    # Point the row at the shared content for its current subject and body
+    if update_fields is None or 'content' in update_fields:
+        attach_content(instance)
+
+@receiver(pre_save, sender=Mail)
+def thread_mail(sender, instance, **kwargs):
+    # Replies join the conversation they answer, anything else starts one
+    assign_thread(instance)
+
+@receiver(pre_save, sender=Mail)
+def update_mail_search_document(sender, instance, update_fields=None, **kwargs):
+    # Partial saves (e.g. marking read) don't touch the indexed text
+    if update_fields is None or 'search_document' in update_fields:
+        instance.search_document = build_mail_document(instance)
+
+@receiver(pre_save, sender=Draft)
+def update_draft_search_document(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'search_document' in update_fields:
+        instance.search_document = build_draft_document(instance)
+
+@receiver(pre_save, sender=Draft)
+def bump_draft_version(sender, instance, update_fields=None, **kwargs):
+    # Every content change, from autosave or the edit form, moves the version on
+    if update_fields is not None:
+        return
+    content_hash = draft_content_hash(instance)
+    if content_hash != instance.content_hash:
+        instance.content_hash = content_hash
+        if instance.pk:
+            instance.version += 1
+
+@receiver(post_save, sender=Mail)
+def count_delivered_mail(sender, instance, created, **kwargs):
+    if created:
+        counters.apply_delta(instance.recipient_id, instance.project_id,
+                             total=1, unread=0 if instance.is_read else 1)
+
+@receiver(post_save, sender=Mail)
+def push_delivered_mail(sender, instance, created, **kwargs):
+    if created:
+        push.notify_delivered([instance])
+
+@receiver(post_delete, sender=Mail)
+def count_deleted_mail(sender, instance, **kwargs):
+    counters.apply_delta(instance.recipient_id, instance.project_id,
+                         total=-1, unread=0 if instance.is_read else -1)
+
+@receiver(post_save, sender=Mail)
+def log_saved_mail(sender, instance, **kwargs):
+    changelog.record(changelog.mail_changes([instance]))
+
+@receiver(post_delete, sender=Mail)
+def log_deleted_mail(sender, instance, **kwargs):
+    changelog.record(changelog.mail_changes([instance], action=changelog.DELETE))
+
+@receiver(post_save, sender=Draft)
+def log_saved_draft(sender, instance, **kwargs):
+    changelog.record([(instance.author_id, changelog.DRAFT, instance.id, changelog.UPSERT)])
+
+@receiver(post_delete, sender=Draft)
+def log_deleted_draft(sender, instance, **kwargs):
+    changelog.record([(instance.author_id, changelog.DRAFT, instance.id, changelog.DELETE)])
+
+@receiver(pre_delete, sender=User)
+def stop_logging_for_deleted_user(sender, instance, **kwargs):
+    changelog.user_departing(instance.pk)
+
+@receiver(post_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    changelog.user_departed(instance.pk)
+
+@receiver(post_migrate)
+def repair_search_triggers(sender, app_config, using='default', **kwargs):
+    if app_config.label == 'mailapp':
+        repair_sqlite_fts(connections[using])
+
+@receiver(m2m_changed, sender=UserProfile.projects.through)
+def invalidate_project_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is empty for clears, so note what is about to go
+        if reverse:
+            instance._directory_cleared = [instance.pk]
+        else:
+            instance._directory_cleared = list(instance.projects.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        for project_id in ([instance.pk] if reverse else pk_set):
+            directory.invalidate_project(project_id)
+    elif action == 'post_clear':
+        for project_id in getattr(instance, '_directory_cleared', []):
+            directory.invalidate_project(project_id)
+
+@receiver(m2m_changed, sender=UserProfile.projects.through)
+def invalidate_member_mailboxes(sender, instance, action, reverse, pk_set, **kwargs):
+    # Mailbox pages list the user's projects in the sidebar and filters
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_mailboxes([instance.user_id])
+    elif action == 'pre_clear':
+        instance._mailbox_cleared = list(instance.members.values_list('user_id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        invalidate_mailboxes(UserProfile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+    elif action == 'post_clear':
+        invalidate_mailboxes(getattr(instance, '_mailbox_cleared', []))
+
+@receiver(post_save, sender=Project)
+def invalidate_project_mailboxes(sender, instance, created, **kwargs):
+    # A renamed project shows up on every member's pages; a new one has no members yet
+    if not created:
+        invalidate_mailboxes(member['id'] for member in directory.project_members(instance.pk) or [])
+
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    if hasattr(instance, 'userprofile'):
-        instance.userprofile.save()
-    else:
-        UserProfile.objects.create(user=instance)
+def invalidate_own_mailbox(sender, instance, created, update_fields=None, **kwargs):
+    # The navbar shows the user's name and email
+    if not created and (update_fields is None or {'first_name', 'last_name', 'email'} & set(update_fields)):
+        invalidate_mailboxes([instance.pk])
+
+@receiver(post_save, sender=User)
+def invalidate_member_name(sender, instance, created, update_fields=None, **kwargs):
+    # New users have no projects yet, and logins only touch last_login
+    if created or (update_fields is not None and not {'username', 'first_name', 'last_name'} & set(update_fields)):
+        return
+    for project_id in Project.objects.filter(members__user=instance).values_list('pk', flat=True):
+        directory.invalidate_project(project_id)
+
+@receiver(pre_delete, sender=User)
+def invalidate_deleted_member(sender, instance, **kwargs):
+    # The cascade removes memberships without sending m2m_changed
+    for project_id in Project.objects.filter(members__user=instance).values_list('pk', flat=True):
+        directory.invalidate_project(project_id)
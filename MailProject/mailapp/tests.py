@@ -1,3 +1,1874 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, router
+from django.db.models import Count, F
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from . import ai, changelog, counters, directory, profiling, push, ratelimit, replicas
+from .forms import ComposeMailForm, DraftForm
+from .archive import archive, current_run
+from .batch_send import send_to_many
+from .benchmark import compare, generate_dataset
+from .bulk import apply_bulk_action, select_mailbox
+from .counters import mark_mail_read
+from .dbpool import ConnectionPool, PoolTimeout
+from .disconnect import cancel_on_disconnect
+from .models import Project, Mail, ArchivedMail, ArchiveRun, Draft, MailboxChange, MailboxCounter, MessageContent, Thread, AIDraftJob, PREVIEW_LENGTH
+from .pagination import KeysetPaginator, approximate_count, encode_cursor
+from .querycheck import QueryInspector, fingerprint
+from .search import search
+from .threads import attach_latest, threaded_mailbox
+from .transfer import ExportScope, import_mailbox
+
+
+def make_user(username, project=None):
+    user = User.objects.create_user(username=username, password='pass12345', first_name=username.title())
+    if project is not None:
+        user.userprofile.projects.add(project)
+    return user
+
+
+class InlineExecutor:
+    """ThreadPoolExecutor stand-in that runs work on the calling thread, inside the test transaction"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+        cls.project = Project.objects.create(name='Apollo', created_by=cls.alice)
+        cls.alice.userprofile.projects.add(cls.project)
+        cls.bob = make_user('bob', cls.project)
+        now = timezone.now()
+        for i in range(25):
+            mail = Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project,
+                                       subject=f'Mail {i}', body='Hello')
+            # Pairs of mails share a timestamp so the id tie-breaker is exercised
+            Mail.objects.filter(pk=mail.pk).update(sent_at=now - timedelta(minutes=i // 2))
+
+    def paginate(self, cursor=None):
+        queryset = Mail.objects.filter(recipient=self.alice)
+        return KeysetPaginator(queryset, 10, ordering=('-sent_at', '-id')).get_page(cursor)
+
+    def test_walks_forward_and_back_without_gaps(self):
+        expected = list(Mail.objects.filter(recipient=self.alice).order_by('-sent_at', '-id'))
+        first = self.paginate()
+        second = self.paginate(first.next_cursor)
+        third = self.paginate(second.next_cursor)
+        self.assertEqual(list(first) + list(second) + list(third), expected)
+        self.assertFalse(first.has_previous)
+        self.assertFalse(third.has_next)
+        self.assertEqual(list(self.paginate(third.previous_cursor)), list(second))
+        self.assertEqual(list(self.paginate(second.previous_cursor)), list(first))
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        self.assertEqual(list(self.paginate('not-a-cursor')), list(self.paginate()))
+        self.assertEqual(list(self.paginate(encode_cursor(['bogus'], 'next'))), list(self.paginate()))
+
+    def test_approximate_count_is_exact_below_threshold(self):
+        count = approximate_count(Mail.objects.filter(recipient=self.alice), threshold=100)
+        self.assertEqual((count.value, count.is_estimate), (25, False))
+
+    def test_inbox_renders_cursor_links(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('inbox'))
+        self.assertContains(response, '25 messages')
+        next_cursor = response.context['page_obj'].next_cursor
+        response = self.client.get(reverse('inbox'), {'cursor': next_cursor})
+        self.assertEqual(len(response.context['page_obj']), 10)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ListViewQueryCountTests(TestCase):
+    """
+    Each mailbox listing must cost a fixed number of queries however many
+    rows are on the page, i.e. no per-row lookups from the templates.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+        cls.project = Project.objects.create(name='Apollo', created_by=cls.alice)
+        cls.alice.userprofile.projects.add(cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def fill(self, count):
+        for i in range(count):
+            Mail.objects.create(sender=self.bob, recipient=self.alice, project=self.project,
+                                subject=f'In {i}', body='x' * 500)
+            Mail.objects.create(sender=self.alice, recipient=self.bob, project=self.project,
+                                subject=f'Out {i}', body='y' * 500)
+            Draft.objects.create(author=self.alice, recipient=self.bob, project=self.project,
+                                 subject=f'Draft {i}', body='z' * 500)
+
+    def assertViewQueries(self, url_name, expected):
+        for rows in (1, 9):
+            self.fill(rows)
+            with self.assertNumQueries(expected):
+                response = self.client.get(reverse(url_name))
+            self.assertEqual(response.status_code, 200)
+
+    # Session and user lookups account for two queries in every view
+    def test_inbox(self):
+        # profile, projects (shared with the sidebar), page, counters
+        self.assertViewQueries('inbox', 6)
+
+    def test_sent(self):
+        self.assertViewQueries('sent', 6)
+
+    def test_drafts(self):
+        # page, profile, sidebar projects
+        self.assertViewQueries('drafts', 5)
+
+    def test_list_projection_defers_body(self):
+        self.fill(1)
+        mail = Mail.objects.for_list().get(sender=self.bob)
+        self.assertIn('content_id', mail.get_deferred_fields())
+        self.assertEqual(len(mail.preview), PREVIEW_LENGTH)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+        cls.project = Project.objects.create(name='Apollo', created_by=cls.alice)
+        cls.alice.userprofile.projects.add(cls.project)
+        cls.bob = make_user('bob', cls.project)
+        cls.update = Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project,
+                                         subject='Project update', body='The launch moved to Friday.')
+        cls.budget = Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project,
+                                         subject='Budget', body='Budget numbers for the project update.')
+        cls.lunch = Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project,
+                                        subject='Lunch', body='Pizza?')
+
+    def test_prefix_terms_match(self):
+        results = search(Mail.objects.all(), 'proj upd')
+        self.assertEqual(set(results), {self.update, self.budget})
+
+    def test_participant_names_are_searchable(self):
+        self.assertEqual(search(Mail.objects.all(), 'Bob').count(), 3)
+
+    def test_document_follows_edits(self):
+        self.lunch.body = 'Tacos instead'
+        self.lunch.save()
+        self.assertEqual(list(search(Mail.objects.all(), 'tacos')), [self.lunch])
+        self.assertFalse(search(Mail.objects.all(), 'pizza').exists())
+
+    def test_inbox_search_uses_index(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('inbox'), {'search': 'launch'})
+        self.assertEqual(list(response.context['page_obj']), [self.update])
+
+    def test_drafts_search(self):
+        draft = Draft.objects.create(author=self.alice, project=self.project, subject='Quarterly plan')
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('drafts'), {'search': 'quart'})
+        self.assertEqual(list(response.context['page_obj']), [draft])
+
+    def test_rebuild_command_backfills(self):
+        Mail.objects.filter(pk=self.lunch.pk).update(search_document='')
+        self.assertFalse(search(Mail.objects.all(), 'lunch').exists())
+        call_command('rebuild_search_index', chunk_size=2, stdout=StringIO())
+        self.assertEqual(list(search(Mail.objects.all(), 'lunch')), [self.lunch])
+
+    def test_terms_can_match_subject_and_body_separately(self):
+        self.assertEqual(list(search(Mail.objects.all(), 'lunch pizza')), [self.lunch])
+        self.assertFalse(search(Mail.objects.all(), 'budget pizza').exists())
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL text search drops stop words')
+    def test_stop_words_are_left_out_of_postgres_searches(self):
+        self.assertEqual(list(search(Mail.objects.all(), 'launch on friday')), [self.update])
+        self.assertFalse(search(Mail.objects.all(), 'on the').exists())
+
+    def test_ranked_results_paginate(self):
+        queryset = search(Mail.objects.all(), 'project')
+        paginator = KeysetPaginator(queryset, 1, ordering=('-search_rank', '-id'))
+        first = paginator.get_page()
+        second = paginator.get_page(first.next_cursor)
+        self.assertEqual({*first, *second}, {self.update, self.budget})
+        self.assertFalse(second.has_next)
+        self.assertEqual(list(paginator.get_page(second.previous_cursor)), list(first))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class MailboxCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+        cls.project = Project.objects.create(name='Apollo', created_by=cls.alice)
+        cls.alice.userprofile.projects.add(cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def send(self, **kwargs):
+        return Mail.objects.create(sender=self.bob, recipient=self.alice, project=self.project,
+                                   subject='Hi', body='Hello', **kwargs)
+
+    def counter(self):
+        counter = MailboxCounter.objects.get(user=self.alice, project=self.project)
+        return counter.total, counter.unread
+
+    def test_delivery_read_and_delete_adjust_counter(self):
+        first = self.send()
+        self.send()
+        self.assertEqual(self.counter(), (2, 2))
+        self.assertTrue(mark_mail_read(first))
+        self.assertFalse(mark_mail_read(first))
+        self.assertEqual(self.counter(), (2, 1))
+        first.delete()
+        self.assertEqual(self.counter(), (1, 1))
+
+    def test_read_mail_view_decrements_once(self):
+        mail = self.send()
+        self.client.force_login(self.alice)
+        self.client.get(reverse('read_mail', args=[mail.id]))
+        self.client.get(reverse('read_mail', args=[mail.id]))
+        self.assertEqual(self.counter(), (1, 0))
+
+    def test_inbox_shows_counts(self):
+        self.send()
+        self.send(is_read=True)
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('inbox'))
+        self.assertContains(response, '2 messages · 1 unread')
+        self.assertContains(response, 'Apollo (1)')
+
+    def test_reconcile_fixes_drift(self):
+        self.send()
+        MailboxCounter.objects.update(total=7, unread=0)
+        call_command('reconcile_mailbox_counters', stdout=StringIO())
+        self.assertEqual(self.counter(), (1, 1))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class BulkActionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+        cls.project = Project.objects.create(name='Apollo', created_by=cls.alice)
+        cls.alice.userprofile.projects.add(cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        self.mails = [
+            Mail.objects.create(sender=self.bob, recipient=self.alice, project=self.project,
+                                subject=f'Mail {i}', body='Hello')
+            for i in range(5)
+        ]
+        self.foreign = Mail.objects.create(sender=self.alice, recipient=self.bob, project=self.project,
+                                           subject='Not yours', body='Hello')
+
+    def post(self, **data):
+        return self.client.post(reverse('bulk_mail_action'), data).json()
+
+    def counter(self):
+        counter = MailboxCounter.objects.get(user=self.alice, project=self.project)
+        return counter.total, counter.unread
+
+    def test_mark_read_by_ids_ignores_other_mailboxes(self):
+        ids = [self.mails[0].id, self.mails[1].id, self.foreign.id]
+        self.assertEqual(self.post(action='mark_read', ids=ids)['changed'], 2)
+        self.foreign.refresh_from_db()
+        self.assertFalse(self.foreign.is_read)
+        self.assertEqual(self.counter(), (5, 3))
+
+    def test_mark_all_in_chunks(self):
+        # Per chunk: id scan, savepoint, lock, update, change log, counter, release; then a final empty scan
+        with self.assertNumQueries(3 * 7 + 1):
+            changed = apply_bulk_action(select_mailbox(self.alice), 'mark_read', chunk_size=2)
+        self.assertEqual(changed, 5)
+        self.assertEqual(self.counter(), (5, 0))
+        self.assertEqual(self.post(action='mark_unread', all='true')['changed'], 5)
+        self.assertEqual(self.counter(), (5, 5))
+
+    def test_delete_by_filter(self):
+        Mail.objects.filter(pk=self.mails[0].pk).update(sent_at=timezone.now() - timedelta(days=40))
+        self.assertEqual(self.post(action='delete', older_than_days=30)['changed'], 1)
+        self.assertFalse(Mail.objects.filter(pk=self.mails[0].pk).exists())
+        self.assertEqual(self.counter(), (4, 4))
+
+    def test_move_to_another_project(self):
+        other = Project.objects.create(name='Gemini', created_by=self.alice)
+        mark_mail_read(self.mails[0])
+        ids = [self.mails[0].id, self.mails[1].id, self.foreign.id]
+        # Only projects the user belongs to are allowed
+        response = self.client.post(reverse('bulk_mail_action'), {'action': 'move', 'ids': ids, 'to_project': other.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Mail.objects.filter(project=other).count(), 0)
+
+        self.alice.userprofile.projects.add(other)
+        self.assertEqual(self.post(action='move', ids=ids, to_project=other.id)['changed'], 2)
+        self.assertEqual(set(Mail.objects.filter(project=other).values_list('id', flat=True)), set(ids[:2]))
+        self.assertEqual(self.counter(), (3, 3))
+        moved = MailboxCounter.objects.get(user=self.alice, project=other)
+        self.assertEqual((moved.total, moved.unread), (2, 1))
+
+    def test_requires_explicit_scope(self):
+        response = self.client.post(reverse('bulk_mail_action'), {'action': 'delete'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Mail.objects.count(), 6)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class DraftAutosaveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+        cls.project = Project.objects.create(name='Apollo', created_by=cls.alice)
+        cls.alice.userprofile.projects.add(cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def autosave(self, draft_id=None, version=None, **data):
+        data = {'project': self.project.id, 'recipient': self.bob.id, 'subject': 'Plan', 'body': 'v1', **data}
+        url = reverse('autosave_existing_draft', args=[draft_id]) if draft_id else reverse('autosave_draft')
+        headers = {'HTTP_IF_MATCH': f'"{version}"'} if version else {}
+        return self.client.post(url, data, **headers)
+
+    def test_creates_once_then_updates_in_place(self):
+        created = self.autosave()
+        self.assertEqual(created.status_code, 201)
+        draft_id, version = created.json()['draft_id'], created.json()['version']
+        updated = self.autosave(draft_id, version, body='v2')
+        self.assertEqual(updated.json()['version'], version + 1)
+        self.assertEqual(updated['ETag'], f'"{version + 1}"')
+        self.assertEqual(Draft.objects.get().body, 'v2')
+
+    def test_unchanged_content_skips_write(self):
+        created = self.autosave().json()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.autosave(created['draft_id'], created['version']).json()
+        writes = [q['sql'] for q in queries if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertEqual(writes, [])
+        self.assertFalse(response['saved'])
+        self.assertEqual(response['version'], created['version'])
+
+    def test_stale_version_conflicts(self):
+        created = self.autosave().json()
+        self.autosave(created['draft_id'], created['version'], body='from tab one')
+        response = self.autosave(created['draft_id'], created['version'], body='from tab two')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Draft.objects.get().body, 'from tab one')
+
+    def test_other_users_draft_is_not_found(self):
+        draft = Draft.objects.create(author=self.bob, project=self.project, subject='Mine')
+        self.assertEqual(self.autosave(draft.id).status_code, 404)
+
+    def test_send_removes_autosaved_draft(self):
+        draft_id = self.autosave().json()['draft_id']
+        self.client.post(reverse('compose'), {
+            'action': 'send', 'draft_id': draft_id, 'project': self.project.id,
+            'recipient': self.bob.id, 'subject': 'Plan', 'body': 'final',
+        })
+        self.assertFalse(Draft.objects.exists())
+        self.assertEqual(Mail.objects.get().body, 'final')
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, AI_DRAFT_BACKEND='mailapp.ai.FakeBackend')
+class AIDraftJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='pass12345')
+
+    def setUp(self):
+        ai._backend = None
+        self.addCleanup(setattr, ai, '_backend', None)
+        ai.get_cache().clear()
+        cache.clear()
+        self.client.force_login(self.alice)
+        self.async_client.force_login(self.alice)
+
+    def test_submit_returns_job_and_poll_reports_result(self):
+        response = self.client.post(reverse('generate_ai_draft'), {'prompt': 'ask for a status update'})
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], AIDraftJob.STATUS_PENDING)
+
+        for job in ai.claim_jobs(4):
+            ai.run_job(job)
+        result = self.client.get(status_url).json()
+        self.assertEqual(result['status'], AIDraftJob.STATUS_DONE)
+        self.assertEqual(result['subject'], 'Ask for a status update')
+
+    def test_claim_respects_limit_and_order(self):
+        jobs = [ai.submit_job(self.alice, f'prompt {i}') for i in range(3)]
+        claimed = ai.claim_jobs(2)
+        self.assertEqual([job.pk for job in claimed], [jobs[0].pk, jobs[1].pk])
+        self.assertEqual(ai.claim_jobs(5), [jobs[2]])
+        self.assertEqual(ai.claim_jobs(5), [])
+
+    def test_worker_command_drains_queue(self):
+        ai.submit_job(self.alice, 'thank the team')
+        with patch('mailapp.management.commands.run_ai_worker.ThreadPoolExecutor', InlineExecutor):
+            call_command('run_ai_worker', once=True, stdout=StringIO())
+        self.assertEqual(AIDraftJob.objects.get().status, AIDraftJob.STATUS_DONE)
+
+    def test_failures_are_recorded(self):
+        job = ai.submit_job(self.alice, 'anything')
+        with patch.object(ai.FakeBackend, 'generate', side_effect=RuntimeError('quota exceeded')):
+            ai.run_job(ai.claim_jobs(1)[0])
+        job.refresh_from_db()
+        self.assertEqual(job.status, AIDraftJob.STATUS_FAILED)
+        self.assertIn('quota exceeded', job.error)
+
+    def test_other_users_jobs_are_hidden(self):
+        bob = make_user('bob')
+        job = ai.submit_job(bob, 'secret')
+        self.assertEqual(self.client.get(reverse('ai_draft_job', args=[job.id])).status_code, 404)
+
+    def test_repeated_prompt_is_served_from_cache(self):
+        self.assertEqual(ai.generate_draft('Thank the team'), ai.generate_draft(' thank  the team\n'))
+        self.assertEqual(ai.cache_stats(), {'hits': 1, 'misses': 1, 'coalesced': 0})
+
+        # A cached prompt completes at submit time without going through the queue
+        with patch.object(ai.FakeBackend, 'generate') as generate:
+            response = self.client.post(reverse('generate_ai_draft'), {'prompt': 'THANK the team'})
+        generate.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['subject'], 'Thank the team')
+        self.assertEqual(ai.claim_jobs(5), [])
+
+    def test_resubmitting_a_queued_prompt_reuses_the_job(self):
+        first = ai.submit_job(self.alice, 'Draft a memo')
+        self.assertEqual(ai.submit_job(self.alice, 'draft a  memo'), first)
+        self.assertNotEqual(ai.submit_job(make_user('bob'), 'draft a memo'), first)
+
+    def test_concurrent_identical_prompts_share_one_call(self):
+        calls = []
+        release = threading.Event()
+
+        def slow_generate(prompt):
+            calls.append(prompt)
+            release.wait(5)
+            return '{"subject": "Hi", "body": "There"}'
+
+        results = []
+        with patch.object(ai.FakeBackend, 'generate', side_effect=slow_generate):
+            threads = [threading.Thread(target=lambda: results.append(ai.generate_draft('same prompt')))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            while not calls:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [('Hi', 'There')] * 3)
+        self.assertEqual(ai.cache_stats()['misses'], 1)
+
+    def test_giving_up_on_a_lease_leaves_it_with_its_holder(self):
+        lease_key = f"lease:{ai.prompt_hash('same prompt')}"
+        ai.get_cache().set(lease_key, 'another caller', 60)
+        with patch.object(ai, 'LEASE_TIMEOUT', 0.1), patch.object(ai, 'LEASE_POLL_INTERVAL', 0.01):
+            # The wait runs out, so this caller asks the model itself
+            self.assertEqual(ai.generate_draft('same prompt')[0], 'Same prompt')
+        self.assertEqual(ai.get_cache().get(lease_key), 'another caller')
+
+    def test_stream_sends_subject_then_body(self):
+        response = self.client.post(reverse('stream_ai_draft'), {'prompt': 'ask for a status update'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [chunk.decode() for chunk in response.streaming_content]
+        self.assertEqual(events[0], 'event: subject\ndata: {"text": "Ask for a status update"}\n\n')
+        self.assertTrue(all(event.startswith('event: body') for event in events[1:-1]))
+        self.assertTrue(events[-1].startswith('event: done'))
+        # The finished draft is cached for the queued path too
+        self.assertEqual(ai.get_cached_draft('Ask for a status update')[0], 'Ask for a status update')
+
+    async def test_stream_sends_each_event_as_it_arrives_under_asgi(self):
+        release, finished = threading.Event(), threading.Event()
+
+        def slow(prompt):
+            yield '{"subject": "Hi", "body": "'
+            release.wait(5)
+            yield 'there"}'
+            finished.set()
+
+        with patch.object(ai.FakeBackend, 'stream', side_effect=slow):
+            response = await self.async_client.post(reverse('stream_ai_draft'), {'prompt': 'anything'})
+            stream = aiter(response.streaming_content)
+            self.assertEqual(await anext(stream), b'event: subject\ndata: {"text": "Hi"}\n\n')
+            self.assertFalse(finished.is_set())
+            release.set()
+            rest = [chunk async for chunk in stream]
+        self.assertTrue(finished.is_set())
+        self.assertTrue(rest[-1].startswith(b'event: done'))
+
+    async def test_cancelled_stream_closes_the_model_call_under_asgi(self):
+        more, closed = threading.Event(), threading.Event()
+
+        def endless(prompt):
+            try:
+                yield '{"subject": "Hi", "body": "'
+                while True:
+                    more.wait(5)
+                    yield 'more '
+            finally:
+                closed.set()
+
+        with patch.object(ai.FakeBackend, 'stream', side_effect=endless):
+            response = await self.async_client.post(reverse('stream_ai_draft'), {'prompt': 'anything'})
+            stream = aiter(response.streaming_content)
+            await anext(stream)
+            # What cancel_on_disconnect does once the client has gone
+            reading = asyncio.ensure_future(anext(stream))
+            await asyncio.sleep(0.05)
+            reading.cancel()
+            more.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await reading
+        self.assertTrue(closed.is_set())
+        self.assertEqual(ratelimit.stats()['ai_calls']['active'], 0)
+
+    def test_streamed_drafts_count_as_ai_time(self):
+        def slow(prompt):
+            time.sleep(0.02)
+            yield '{"subject": "Hi", "body": "there"}'
+
+        profiling.metrics.reset()
+        with patch.object(ai.FakeBackend, 'stream', side_effect=slow):
+            response = self.client.post(reverse('stream_ai_draft'), {'prompt': 'anything'})
+            b''.join(response.streaming_content)
+        line = next(line for line in profiling.metrics.render().splitlines()
+                    if line.startswith('mailapp_request_component_seconds_total{view="stream_ai_draft",component="ai"}'))
+        self.assertGreaterEqual(float(line.split()[-1]), 0.02)
+
+    def test_stream_parser_handles_split_escapes(self):
+        text = '```json\n{"subject": "Caf\\u00e9 \\"plans\\"", "body": "Hi,\\nsee you"}\n```'
+        parser, events = ai.DraftStreamParser(), []
+        for char in text:
+            events += parser.feed(char)
+        rest, result = parser.close()
+        events += rest
+        self.assertEqual(events[0], ('subject', 'Café "plans"'))
+        self.assertEqual(''.join(text for field, text in events[1:]), 'Hi,\nsee you')
+        self.assertEqual(result, ('Café "plans"', 'Hi,\nsee you'))
+
+    def test_stream_parser_keeps_malformed_escapes_as_text(self):
+        text = r'{"subject": "Hi", "body": "bad \uZZ12 and \u00"}'
+        parser, events = ai.DraftStreamParser(), []
+        for char in text:
+            events += parser.feed(char)
+        rest, result = parser.close()
+        events += rest
+        self.assertEqual(events[0], ('subject', 'Hi'))
+        self.assertEqual(''.join(text for field, text in events[1:]), r'bad \uZZ12 and \u00')
+        self.assertEqual(result, ('Hi', r'bad \uZZ12 and \u00'))
+
+    def test_client_disconnect_closes_upstream_stream(self):
+        closed = []
+
+        def endless(prompt):
+            try:
+                yield '{"subject": "Hi", "body": "'
+                while True:
+                    yield 'more '
+            finally:
+                closed.append(True)
+
+        with patch.object(ai.FakeBackend, 'stream', side_effect=endless):
+            response = self.client.post(reverse('stream_ai_draft'), {'prompt': 'anything'})
+            stream = iter(response.streaming_content)
+            next(stream)
+            next(stream)
+            response.close()
+        self.assertEqual(closed, [True])
+
+    def test_parse_draft_response_fallbacks(self):
+        self.assertEqual(ai.parse_draft_response('```json\n{"subject": "Hi", "body": "There"}\n```'), ('Hi', 'There'))
+        self.assertEqual(ai.parse_draft_response('Subject: Hi\nThere'), ('Hi', 'There'))
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, AI_DRAFT_BACKEND='mailapp.ai.FakeBackend',
+    RATE_LIMITS={'autosave': '2/m', 'compose': '1/h', 'ai_draft': '10/m'},
+)
+class RateLimitTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        cache.clear()
+        ai.get_cache().clear()
+        ai._backend = None
+        self.addCleanup(setattr, ai, '_backend', None)
+        self.client.force_login(self.alice)
+
+    def autosave(self):
+        return self.client.post(reverse('autosave_draft'), {'project': self.project.id, 'subject': 'Hi', 'body': ''})
+
+    def test_bucket_limits_each_user_separately(self):
+        self.assertEqual(self.autosave().status_code, 201)
+        self.assertEqual(self.autosave().status_code, 201)
+        response = self.autosave()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(response.json()['retry_after'], 30)
+
+        self.client.force_login(self.bob)
+        self.assertEqual(self.autosave().status_code, 201)
+        self.assertEqual(ratelimit.stats()['autosave'], {'allowed': 3, 'limited': 1})
+
+    def test_bucket_refills_over_time(self):
+        with patch('mailapp.ratelimit.time.time', return_value=1000.0):
+            self.autosave()
+            self.autosave()
+            self.assertEqual(self.autosave().status_code, 429)
+        with patch('mailapp.ratelimit.time.time', return_value=1030.0):
+            self.assertEqual(self.autosave().status_code, 201)
+            self.assertEqual(self.autosave().status_code, 429)
+
+    def test_page_posts_get_an_html_429_and_gets_are_free(self):
+        data = {'action': 'send', 'recipient': self.bob.id, 'project': self.project.id, 'subject': 'Hi', 'body': 'Yo'}
+        self.assertEqual(self.client.post(reverse('compose'), data).status_code, 302)
+        response = self.client.post(reverse('compose'), data)
+        self.assertEqual(response.status_code, 429)
+        self.assertTemplateUsed(response, 'mailapp/rate_limited.html')
+        self.assertEqual(self.client.get(reverse('compose')).status_code, 200)
+        self.assertEqual(Mail.objects.count(), 1)
+
+    @override_settings(AI_MAX_CONCURRENT_CALLS=1)
+    def test_ai_calls_are_capped_globally(self):
+        self.assertTrue(ratelimit.ai_calls.acquire())
+        self.addCleanup(ratelimit.ai_calls.release)
+
+        response = self.client.post(reverse('stream_ai_draft'), {'prompt': 'hello'})
+        events = b''.join(response.streaming_content).decode()
+        self.assertIn('event: error', events)
+        self.assertIn('busy', events)
+
+        # Queued jobs wait for a free slot instead of failing
+        ai.submit_job(self.alice, 'hello')
+        job = ai.run_job(ai.claim_jobs(1)[0])
+        self.assertEqual(job.status, AIDraftJob.STATUS_PENDING)
+        self.assertEqual(ratelimit.stats()['ai_calls']['active'], 1)
+
+    @override_settings(AI_MAX_CONCURRENT_CALLS=1)
+    def test_concurrency_count_survives_expiring_mid_call(self):
+        self.assertTrue(ratelimit.ai_calls.acquire())
+        # The count times out while that call runs and restarts with the next one
+        cache.delete(ratelimit.ai_calls.key)
+        self.assertTrue(ratelimit.ai_calls.acquire())
+        ratelimit.ai_calls.release()
+        ratelimit.ai_calls.release()
+        self.assertEqual(cache.get(ratelimit.ai_calls.key), 0)
+        # The cap still holds
+        self.assertTrue(ratelimit.ai_calls.acquire())
+        self.addCleanup(ratelimit.ai_calls.release)
+        self.assertFalse(ratelimit.ai_calls.acquire())
+
+    def test_counters_are_staff_only(self):
+        self.assertEqual(self.client.get(reverse('ops_counters')).status_code, 403)
+        self.client.force_login(User.objects.create_user(username='ops', is_staff=True))
+        data = self.client.get(reverse('ops_counters')).json()
+        self.assertIn('autosave', data['rate_limits'])
+        self.assertIn('hits', data['ai_cache'])
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class DirectoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def member_names(self):
+        return [member['name'] for member in directory.project_members(self.project.id)]
+
+    def test_members_are_cached_until_membership_changes(self):
+        self.assertEqual(self.member_names(), ['Alice (alice)', 'Bob (bob)'])
+        with self.assertNumQueries(0):
+            self.member_names()
+
+        carol = make_user('carol', self.project)
+        self.assertIn('Carol (carol)', self.member_names())
+        self.project.members.remove(carol.userprofile)
+        self.assertNotIn('Carol (carol)', self.member_names())
+
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        self.assertIn('Robert (bob)', self.member_names())
+
+        self.bob.userprofile.projects.clear()
+        self.assertEqual(self.member_names(), ['Alice (alice)'])
+
+    def test_deleting_a_user_drops_them(self):
+        self.member_names()
+        self.bob.delete()
+        self.assertEqual(self.member_names(), ['Alice (alice)'])
+
+    @override_settings(MAIL_SHARED_CACHE=True)
+    def test_project_users_supports_etags(self):
+        url = reverse('get_project_users') + f'?project_id={self.project.id}'
+        response = self.client.get(url)
+        self.assertEqual(response.json()['users'], [{'id': self.bob.id, 'name': 'Bob (bob)'}])
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        make_user('carol', self.project)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['users']), 2)
+
+    def test_per_process_cache_keeps_lists_briefly_and_sends_no_etag(self):
+        with patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            self.member_names()
+        self.assertEqual(cache_set.call_args.kwargs['timeout'], directory.LOCAL_MEMBERS_TIMEOUT)
+        response = self.client.get(reverse('get_project_users') + f'?project_id={self.project.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+    def test_drafts_are_only_sent_to_current_members(self):
+        draft = Draft.objects.create(author=self.alice, project=self.project, recipient=self.bob, subject='Plan')
+        response = self.client.get(reverse('edit_draft', args=[draft.id]), secure=True)
+        self.assertEqual(list(response.context['form'].fields['recipient'].queryset), [self.bob])
+
+        self.bob.userprofile.projects.clear()
+        self.client.post(reverse('edit_draft', args=[draft.id]), {'action': 'send'}, secure=True)
+        self.assertFalse(Mail.objects.exists())
+        self.assertTrue(Draft.objects.filter(pk=draft.pk).exists())
+
+    def test_forms_only_accept_project_members(self):
+        outsider = make_user('mallory')
+        data = {'project': self.project.id, 'recipient': outsider.id, 'subject': 'Hi', 'body': 'Yo'}
+        self.assertIn('recipient', ComposeMailForm(user=self.alice, data=data).errors)
+        data['recipient'] = self.bob.id
+        self.assertTrue(ComposeMailForm(user=self.alice, data=data).is_valid())
+        self.assertTrue(DraftForm(user=self.alice, data=data).is_valid())
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class BatchSendTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.members = [make_user(f'member{i}', cls.project) for i in range(5)]
+        cls.outsider = make_user('mallory')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def test_send_to_all_members_in_a_few_queries(self):
+        MailboxCounter.objects.create(user=self.members[0], project=self.project, total=3, unread=1)
+        # Members, the shared content (lookup and insert), the thread, one mail
+        # INSERT, counter rows and one counter UPDATE, the change log, plus savepoints
+        with self.assertNumQueries(12):
+            mails, results = send_to_many(self.alice, self.project, 'Launch', 'We ship today', all_members=True)
+        self.assertEqual(len(mails), 5)
+        self.assertEqual(set(results.values()), {'sent'})
+        self.assertTrue(all(mail.pk and mail.sent_at for mail in mails))
+        self.assertEqual(len({mail.content_id for mail in mails}), 1)
+        self.assertEqual(len({mail.thread_id for mail in mails}), 1)
+
+        counter = MailboxCounter.objects.get(user=self.members[0], project=self.project)
+        self.assertEqual((counter.total, counter.unread), (4, 2))
+        self.assertEqual(MailboxCounter.objects.get(user=self.members[1]).unread, 1)
+        # bulk_create skipped the signals, but the mail is still searchable
+        self.assertEqual(search(Mail.objects.filter(recipient=self.members[2]), 'ship').count(), 1)
+
+    def test_api_reports_each_recipient(self):
+        response = self.client.post(reverse('batch_send_mail'), {
+            'project': self.project.id, 'subject': 'Hi', 'body': 'Yo',
+            'recipients': [self.members[0].id, self.outsider.id, self.alice.id, self.members[0].id],
+        })
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual(data['sent'], 1)
+        statuses = {result['recipient_id']: result['status'] for result in data['results']}
+        self.assertEqual(statuses, {self.members[0].id: 'sent', self.outsider.id: 'not_a_member', self.alice.id: 'self'})
+        self.assertEqual(Mail.objects.filter(recipient=self.outsider).count(), 0)
+
+    def test_compose_can_send_to_the_whole_project(self):
+        response = self.client.post(reverse('compose'), {
+            'action': 'send', 'all_members': 'true', 'project': self.project.id, 'subject': 'Hi', 'body': 'Yo',
+        })
+        self.assertRedirects(response, reverse('inbox'), fetch_redirect_response=False)
+        self.assertEqual(Mail.objects.filter(sender=self.alice).count(), 5)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class MessageContentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def send(self, subject='Hi', body='Same text'):
+        return Mail.objects.create(sender=self.alice, recipient=self.bob, project=self.project, subject=subject, body=body)
+
+    def test_identical_messages_share_content(self):
+        first, second = self.send(), self.send()
+        self.assertEqual(first.content_id, second.content_id)
+        self.assertNotEqual(self.send(body='Other text').content_id, first.content_id)
+        self.assertEqual(Mail.objects.get(pk=second.pk).body, 'Same text')
+
+    def test_editing_a_draft_moves_it_to_new_content(self):
+        draft = Draft.objects.create(author=self.alice, project=self.project, subject='Plan', body='v1')
+        old_content = draft.content_id
+        draft.body = 'v2'
+        draft.save()
+        self.assertNotEqual(draft.content_id, old_content)
+        self.assertEqual(MessageContent.objects.get(pk=old_content).body, 'v1')
+
+        call_command('prune_message_contents', stdout=StringIO())
+        self.assertFalse(MessageContent.objects.filter(pk=old_content).exists())
+        self.assertTrue(MessageContent.objects.filter(pk=draft.content_id).exists())
+
+    def test_sending_a_draft_reuses_its_content(self):
+        draft = Draft.objects.create(author=self.alice, project=self.project, recipient=self.bob,
+                                     subject='Plan', body='Ship it')
+        self.client.force_login(self.alice)
+        self.assertContains(self.client.get(reverse('edit_draft', args=[draft.id])), 'Ship it')
+        self.client.post(reverse('edit_draft', args=[draft.id]), {'action': 'send'})
+        self.assertEqual(Mail.objects.get(sender=self.alice).content_id, draft.content_id)
+
+    def test_list_views_never_read_content(self):
+        self.send()
+        self.client.force_login(self.bob)
+        for name in ('inbox', 'sent', 'drafts'):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse(name))
+            self.assertFalse([q for q in queries if 'mailapp_messagecontent' in q['sql']], name)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ThreadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+        cls.mallory = make_user('mallory', cls.project)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def send(self, sender, recipient, subject, in_reply_to=None):
+        return Mail.objects.create(sender=sender, recipient=recipient, project=self.project,
+                                   subject=subject, body=f'{subject} body', in_reply_to=in_reply_to)
+
+    def test_replies_join_the_original_thread(self):
+        first = self.send(self.bob, self.alice, 'Plan')
+        reply = self.send(self.alice, self.bob, 'Re: Plan', in_reply_to=first)
+        other = self.send(self.bob, self.alice, 'Lunch')
+        self.assertEqual(reply.thread_id, first.thread_id)
+        self.assertNotEqual(other.thread_id, first.thread_id)
+        self.assertEqual(first.thread.subject, 'Plan')
+
+    def test_reply_form_is_prefilled_and_threads_the_sent_mail(self):
+        original = self.send(self.bob, self.alice, 'Plan')
+        response = self.client.get(reverse('compose'), {'reply_to': original.id})
+        form = response.context['form']
+        self.assertEqual(form.initial['subject'], 'Re: Plan')
+        self.assertEqual(form.initial['recipient'], self.bob)
+        self.assertIn('Plan body', form.initial['body'])
+
+        # Replying to a reply doesn't stack prefixes
+        response = self.client.get(reverse('compose'), {'reply_to': self.send(self.bob, self.alice, 'Re: Plan').id})
+        self.assertEqual(response.context['form'].initial['subject'], 'Re: Plan')
+
+        self.client.post(reverse('compose'), {
+            'action': 'send', 'project': self.project.id, 'recipient': self.bob.id,
+            'subject': 'Re: Plan', 'body': 'Sounds good', 'in_reply_to': original.id,
+        })
+        sent = Mail.objects.get(sender=self.alice)
+        self.assertEqual((sent.in_reply_to_id, sent.thread_id), (original.id, original.thread_id))
+
+    def test_cannot_reply_into_someone_elses_thread(self):
+        private = self.send(self.bob, self.mallory, 'Secret')
+        response = self.client.get(reverse('compose'), {'forward': private.id})
+        self.assertNotIn('subject', response.context['form'].initial)
+        form = ComposeMailForm(user=self.alice, data={
+            'project': self.project.id, 'recipient': self.bob.id, 'subject': 'Hi', 'body': 'x',
+            'in_reply_to': private.id,
+        })
+        self.assertIn('in_reply_to', form.errors)
+
+    def test_draft_keeps_its_place_in_the_thread(self):
+        original = self.send(self.bob, self.alice, 'Plan')
+        draft = Draft.objects.create(author=self.alice, recipient=self.bob, project=self.project,
+                                     subject='Re: Plan', body='Later', in_reply_to=original)
+        self.client.post(reverse('edit_draft', args=[draft.id]), {'action': 'send'})
+        self.assertEqual(Mail.objects.get(sender=self.alice).thread_id, original.thread_id)
+
+    def test_threaded_inbox_groups_in_one_query(self):
+        first = self.send(self.bob, self.alice, 'Plan')
+        self.send(self.alice, self.bob, 'Re: Plan', in_reply_to=first)
+        latest = self.send(self.bob, self.alice, 'Re: Plan', in_reply_to=first)
+        mark_mail_read(first)
+        self.send(self.mallory, self.alice, 'Lunch')
+
+        with self.assertNumQueries(1):
+            threads = list(threaded_mailbox(self.alice).order_by('-latest_at', '-id'))
+        self.assertEqual([thread.subject for thread in threads], ['Lunch', 'Plan'])
+        plan = threads[1]
+        # Only mail alice received counts, not her own reply
+        self.assertEqual((plan.message_count, plan.unread_count, plan.latest_id), (2, 1, latest.id))
+
+        with self.assertNumQueries(1):
+            attach_latest(threads)
+        self.assertEqual(plan.latest, latest)
+
+        response = self.client.get(reverse('inbox'), {'view': 'threads'})
+        self.assertTrue(response.context['threaded'])
+        self.assertEqual(len(response.context['page_obj']), 2)
+
+    def test_threaded_inbox_paginates_by_latest_activity(self):
+        threads = [self.send(self.bob, self.alice, f'Topic {i}') for i in range(12)]
+        # A reply brings an old conversation back to the top
+        self.send(self.bob, self.alice, 'Re: Topic 0', in_reply_to=threads[0])
+        response = self.client.get(reverse('inbox'), {'view': 'threads'})
+        page = response.context['page_obj']
+        self.assertEqual(page.object_list[0].subject, 'Topic 0')
+        response = self.client.get(reverse('inbox'), {'view': 'threads', 'cursor': page.next_cursor})
+        self.assertEqual([thread.subject for thread in response.context['page_obj']], ['Topic 2', 'Topic 1'])
+
+    def test_read_thread_shows_the_conversation_and_marks_it_read(self):
+        first = self.send(self.bob, self.alice, 'Plan')
+        self.send(self.alice, self.bob, 'Re: Plan', in_reply_to=first)
+        self.send(self.bob, self.mallory, 'Fwd: Plan', in_reply_to=first)
+        response = self.client.get(reverse('read_thread', args=[first.thread_id]))
+        self.assertEqual([mail.subject for mail in response.context['thread_mails']], ['Plan', 'Re: Plan'])
+        self.assertTrue(Mail.objects.get(id=first.id).is_read)
+        self.assertEqual(MailboxCounter.objects.get(user=self.alice).unread, 0)
+
+        self.client.force_login(User.objects.create_user(username='stranger'))
+        response = self.client.get(reverse('read_thread', args=[first.thread_id]))
+        self.assertRedirects(response, reverse('inbox'), fetch_redirect_response=False)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, MAIL_PUSH_BROKER='memory')
+class MailPushTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        push.reset_broker()
+        self.client.force_login(self.alice)
+        self.async_client.force_login(self.alice)
+
+    def send(self, recipient, subject='Hello'):
+        return Mail.objects.create(sender=self.bob, recipient=recipient, project=self.project,
+                                   subject=subject, body='Hi there')
+
+    @patch('mailapp.views.SYNC_OVERLAP_SECONDS', 0)
+    def test_since_returns_only_new_mail_after_the_cursor(self):
+        self.send(self.alice, 'Old')
+        cursor = self.client.get(reverse('mail_since')).json()['cursor']
+        new = self.send(self.alice, 'New')
+        self.send(self.bob, 'Not for alice')
+
+        data = self.client.get(reverse('mail_since'), {'cursor': cursor}).json()
+        self.assertEqual([mail['id'] for mail in data['mails']], [new.id])
+        self.assertIn(f'data-mail-id="{new.id}"', data['mails'][0]['html'])
+        self.assertEqual(data['unread_count'], 2)
+        self.assertFalse(data['has_more'])
+        # The returned cursor moves past what was just delivered
+        self.assertEqual(self.client.get(reverse('mail_since'), {'cursor': data['cursor']}).json()['mails'], [])
+
+        self.assertEqual(self.client.get(reverse('mail_since'), {'cursor': 'garbage'}).status_code, 400)
+
+    def test_since_sends_recent_mail_again_in_case_it_committed_late(self):
+        old = self.send(self.alice, 'Old')
+        Mail.objects.filter(pk=old.pk).update(sent_at=timezone.now() - timedelta(hours=1))
+        late, newer = self.send(self.alice, 'Late'), self.send(self.alice, 'Newer')
+        # The page already has "Newer", but "Late" was not committed yet when it asked
+        data = self.client.get(reverse('mail_since'), {'cursor': encode_cursor([newer.id], 'next')}).json()
+        self.assertEqual([mail['id'] for mail in data['mails']], [late.id, newer.id])
+        self.assertEqual(data['cursor'], encode_cursor([newer.id], 'next'))
+
+    def test_recipients_are_notified_after_commit(self):
+        with patch.object(push.get_broker(), 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                mail = self.send(self.alice)
+                publish.assert_not_called()
+            publish.assert_called_once_with(push.channel_for(self.alice.id), {'type': 'mail', 'id': mail.id})
+
+            publish.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True):
+                send_to_many(self.bob, self.project, 'All hands', 'Now', all_members=True)
+            self.assertEqual([call.args[0] for call in publish.call_args_list], [push.channel_for(self.alice.id)])
+
+    def test_event_stream_needs_an_asgi_server(self):
+        # Under WSGI the page is told not to reconnect and polls instead
+        self.assertEqual(self.client.get(reverse('mail_events')).status_code, 204)
+
+    async def test_event_stream_pushes_notifications(self):
+        response = await self.async_client.get(reverse('mail_events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+
+        push.get_broker().publish(push.channel_for(self.bob.id), {'type': 'mail', 'id': 1})
+        push.get_broker().publish(push.channel_for(self.alice.id), {'type': 'mail', 'id': 2})
+        self.assertEqual(await anext(stream), b'event: mail\ndata: {"type": "mail", "id": 2}\n\n')
+        await stream.aclose()
+
+    async def test_a_client_that_disconnects_cancels_its_request(self):
+        closed = asyncio.Event()
+
+        async def app(scope, receive, send):
+            await receive()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            try:
+                while True:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.set()
+
+        received = asyncio.Queue()
+        received.put_nowait({'type': 'http.request', 'body': b'', 'more_body': False})
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 3:
+                received.put_nowait({'type': 'http.disconnect'})
+
+        await asyncio.wait_for(cancel_on_disconnect(app)({'type': 'http'}, received.get, send), timeout=5)
+        self.assertTrue(closed.is_set())
+
+    @override_settings(MAIL_PUSH_STREAM_SECONDS=0)
+    async def test_event_stream_ends_and_unsubscribes(self):
+        response = await self.async_client.get(reverse('mail_events'))
+        self.assertEqual([chunk async for chunk in response.streaming_content], [b'retry: 5000\n\n'])
+        self.assertEqual(push.get_broker().subscriber_count(push.channel_for(self.alice.id)), 0)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class MailboxSyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+        # Cursor semantics without the re-read of recent entries, which has its own test
+        overlap = patch.object(changelog, 'SYNC_OVERLAP_SECONDS', 0)
+        overlap.start()
+        self.addCleanup(overlap.stop)
+
+    def send(self, sender, recipient, subject='Hello'):
+        return Mail.objects.create(sender=sender, recipient=recipient, project=self.project,
+                                   subject=subject, body='Hi there')
+
+    def sync(self, cursor=0, **params):
+        response = self.client.get(reverse('sync_mailbox'), {'cursor': cursor, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sync_returns_changes_after_the_cursor(self):
+        received = self.send(self.bob, self.alice, 'For alice')
+        sent = self.send(self.alice, self.bob, 'From alice')
+        self.send(self.bob, self.bob, 'Not hers')
+        draft = Draft.objects.create(author=self.alice, project=self.project, subject='Later', body='...')
+
+        data = self.sync()
+        self.assertEqual([mail['id'] for mail in data['mails']], [received.id, sent.id])
+        self.assertEqual(data['mails'][0]['subject'], 'For alice')
+        self.assertNotIn('body', data['mails'][0])
+        self.assertEqual([d['id'] for d in data['drafts']], [draft.id])
+        self.assertEqual(self.sync(data['cursor'])['mails'], [])
+
+        # Read state, edits and deletes show up as the objects' new state
+        cursor, draft_id = data['cursor'], draft.id
+        mark_mail_read(received)
+        draft.delete()
+        data = self.sync(cursor)
+        self.assertEqual(data['mails'], [{**data['mails'][0], 'id': received.id, 'is_read': True}])
+        self.assertEqual(data['deleted'], {'mails': [], 'drafts': [draft_id]})
+
+        cursor = data['cursor']
+        apply_bulk_action(select_mailbox(self.alice), 'delete')
+        self.assertEqual(self.sync(cursor)['deleted']['mails'], [received.id])
+
+    def test_field_selection_and_paging(self):
+        mails = [self.send(self.bob, self.alice, f'Mail {i}') for i in range(3)]
+        data = self.sync(mail_fields='subject,body,sender', limit=2)
+        self.assertEqual(data['mails'][0], {'id': mails[0].id, 'subject': 'Mail 0', 'body': 'Hi there', 'sender': 'bob'})
+        self.assertTrue(data['has_more'])
+        data = self.sync(data['cursor'], mail_fields='subject', limit=2)
+        self.assertEqual(data['mails'], [{'id': mails[2].id, 'subject': 'Mail 2'}])
+        self.assertFalse(data['has_more'])
+
+        response = self.client.get(reverse('sync_mailbox'), {'mail_fields': 'subject,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('password', response.json()['error'])
+
+    def test_responses_are_gzipped(self):
+        for i in range(20):
+            self.send(self.bob, self.alice, f'Mail {i}')
+        response = self.client.get(reverse('sync_mailbox'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_batch_sends_and_compaction(self):
+        mails, _ = send_to_many(self.bob, self.project, 'All hands', 'Now', all_members=True)
+        self.assertEqual([mail['id'] for mail in self.sync()['mails']], [mails[0].id])
+        mark_mail_read(mails[0])
+
+        removed = changelog.compact()
+        # The read flip supersedes the delivery entries in both mailboxes
+        self.assertEqual(removed, 2)
+        self.assertEqual(MailboxChange.objects.filter(user=self.alice).count(), 1)
+        self.assertEqual([mail['is_read'] for mail in self.sync()['mails']], [True])
+
+    @patch.object(changelog, 'SYNC_OVERLAP_SECONDS', 30)
+    def test_entries_that_commit_late_are_still_synced(self):
+        # Transaction A takes the next change id, then transaction B takes the one after it
+        reserved = MailboxChange.objects.create(user=self.alice, kind=MailboxChange.KIND_MAIL, object_id=0,
+                                                action=MailboxChange.ACTION_UPSERT)
+        MailboxChange.objects.filter(pk=reserved.pk).delete()
+        first = self.send(self.bob, self.alice, 'Committed first')
+        # B commits and the client syncs past both ids
+        data = self.sync()
+        self.assertEqual([mail['id'] for mail in data['mails']], [first.id])
+        cursor = data['cursor']
+        # Only now does A commit, with the lower id
+        late = self.send(self.bob, self.alice, 'Committed late')
+        MailboxChange.objects.filter(user=self.alice, object_id=late.id).update(id=reserved.pk)
+        self.assertLess(reserved.pk, cursor)
+
+        data = self.sync(cursor)
+        self.assertEqual([mail['id'] for mail in data['mails']], [first.id, late.id])
+        self.assertEqual(data['cursor'], cursor)
+        self.assertFalse(data['has_more'])
+
+        # Once the window has passed, the entries aren't sent again
+        MailboxChange.objects.update(created_at=timezone.now() - timedelta(seconds=31))
+        self.assertEqual(self.sync(cursor)['mails'], [])
+
+    def test_deleting_a_user_logs_only_for_the_others(self):
+        mail = self.send(self.bob, self.alice)
+        cursor = self.sync()['cursor']
+        self.bob.delete()
+        self.assertEqual(self.sync(cursor)['deleted']['mails'], [mail.id])
+        self.assertFalse(MailboxChange.objects.filter(user_id=self.bob.id).exists())
+
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, MAIL_SHARED_CACHE=True)
+class MailboxConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def send(self, sender, recipient, subject='Hello'):
+        return Mail.objects.create(sender=sender, recipient=recipient, project=self.project,
+                                   subject=subject, body='Hi there')
+
+    def etag(self, url):
+        # The first visit also hands out the CSRF cookie, which is part of the tag
+        self.client.get(url)
+        return self.client.get(url)['ETag']
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_inbox_is_not_modified(self):
+        self.send(self.bob, self.alice)
+        url = reverse('inbox')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertTrue(response.has_header('Last-Modified'))
+        etag = self.etag(url)
+
+        with self.assertNumQueries(2):  # session and user
+            self.assertEqual(self.revalidate(url, etag).status_code, 304)
+
+    @override_settings(MAIL_SHARED_CACHE=False)
+    def test_no_validators_without_a_shared_cache(self):
+        url = reverse('inbox')
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def test_mailbox_changes_give_a_new_etag(self):
+        mail = self.send(self.bob, self.alice)
+        url = reverse('inbox')
+
+        def assert_changes(change):
+            etag = self.etag(url)
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            self.assertEqual(self.revalidate(url, etag).status_code, 200)
+
+        assert_changes(lambda: self.send(self.bob, self.alice, 'Another'))
+        assert_changes(lambda: mark_mail_read(mail))
+        assert_changes(lambda: self.alice.userprofile.projects.add(
+            Project.objects.create(name='Gemini', created_by=self.bob)))
+        assert_changes(lambda: Project.objects.get(pk=self.project.pk).save())
+
+        def rename():
+            self.alice.first_name = 'Alicia'
+            self.alice.save()
+        assert_changes(rename)
+
+        # Mail between other people leaves alice's pages alone
+        etag = self.etag(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(self.bob, self.bob, 'Note to self')
+        self.assertEqual(self.revalidate(url, etag).status_code, 304)
+
+    def test_sent_and_read_mail_support_etags(self):
+        mail = self.send(self.bob, self.alice)
+        self.send(self.alice, self.bob)
+        for url in (reverse('sent'), reverse('read_mail', args=[mail.id])):
+            with self.captureOnCommitCallbacks(execute=True):
+                etag = self.etag(url)  # reading marks the mail read
+            etag = self.etag(url)
+            self.assertEqual(self.revalidate(url, etag).status_code, 304)
+        # Pages of different mails never share a tag
+        other = self.send(self.bob, self.alice, 'Other')
+        self.assertNotEqual(self.etag(reverse('read_mail', args=[other.id])), etag)
+
+    def test_pages_with_flash_messages_are_always_rendered(self):
+        url = reverse('inbox')
+        etag = self.etag(url)
+        self.client.post(reverse('compose'), {
+            'action': 'send', 'project': self.project.id, 'recipient': self.bob.id, 'subject': 'Hi', 'body': 'Hello',
+        })
+        response = self.revalidate(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Mail sent successfully!')
+        self.assertFalse(response.has_header('ETag'))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def send(self, subject, days_ago=0, sender=None, recipient=None):
+        mail = Mail.objects.create(sender=sender or self.bob, recipient=recipient or self.alice,
+                                   project=self.project, subject=subject, body=f'About {subject.lower()}')
+        if days_ago:
+            Mail.objects.filter(pk=mail.pk).update(sent_at=timezone.now() - timedelta(days=days_ago))
+        return mail
+
+    def test_old_mail_moves_in_resumable_batches(self):
+        old = [self.send(f'Old {i}', days_ago=400) for i in range(5)]
+        mark_mail_read(old[0])
+        recent = self.send('Recent', days_ago=10)
+
+        run = archive(current_run(older_than_days=365), batch_size=2, max_batches=2)
+        self.assertIsNone(run.finished_at)
+        self.assertEqual((run.moved, run.last_id), (4, old[3].id))
+
+        # A later invocation picks the same run back up
+        resumed = current_run(older_than_days=1)
+        self.assertEqual((resumed.pk, resumed.cutoff), (run.pk, run.cutoff))
+        out = StringIO()
+        call_command('archive_mail', batch_size=2, stdout=out)
+        self.assertIn('Done: 5 mail(s) archived', out.getvalue())
+        self.assertFalse(ArchiveRun.objects.filter(finished_at__isnull=True).exists())
+
+        self.assertEqual(list(Mail.objects.values_list('id', flat=True)), [recent.id])
+        archived = ArchivedMail.objects.get(pk=old[0].id)
+        self.assertEqual((archived.subject, archived.body, archived.is_read), ('Old 0', 'About old 0', True))
+        self.assertEqual(archived.thread_id, old[0].thread_id)
+
+        # The hot mailbox no longer counts it, and sync clients see it go
+        counter = MailboxCounter.objects.get(user=self.alice, project=self.project)
+        self.assertEqual((counter.total, counter.unread), (1, 1))
+        deleted = MailboxChange.objects.filter(user=self.alice, action=MailboxChange.ACTION_DELETE)
+        self.assertEqual(deleted.count(), 5)
+
+    def test_archived_mail_is_only_searched_on_request(self):
+        old = self.send('Budget review', days_ago=400)
+        recent = self.send('Budget update')
+        archive(current_run(older_than_days=365))
+
+        response = self.client.get(reverse('inbox'), {'search': 'budget'})
+        self.assertEqual([mail.id for mail in response.context['page_obj']], [recent.id])
+        self.assertEqual(response.context['archived_mails'], [])
+
+        response = self.client.get(reverse('inbox'), {'search': 'budget', 'archive': '1'})
+        self.assertEqual([mail.id for mail in response.context['archived_mails']], [old.id])
+        self.assertContains(response, 'From the archive')
+
+        # Bob sent it, so it is in his sent archive but not his inbox's
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse('sent'), {'search': 'budget', 'archive': '1'})
+        self.assertEqual([mail.id for mail in response.context['archived_mails']], [old.id])
+        response = self.client.get(reverse('inbox'), {'search': 'budget', 'archive': '1'})
+        self.assertEqual(response.context['archived_mails'], [])
+
+    def test_read_mail_falls_back_to_the_archive(self):
+        old = self.send('Ancient', days_ago=400)
+        archive(current_run(older_than_days=365))
+
+        response = self.client.get(reverse('read_mail', args=[old.id]))
+        self.assertContains(response, 'About ancient')
+        self.assertContains(response, 'Archived')
+        self.assertNotContains(response, '?reply_to=')
+
+        self.client.force_login(make_user('mallory', self.project))
+        self.assertRedirects(self.client.get(reverse('read_mail', args=[old.id])), reverse('inbox'),
+                             fetch_redirect_response=False)
+        self.assertEqual(self.client.get(reverse('read_mail', args=[old.id + 100])).status_code, 404)
+
+    def test_replies_keep_their_archived_parent(self):
+        question = self.send('Launch date?', days_ago=400)
+        answer = Mail.objects.create(sender=self.alice, recipient=self.bob, project=self.project,
+                                     subject='Re: Launch date?', body='Friday', in_reply_to=question)
+        draft = Draft.objects.create(author=self.alice, project=self.project, recipient=self.bob,
+                                     subject='Re: Launch date?', body='Or Monday', in_reply_to=question)
+        archive(current_run(older_than_days=365))
+
+        answer.refresh_from_db()
+        draft.refresh_from_db()
+        self.assertEqual((answer.in_reply_to_id, answer.in_reply_to_archived_id), (None, question.id))
+        self.assertEqual((draft.in_reply_to_id, draft.in_reply_to_archived_id), (None, question.id))
+        changes = changelog.changes_since(self.alice, 0, mail_fields=('id', 'in_reply_to_id'),
+                                          draft_fields=('id', 'in_reply_to_id'))
+        self.assertEqual(changes['mails'], [{'id': answer.id, 'in_reply_to_id': question.id}])
+        self.assertEqual(changes['drafts'], [{'id': draft.id, 'in_reply_to_id': question.id}])
+
+        # Sending the draft still joins the archived conversation
+        self.client.post(reverse('edit_draft', args=[draft.id]), {'action': 'send'})
+        sent = Mail.objects.get(subject='Re: Launch date?', content__body='Or Monday')
+        self.assertEqual((sent.in_reply_to_archived_id, sent.thread_id), (question.id, question.thread_id))
+
+        # And an archived reply remembers what it answered
+        Mail.objects.filter(pk=answer.pk).update(sent_at=timezone.now() - timedelta(days=400))
+        archive(current_run(older_than_days=365))
+        self.assertEqual(ArchivedMail.objects.get(pk=answer.pk).in_reply_to_id, question.id)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ExportImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        self.client.force_login(self.alice)
+
+    def send(self, sender, recipient, subject, body='Hi there', **kwargs):
+        return Mail.objects.create(sender=sender, recipient=recipient, project=self.project,
+                                   subject=subject, body=body, **kwargs)
+
+    def test_project_round_trip_remaps_ids(self):
+        question = self.send(self.alice, self.bob, 'Launch date?')
+        self.send(self.bob, self.alice, 'Re: Launch date?', body='From now on, Friday.', in_reply_to=question)
+        old = self.send(self.bob, self.alice, 'Old news')
+        Mail.objects.filter(pk=old.pk).update(sent_at=timezone.now() - timedelta(days=400))
+        archive(current_run(older_than_days=365))
+        Draft.objects.create(author=self.alice, project=self.project, recipient=self.bob, subject='Later', body='...')
+        sent_at = ArchivedMail.objects.get(pk=old.pk).sent_at
+
+        out = StringIO()
+        call_command('export_mail', project='Apollo', chunk_size=2, stdout=out)
+        lines = out.getvalue().splitlines(keepends=True)
+        self.assertEqual([json.loads(line)['type'] for line in lines],
+                         ['export'] + ['user'] * 3 + ['project'] + ['mail'] * 3 + ['draft'])
+
+        # Import into an empty database: everything is recreated under new ids
+        for model in (Draft, ArchivedMail, Mail, Thread, Project, MailboxChange, MailboxCounter):
+            model.objects.all().delete()
+        User.objects.all().delete()
+        stats = import_mailbox(lines, batch_size=2)
+        self.assertEqual(stats, {'users': 3, 'projects': 1, 'mails': 3, 'drafts': 1})
+
+        alice, bob = User.objects.get(username='alice'), User.objects.get(username='bob')
+        project = Project.objects.get(name='Apollo')
+        self.assertEqual(set(project.members.values_list('user__username', flat=True)), {'alice', 'bob'})
+        question = Mail.objects.get(subject='Launch date?')
+        answer = Mail.objects.get(subject='Re: Launch date?')
+        self.assertEqual((question.sender, question.recipient), (alice, bob))
+        self.assertEqual((answer.in_reply_to, answer.thread_id, answer.body), (question, question.thread_id, 'From now on, Friday.'))
+        # Archived mail comes back into the hot table with its original date
+        old = Mail.objects.get(subject='Old news')
+        self.assertEqual(old.sent_at, sent_at)
+        self.assertNotEqual(old.thread_id, question.thread_id)
+        self.assertEqual(Draft.objects.get().recipient, bob)
+        self.assertEqual(search(Mail.objects.all(), 'friday').get(), answer)
+        counter = MailboxCounter.objects.get(user=alice, project=project)
+        self.assertEqual((counter.total, counter.unread), (2, 2))
+
+    def test_download_streams_own_mail(self):
+        self.send(self.bob, self.alice, 'For alice', body='From the team\n>From before')
+        self.send(self.bob, self.bob, 'Not hers')
+        response = self.client.get(reverse('export_mail'), {'format': 'mbox'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment', response['Content-Disposition'])
+        mbox = b''.join(response.streaming_content).decode()
+        self.assertTrue(mbox.startswith('From bob '))
+        self.assertIn('Subject: For alice', mbox)
+        self.assertIn('\n>From the team\n>>From before\n', mbox)
+        self.assertNotIn('Not hers', mbox)
+
+        response = self.client.get(reverse('export_mail'), {'format': 'jsonl', 'project': self.project.id})
+        records = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([r['subject'] for r in records if r['type'] == 'mail'], ['For alice'])
+
+        other = Project.objects.create(name='Gemini', created_by=self.bob)
+        self.assertEqual(self.client.get(reverse('export_mail'), {'project': other.id}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('export_mail'), {'format': 'pst'}).status_code, 400)
+
+    def test_keyset_batches_without_server_side_cursors(self):
+        for i in range(5):
+            self.send(self.bob if i % 2 else self.alice, self.alice if i % 2 else self.bob, f'Note {i}')
+        scope = ExportScope(user=self.alice)
+        expected = list(scope.mail_rows(chunk_size=2))
+        with patch.dict(connection.settings_dict, DISABLE_SERVER_SIDE_CURSORS=True):
+            with CaptureQueriesContext(connection) as captured:
+                rows = list(scope.mail_rows(chunk_size=2))
+        self.assertEqual(rows, expected)
+        self.assertEqual(len(rows), 5)
+        # Three batches of hot mail (2, 2, 1) and one for the empty archive
+        self.assertEqual(len(captured), 4)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class BenchmarkTests(TestCase):
+    def test_generated_data_is_skewed_and_consistent(self):
+        dataset = generate_dataset(400, users=20, projects=4, seed=1, chunk_size=150)
+        mails = Mail.objects.filter(project__in=dataset.projects)
+        self.assertEqual(mails.count(), 400)
+        # Everyone mails within projects they belong to
+        self.assertFalse(mails.exclude(recipient__userprofile__projects=F('project')).exists())
+        self.assertFalse(mails.exclude(sender__userprofile__projects=F('project')).exists())
+        # Replies stay in their conversation, and a few people get most of the mail
+        replies = mails.filter(in_reply_to__isnull=False)
+        self.assertTrue(replies.exists())
+        self.assertFalse(replies.exclude(thread=F('in_reply_to__thread')).exists())
+        received = sorted(mails.values('recipient').annotate(n=Count('id')).values_list('n', flat=True))
+        self.assertGreater(received[-1], 3 * received[len(received) // 2])
+        self.assertEqual(counters.reconcile(), 0)
+        self.assertEqual(
+            generate_dataset(50, users=10, projects=2, seed=1).busiest.username.split('-')[1],
+            generate_dataset(50, users=10, projects=2, seed=1).busiest.username.split('-')[1],
+        )
+
+    def test_command_saves_and_compares_a_baseline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            call_command('benchmark_views', sizes='200', repeat=2, save=path, stdout=StringIO())
+            with open(path) as baseline:
+                saved = json.load(baseline)
+            self.assertEqual(set(saved['results']['200']),
+                             {'inbox', 'inbox_search', 'inbox_threads', 'sent', 'read_mail', 'compose',
+                              'compose_send', 'project_users'})
+
+        saved = saved['results']
+        lines, regressions = compare(saved, saved, tolerance=0.25)
+        self.assertEqual(regressions, 0)
+        worse = {'200': {**saved['200'], 'inbox': {**saved['200']['inbox'], 'queries': saved['200']['inbox']['queries'] + 1}}}
+        lines, regressions = compare(saved, worse, tolerance=0.25)
+        self.assertEqual(regressions, 1)
+        self.assertIn('REGRESSION', [line for line in lines if 'inbox ' in line][0])
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+        Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project, subject='Hello', body='Hi')
+
+    def setUp(self):
+        profiling.metrics.reset()
+        self.client.force_login(self.alice)
+
+    def test_server_timing_matches_the_queries_run(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('inbox'))
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertIn(f'desc="{len(captured)} queries"', timing['db'])
+        self.assertGreater(float(timing['tpl'].split('=')[1]), 0)
+        self.assertEqual(set(timing), {'total', 'db', 'tpl', 'ai'})
+
+    @override_settings(MAIL_SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('mailapp.profiling', 'WARNING') as logs:
+            self.client.get(reverse('inbox'))
+        self.assertIn('(inbox)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_metrics_are_staff_only_histograms_per_view(self):
+        self.client.get(reverse('inbox'))
+        self.client.get(reverse('inbox'))
+        self.assertEqual(self.client.get(reverse('ops_metrics')).status_code, 403)
+
+        self.client.force_login(User.objects.create_user(username='ops', is_staff=True))
+        body = self.client.get(reverse('ops_metrics')).content.decode()
+        self.assertIn('mailapp_request_duration_seconds_bucket{view="inbox",le="+Inf"} 2', body)
+        self.assertIn('mailapp_request_duration_seconds_count{view="inbox"} 2', body)
+        self.assertIn('mailapp_request_queries_bucket{view="inbox",le="+Inf"} 2', body)
+        self.assertIn('mailapp_request_component_seconds_total{view="inbox",component="template"}', body)
+        self.assertIn('mailapp_rate_limit_requests_total{limit="compose",outcome="allowed"}', body)
+
+    def test_ai_time_is_attributed_to_the_request(self):
+        profile = profiling.RequestProfile()
+        token = profiling._current.set(profile)
+        try:
+            with override_settings(AI_DRAFT_BACKEND='mailapp.ai.FakeBackend'), patch.object(ai, '_backend', None):
+                cache.clear()
+                ai.generate_draft('slow model')
+        finally:
+            profiling._current.reset(token)
+        self.assertGreater(profile.seconds['ai'], 0)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class QueryReportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+        for subject in ('One', 'Two', 'Three'):
+            Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project, subject=subject, body='Hi')
+
+    def test_duplicates_and_repeats_point_at_their_line(self):
+        inspector = QueryInspector()
+        token = profiling._current.set(profiling.RequestProfile(inspector))
+        try:
+            for _ in range(2):
+                Project.objects.get(pk=self.project.pk)
+            for mail_id in Mail.objects.values_list('id', flat=True):
+                Mail.objects.get(pk=mail_id)
+        finally:
+            profiling._current.reset(token)
+
+        findings = inspector.findings()
+        [duplicate] = findings['duplicates']
+        self.assertEqual(duplicate['count'], 2)
+        self.assertIn('FROM "mailapp_project"', duplicate['sql'])
+        self.assertTrue(duplicate['origins'][0][0].startswith('mailapp/tests.py:'))
+        [repeat] = findings['repeats']
+        self.assertEqual(repeat['count'], 3)
+        self.assertIn('"mailapp_mail"."id" = %s', repeat['sql'])
+        self.assertEqual(fingerprint('SELECT 1 WHERE a IN (%s, %s) AND b = \'x\''), 'SELECT ? WHERE a IN (...) AND b = ?')
+
+    def test_report_file_and_summary(self):
+        self.client.force_login(self.alice)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'queries.jsonl')
+            with override_settings(MAIL_QUERY_REPORT=path, MAIL_QUERY_EXPLAIN_MS=0):
+                self.client.get(reverse('inbox'))
+            with open(path) as report:
+                [record] = [json.loads(line) for line in report]
+            self.assertEqual(record['view'], 'inbox')
+            selects = [finding for finding in record['slow'] if finding['sql'].startswith('SELECT')]
+            self.assertTrue(selects)
+            self.assertTrue(all(finding['plan'] for finding in selects))
+
+            out = StringIO()
+            call_command('query_report', path, stdout=out)
+            self.assertIn('mailapp/counters.py', out.getvalue())
+            with self.assertRaises(CommandError):
+                call_command('query_report', path, fail_on_findings=True, stdout=StringIO())
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ProfileProvisioningTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+        Mail.objects.create(sender=cls.bob, recipient=cls.alice, project=cls.project, subject='Hello', body='Hi')
+
+    def assertNoWrites(self, captured):
+        writes = [q['sql'] for q in captured if q['sql'].split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE')]
+        self.assertEqual(writes, [])
+
+    def test_steady_state_inbox_get_writes_nothing(self):
+        self.client.force_login(self.alice)
+        self.client.get(reverse('inbox'))
+        for url in (reverse('inbox'), reverse('inbox') + '?view=threads', reverse('sent'), reverse('compose')):
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertNoWrites(captured)
+
+    def test_saving_a_user_leaves_the_profile_alone(self):
+        self.alice.last_login = timezone.now()
+        with CaptureQueriesContext(connection) as captured:
+            self.alice.save(update_fields=['last_login'])
+        self.assertEqual(len(captured), 1)
+
+    def test_login_provisions_a_default_project_once(self):
+        carol = User.objects.create_user(username='carol', password='pass12345')
+        self.assertFalse(carol.userprofile.projects.exists())
+        for _ in range(2):
+            self.client.post(reverse('login'), {'username': 'carol', 'password': 'pass12345'}, secure=True)
+        self.assertEqual(list(carol.userprofile.projects.values_list('name', flat=True)), ["carol's Project"])
+
+        # The inbox itself no longer creates one
+        carol.userprofile.projects.clear()
+        self.client.get(reverse('inbox'))
+        self.assertFalse(carol.userprofile.projects.exists())
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def make_pool(self, **kwargs):
+        self.opened, self.closed = [], []
+
+        def connect():
+            self.opened.append(object())
+            return self.opened[-1]
+        return ConnectionPool(connect, close=self.closed.append, **kwargs)
+
+    def test_connections_are_reused_and_bounded(self):
+        pool = self.make_pool(max_size=2, timeout=0.05)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+
+        # A waiting request gets the next connection given back
+        threading.Timer(0.01, pool.release, [first]).start()
+        pool.timeout = 5
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_broken_and_old_connections_are_replaced(self):
+        pool = self.make_pool(reset=lambda connection: 1 / 0)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertEqual(self.closed, [first])
+        self.assertIsNot(pool.acquire(), first)
+
+        pool = self.make_pool(max_age=0)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertEqual(self.closed, [first])
+
+        failures = []
+        pool = self.make_pool(check=lambda connection: failures.append(connection) or 1 / 0, check_after=0)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIsNot(pool.acquire(), first)
+        self.assertEqual(failures, [first])
+        self.assertEqual(pool.stats(), {'size': 1, 'idle': 0, 'in_use': 1})
+
+    def test_prewarm_opens_the_minimum(self):
+        pool = self.make_pool(min_size=3)
+        self.assertEqual(pool.prewarm(), 3)
+        self.assertEqual(pool.prewarm(), 0)
+        self.assertEqual(pool.stats(), {'size': 3, 'idle': 3, 'in_use': 0})
+        pool.close_idle()
+        self.assertEqual(len(self.closed), 3)
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+@override_settings(
+    SECURE_SSL_REDIRECT=False, DATABASE_REPLICAS=['replica'], MAIL_REPLICA_MAX_LAG=5, MAIL_REPLICA_CHECK_SECONDS=5,
+)
+class ReplicaRoutingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(name='Apollo', created_by=User.objects.create_user(username='owner'))
+        cls.alice = make_user('alice', cls.project)
+        cls.bob = make_user('bob', cls.project)
+
+    def setUp(self):
+        cache.clear()
+        replicas.health.reset()
+        self.addCleanup(replicas.health.reset)
+
+    def route(self, view, method='GET', pinned=False):
+        """Run ``view`` the way ReplicaMiddleware and replica_reads would"""
+        token = replicas._routing.set(replicas.RoutingState(pinned=pinned))
+        try:
+            return replicas.replica_reads(view)(RequestFactory().generic(method, '/'))
+        finally:
+            replicas._routing.reset(token)
+
+    def read(self, **kwargs):
+        """The database a view's reads would go to"""
+        used = []
+
+        def view(request):
+            used.append(router.db_for_read(Mail))
+            return HttpResponse()
+        self.route(view, **kwargs)
+        return used[0]
+
+    def test_read_only_views_read_from_a_replica_until_the_request_writes(self):
+        used = []
+
+        def view(request):
+            used.append(router.db_for_read(Mail))
+            router.db_for_write(Mail)
+            used.append(router.db_for_read(Mail))
+            return HttpResponse()
+
+        with patch('mailapp.replicas.replica_lag', return_value=0.5):
+            self.route(view)
+            self.assertEqual(used, ['replica', 'default'])
+            # Outside replica_reads, and for other methods or pinned browsers, reads stay on the primary
+            self.assertEqual(router.db_for_read(Mail), 'default')
+            self.assertEqual(self.read(method='POST'), 'default')
+            self.assertEqual(self.read(pinned=True), 'default')
+
+    def test_lagging_or_unreachable_replicas_fall_back_to_the_primary(self):
+        with patch('mailapp.replicas.replica_lag', return_value=30.0), self.assertLogs('mailapp.replicas', 'WARNING'):
+            self.assertEqual(self.read(), 'default')
+        replicas.health.reset()
+        with patch('mailapp.replicas.replica_lag', side_effect=OperationalError('could not connect')), \
+                self.assertLogs('mailapp.replicas', 'WARNING'):
+            self.assertEqual(self.read(), 'default')
+
+        # The result is kept until the next check is due
+        with patch('mailapp.replicas.replica_lag', return_value=0.0) as lag:
+            self.assertEqual(self.read(), 'default')
+            lag.assert_not_called()
+
+    def test_a_view_that_loses_its_replica_runs_again_on_the_primary(self):
+        used = []
+
+        def view(request):
+            used.append(router.db_for_read(Mail))
+            if used[-1] == 'replica':
+                raise OperationalError('server closed the connection unexpectedly')
+            return HttpResponse('ok')
+
+        with patch('mailapp.replicas.replica_lag', return_value=0.0), self.assertLogs('mailapp.replicas', 'WARNING'):
+            self.assertEqual(self.route(view).content, b'ok')
+            self.assertEqual(used, ['replica', 'default'])
+            # Later requests skip it until it is checked again
+            self.assertEqual(self.read(), 'default')
+
+    def test_replica_pages_only_keep_validators_for_settled_changes(self):
+        def page(age):
+            def view(request):
+                response = HttpResponse('page')
+                response['ETag'] = '"v1"'
+                response['Last-Modified'] = http_date(time.time() - age)
+                return response
+            return view
+
+        with patch('mailapp.replicas.replica_lag', return_value=0.0):
+            recent = self.route(page(2))
+            settled = self.route(page(60))
+        self.assertNotIn('ETag', recent)
+        self.assertNotIn('Last-Modified', recent)
+        self.assertEqual(settled['ETag'], '"v1"')
+
+    def test_writes_pin_the_browser_to_the_primary(self):
+        self.client.force_login(self.alice)
+        # Every replica is too far behind, so the inbox itself is served by the primary
+        with patch('mailapp.replicas.replica_lag', return_value=60.0), self.assertLogs('mailapp.replicas', 'WARNING'):
+            response = self.client.get(reverse('inbox'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+        response = self.client.post(reverse('compose'), {
+            'action': 'send', 'recipient': self.bob.id, 'project': self.project.id, 'subject': 'Hi', 'body': 'Yo',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies[replicas.PIN_COOKIE]['max-age'], settings.MAIL_REPLICA_PIN_SECONDS)
+
+        # The pinned sent page doesn't even look at the replicas, and shows the new mail
+        with patch('mailapp.replicas.replica_lag') as lag:
+            response = self.client.get(reverse('sent'))
+        lag.assert_not_called()
+        self.assertContains(response, 'Hi')
+
+    def test_views_that_must_see_the_latest_mail_stay_on_the_primary(self):
+        mail = Mail.objects.create(sender=self.bob, recipient=self.alice, project=self.project, subject='Hi', body='Yo')
+        self.client.force_login(self.alice)
+        for url, routed in [
+            (reverse('drafts'), True),
+            (reverse('sync_mailbox'), True),
+            # Marks the conversation read
+            (reverse('read_thread', args=[mail.thread_id]), False),
+            # Asked for right after a new-mail push, when a replica is most likely behind
+            (reverse('mail_since'), False),
+        ]:
+            with self.subTest(url=url), patch('mailapp.replicas.choose_replica', return_value=None) as choose:
+                self.client.cookies.pop(replicas.PIN_COOKIE, None)
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertEqual(choose.called, routed)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas_nothing_is_pinned(self):
+        self.client.force_login(self.alice)
+        response = self.client.post(reverse('compose'), {
+            'action': 'send', 'recipient': self.bob.id, 'project': self.project.id, 'subject': 'Hi', 'body': 'Yo',
+        })
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
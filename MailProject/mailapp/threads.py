@@ -0,0 +1,88 @@
+"""
+Conversation threading.
+
+Every Mail belongs to a Thread. A reply or forward (``in_reply_to`` set)
+joins the thread of the mail it answers, archived or not; anything else
+starts a new one.
+The threaded inbox is a single grouped query over the recipient's mail,
+served by the (recipient, thread, sent_at, is_read) index, and opening a
+conversation is a range scan of the (thread, sent_at, id) index.
+"""
+from django.db.models import Count, Max, Q
+from django.utils import dateformat, timezone
+
+from .models import ArchivedMail, Mail, Thread
+
+REPLY_PREFIX = 'Re: '
+FORWARD_PREFIX = 'Fwd: '
+
+
+def start_thread(subject, project):
+    return Thread.objects.create(subject=subject, project=project)
+
+
+def assign_thread(mail):
+    """Put a mail that has no thread yet into the right one"""
+    if mail.thread_id is not None:
+        return
+    if mail.in_reply_to_id is not None:
+        mail.thread_id = Mail.objects.filter(pk=mail.in_reply_to_id).values_list('thread_id', flat=True).get()
+    elif mail.in_reply_to_archived_id is not None:
+        mail.thread_id = ArchivedMail.objects.filter(
+            pk=mail.in_reply_to_archived_id,
+        ).values_list('thread_id', flat=True).get()
+    else:
+        mail.thread = start_thread(mail.subject, mail.project)
+
+
+def prefixed(prefix, subject):
+    """'Re: ' + subject, without piling up 'Re: Re: Re: '"""
+    return subject if subject.lower().startswith(prefix.lower()) else f'{prefix}{subject}'
+
+
+def quote(mail, forward=False):
+    """Body text that quotes ``mail`` for a reply or forward"""
+    lines = ['', '', '--- Forwarded Message ---' if forward else '--- Original Message ---']
+    lines.append(f'From: {mail.sender.get_full_name() or mail.sender.username}')
+    if forward:
+        lines.append(f'To: {mail.recipient.get_full_name() or mail.recipient.username}')
+    lines += [f'Sent: {dateformat.format(timezone.localtime(mail.sent_at), "F d, Y g:i A")}', f'Subject: {mail.subject}', '', mail.body]
+    return '\n'.join(lines)
+
+
+def participant_mail(user):
+    return Mail.objects.filter(Q(sender=user) | Q(recipient=user))
+
+
+def threaded_mailbox(user, project_id=None):
+    """
+    One row per thread that ``user`` has received mail in, annotated with
+    ``latest_at``, ``latest_id``, ``message_count`` and ``unread_count``
+    over their received mail. Order by ('-latest_at', '-id').
+    """
+    received = Q(mails__recipient=user)
+    if project_id is not None:
+        received &= Q(mails__project_id=project_id)
+    # The filter and the aggregates share one join, so only the user's mail is counted
+    return Thread.objects.filter(received).annotate(
+        latest_at=Max('mails__sent_at'),
+        latest_id=Max('mails__id'),
+        message_count=Count('mails'),
+        unread_count=Count('mails', filter=Q(mails__is_read=False)),
+    )
+
+
+def attach_latest(threads):
+    """Load the newest received mail of each thread on a page in one query"""
+    latest = Mail.objects.filter(id__in=[thread.latest_id for thread in threads]).for_list().in_bulk()
+    for thread in threads:
+        # Ids grow with sent_at, so the highest id is the newest message
+        thread.latest = latest.get(thread.latest_id)
+    return threads
+
+
+def thread_messages(thread_id, user):
+    """The messages of a thread that ``user`` sent or received, oldest first"""
+    return participant_mail(user).filter(thread_id=thread_id).select_related(
+        'sender', 'recipient', 'project', 'content',
+    ).order_by('sent_at', 'id')
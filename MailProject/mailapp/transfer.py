@@ -0,0 +1,455 @@
+"""
+Exporting and importing mailboxes.
+
+An export is a stream. A user's or a project's mail and drafts are read
+with ``QuerySet.iterator(chunk_size=...)`` (in keyset batches where
+server-side cursors are disabled) and written out one record at a time, so
+memory stays flat however big the mailbox is. There are two formats:
+
+* ``jsonl``: JSON Lines with a header, every user and project the mail
+  refers to, the mail ordered by conversation, then the drafts. This is
+  what ``import_mail`` reads.
+* ``mbox``: mail only, one RFC 5322 message each with mboxrd quoting, for
+  mail clients.
+
+Hot and archived mail are merged into one stream ordered by (thread,
+sent_at, id). A conversation's messages therefore arrive together, and the
+importer only keeps the current conversation's ids in memory to rebuild
+threads and reply links.
+
+The importer maps users by username and projects by name, creating
+whatever is missing. It inserts mail and drafts with ``bulk_create`` in
+batches, one transaction each. bulk_create skips the model signals, so
+content, search documents, counters and change log entries are written
+here, as batch_send does. Archived mail is imported into the hot table,
+and the next ``archive_mail`` run moves it back by its original date.
+Draft reply links are not exported.
+"""
+import heapq
+import itertools
+import json
+import re
+from contextlib import contextmanager
+from email.message import EmailMessage
+from email.utils import format_datetime, formataddr
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import changelog, counters, directory
+from .autosave import draft_content_hash
+from .content import intern_contents, use_content
+from .mailbox_cache import invalidate_mailboxes
+from .models import ArchivedMail, Draft, Mail, Project, Thread, UserProfile
+from .pagination import keyset_rows
+from .search import build_draft_document, build_mail_document
+
+EXPORT_FORMATS = ('jsonl', 'mbox')
+EXPORT_CONTENT_TYPES = {'jsonl': 'application/x-ndjson', 'mbox': 'application/mbox'}
+EXPORT_VERSION = 1
+EXPORT_CHUNK_SIZE = 2000
+IMPORT_BATCH_SIZE = 1000
+# Domain for addresses of users without an email, and for Message-IDs
+MBOX_DOMAIN = 'flowmail.invalid'
+
+USER_VALUES = ('id', 'username', 'email', 'first_name', 'last_name')
+MAIL_VALUES = ('id', 'thread_id', 'in_reply_to_id', 'sender_id', 'recipient_id', 'project_id',
+               'subject', 'content__body', 'sent_at', 'is_read')
+DRAFT_VALUES = ('id', 'author_id', 'project_id', 'recipient_id', 'subject', 'content__body',
+                'created_at', 'updated_at')
+MAIL_ORDER = ('thread_id', 'sent_at', 'id')
+
+
+class InvalidExport(Exception):
+    pass
+
+
+class ExportScope:
+    """The mail, drafts, users and projects of one user's mailbox, one project, or one user within one project"""
+
+    def __init__(self, user=None, project=None):
+        if user is None and project is None:
+            raise ValueError('Export a user, a project or both')
+        mail_filter = Q()
+        if user is not None:
+            mail_filter &= Q(sender=user) | Q(recipient=user)
+        if project is not None:
+            mail_filter &= Q(project=project)
+        self.mails = Mail.objects.filter(mail_filter)
+        self.archived = ArchivedMail.objects.filter(mail_filter)
+
+        drafts = Draft.objects.all()
+        # Memberships travel with the export: the user's own, or everyone's in the project
+        memberships = UserProfile.projects.through.objects.all()
+        if user is not None:
+            drafts = drafts.filter(author=user)
+            memberships = memberships.filter(userprofile__user=user)
+        if project is not None:
+            drafts = drafts.filter(project=project)
+            memberships = memberships.filter(project=project)
+        self.drafts = drafts
+        self.memberships = memberships
+
+        self.projects = Project.objects.filter(
+            Q(id__in=self.mails.values('project_id')) | Q(id__in=self.archived.values('project_id'))
+            | Q(id__in=drafts.values('project_id')) | Q(id__in=memberships.values('project_id'))
+        )
+        self.users = User.objects.filter(
+            Q(id__in=self.mails.values('sender_id')) | Q(id__in=self.mails.values('recipient_id'))
+            | Q(id__in=self.archived.values('sender_id')) | Q(id__in=self.archived.values('recipient_id'))
+            | Q(id__in=drafts.values('author_id')) | Q(id__in=drafts.values('recipient_id'))
+            | Q(id__in=memberships.values('userprofile__user_id'))
+            | Q(id__in=self.projects.values('created_by_id'))
+        )
+
+    def user_rows(self, chunk_size=EXPORT_CHUNK_SIZE):
+        return _rows(self.users.values(*USER_VALUES), ('id',), chunk_size)
+
+    def mail_rows(self, chunk_size=EXPORT_CHUNK_SIZE):
+        """Hot and archived mail as one stream, a conversation at a time"""
+        return heapq.merge(
+            _with_archived_parents(
+                _rows(self.mails.values(*MAIL_VALUES, 'in_reply_to_archived_id'), MAIL_ORDER, chunk_size),
+            ),
+            _rows(self.archived.values(*MAIL_VALUES), MAIL_ORDER, chunk_size),
+            key=itemgetter(*MAIL_ORDER),
+        )
+
+    def draft_rows(self, chunk_size=EXPORT_CHUNK_SIZE):
+        return _rows(self.drafts.values(*DRAFT_VALUES), ('id',), chunk_size)
+
+
+def _with_archived_parents(rows):
+    # Hot replies to archived mail keep the parent's id in a column of its own
+    for row in rows:
+        archived_parent = row.pop('in_reply_to_archived_id')
+        if row['in_reply_to_id'] is None:
+            row['in_reply_to_id'] = archived_parent
+        yield row
+
+
+def _rows(queryset, ordering, chunk_size):
+    # One consistent read through a server-side cursor where there is one; behind a
+    # transaction-pooling pgbouncer there isn't, so read in keyset batches instead
+    if connections[queryset.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+        return keyset_rows(queryset, ordering, chunk_size)
+    return queryset.order_by(*ordering).iterator(chunk_size=chunk_size)
+
+
+def _json_line(record):
+    return json.dumps(record, separators=(',', ':'), default=lambda value: value.isoformat()) + '\n'
+
+
+def export_jsonl(scope, chunk_size=EXPORT_CHUNK_SIZE):
+    yield _json_line({'type': 'export', 'version': EXPORT_VERSION})
+    for row in scope.user_rows(chunk_size):
+        yield _json_line({'type': 'user', **row})
+    for project in scope.projects.order_by('id').iterator(chunk_size=chunk_size):
+        members = scope.memberships.filter(project=project).values_list('userprofile__user_id', flat=True)
+        yield _json_line({
+            'type': 'project', 'id': project.id, 'name': project.name, 'description': project.description,
+            'created_by': project.created_by_id, 'created_at': project.created_at, 'members': list(members),
+        })
+    for row in scope.mail_rows(chunk_size):
+        yield _json_line({
+            'type': 'mail', 'id': row['id'], 'thread': row['thread_id'], 'in_reply_to': row['in_reply_to_id'],
+            'sender': row['sender_id'], 'recipient': row['recipient_id'], 'project': row['project_id'],
+            'subject': row['subject'], 'body': row['content__body'], 'sent_at': row['sent_at'],
+            'is_read': row['is_read'],
+        })
+    for row in scope.draft_rows(chunk_size):
+        yield _json_line({
+            'type': 'draft', 'id': row['id'], 'author': row['author_id'], 'project': row['project_id'],
+            'recipient': row['recipient_id'], 'subject': row['subject'], 'body': row['content__body'],
+            'created_at': row['created_at'], 'updated_at': row['updated_at'],
+        })
+
+
+def _address(user):
+    name = f"{user['first_name']} {user['last_name']}".strip()
+    return formataddr((name, user['email'] or f"{user['username']}@{MBOX_DOMAIN}"))
+
+
+def mbox_message(row, users, project_names):
+    """One mail as an mbox entry: the From_ line, the message, and a blank line"""
+    sender, recipient = users[row['sender_id']], users[row['recipient_id']]
+    message = EmailMessage()
+    message['From'] = _address(sender)
+    message['To'] = _address(recipient)
+    message['Subject'] = row['subject']
+    message['Date'] = format_datetime(row['sent_at'])
+    message['Message-ID'] = f"<{row['id']}@{MBOX_DOMAIN}>"
+    if row['in_reply_to_id']:
+        message['In-Reply-To'] = f"<{row['in_reply_to_id']}@{MBOX_DOMAIN}>"
+    message['X-FlowMail-Project'] = project_names[row['project_id']]
+    message['X-FlowMail-Thread'] = str(row['thread_id'])
+    if row['is_read']:
+        message['Status'] = 'RO'
+    message.set_content(row['content__body'] or '')
+    # mboxrd: any line that looks like a From_ line gets one more '>'
+    text = re.sub(r'^(>*From )', r'>\1', message.as_string(), flags=re.MULTILINE)
+    from_line = f"From {sender['email'] or sender['username']} {row['sent_at']:%a %b %d %H:%M:%S %Y}\n"
+    return f'{from_line}{text.rstrip(chr(10))}\n\n'
+
+
+def export_mbox(scope, chunk_size=EXPORT_CHUNK_SIZE):
+    # Only the people and projects involved are held, never the mail
+    users = {row['id']: row for row in scope.user_rows(chunk_size)}
+    project_names = dict(scope.projects.values_list('id', 'name'))
+    for row in scope.mail_rows(chunk_size):
+        yield mbox_message(row, users, project_names)
+
+
+def export_mailbox(scope, fmt, chunk_size=EXPORT_CHUNK_SIZE):
+    if fmt == 'mbox':
+        return export_mbox(scope, chunk_size)
+    if fmt == 'jsonl':
+        return export_jsonl(scope, chunk_size)
+    raise ValueError(f'Unknown export format: {fmt}')
+
+
+async def iterate_in_thread(iterator, batch_size=100):
+    """
+    Serve a sync iterator that reads the database from an ASGI response.
+    Django 4.2 turns a sync iterator into a list before streaming it under
+    ASGI, which would hold a whole export in memory; this hands it over in
+    batches instead, always from the same thread as the database connection.
+    A stream that has to go out as it is produced uses ``batch_size=1``.
+    Closing this closes ``iterator`` too.
+    """
+    next_batch = sync_to_async(lambda: list(itertools.islice(iterator, batch_size)))
+    try:
+        while True:
+            batch = await next_batch()
+            if not batch:
+                return
+            for item in batch:
+                yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            await sync_to_async(iterator.close)()
+
+
+@contextmanager
+def original_timestamps():
+    """
+    Let bulk_create keep the timestamps an import brings along instead of
+    stamping auto_now/auto_now_add fields with the current time. This
+    changes the model fields for the whole process, so it is only used by
+    the import command.
+    """
+    fields = [
+        Mail._meta.get_field('sent_at'), Thread._meta.get_field('created_at'),
+        Project._meta.get_field('created_at'),
+        Draft._meta.get_field('created_at'), Draft._meta.get_field('updated_at'),
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class MailImporter:
+    """Takes export records in order and writes them in batches, see import_mailbox"""
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        # Exported id -> saved row
+        self.users = {}
+        self.projects = {}
+        self.user_records = []
+        self.project_records = []
+        self.header_done = False
+        self.mail_records = []
+        self.draft_records = []
+        # The conversation being imported: its new Thread and its mails by exported id
+        self.thread_key = None
+        self.thread = None
+        self.thread_mails = {}
+        self.stats = {'users': 0, 'projects': 0, 'mails': 0, 'drafts': 0}
+
+    def feed(self, record):
+        kind = record.get('type')
+        if kind == 'export':
+            if record.get('version') != EXPORT_VERSION:
+                raise InvalidExport(f"Unsupported export version: {record.get('version')!r}")
+        elif kind in ('user', 'project'):
+            if self.header_done:
+                raise InvalidExport('Users and projects must come before mail and drafts')
+            (self.user_records if kind == 'user' else self.project_records).append(record)
+        elif kind == 'mail':
+            self.finish_header()
+            self.mail_records.append(record)
+            if len(self.mail_records) >= self.batch_size:
+                self.flush_mails()
+        elif kind == 'draft':
+            self.finish_header()
+            self.draft_records.append(record)
+            if len(self.draft_records) >= self.batch_size:
+                self.flush_drafts()
+        else:
+            raise InvalidExport(f'Unknown record type: {kind!r}')
+
+    def finish(self):
+        self.finish_header()
+        self.flush_mails()
+        self.flush_drafts()
+        return self.stats
+
+    def lookup(self, mapping, exported_id, what):
+        try:
+            return mapping[exported_id]
+        except KeyError:
+            raise InvalidExport(f'Unknown {what} id {exported_id!r}') from None
+
+    def finish_header(self):
+        if self.header_done:
+            return
+        self.header_done = True
+        with transaction.atomic():
+            self.import_users()
+            self.import_projects()
+
+    def import_users(self):
+        for start in range(0, len(self.user_records), self.batch_size):
+            records = self.user_records[start:start + self.batch_size]
+            existing = {user.username: user for user in User.objects.filter(username__in=[r['username'] for r in records])}
+            created = []
+            for record in records:
+                user = existing.get(record['username'])
+                if user is None:
+                    user = User(username=record['username'], email=record['email'] or '',
+                                first_name=record['first_name'] or '', last_name=record['last_name'] or '')
+                    user.set_unusable_password()
+                    created.append(user)
+                self.users[record['id']] = user
+            User.objects.bulk_create(created)
+            UserProfile.objects.bulk_create([UserProfile(user=user) for user in created])
+            self.stats['users'] += len(created)
+        self.user_records = []
+
+    def import_projects(self):
+        records = self.project_records
+        existing = {project.name: project for project in Project.objects.filter(name__in=[r['name'] for r in records])}
+        created = []
+        for record in records:
+            project = existing.get(record['name'])
+            if project is None:
+                project = Project(name=record['name'], description=record['description'] or '',
+                                  created_by=self.lookup(self.users, record['created_by'], 'user'),
+                                  created_at=parse_datetime(record['created_at']))
+                created.append(project)
+            self.projects[record['id']] = project
+        Project.objects.bulk_create(created)
+        self.stats['projects'] += len(created)
+
+        # Memberships bypass the m2m signals, so the caches they keep are dropped here
+        memberships = [
+            (self.lookup(self.users, user_id, 'user').id, self.projects[record['id']].id)
+            for record in records for user_id in record['members']
+        ]
+        member_ids = {user_id for user_id, _ in memberships}
+        profiles = dict(UserProfile.objects.filter(user_id__in=member_ids).values_list('user_id', 'id'))
+        Through = UserProfile.projects.through
+        Through.objects.bulk_create(
+            [Through(userprofile_id=profiles[user_id], project_id=project_id) for user_id, project_id in memberships],
+            ignore_conflicts=True,
+        )
+        project_ids = [project.id for project in self.projects.values()]
+        transaction.on_commit(lambda: [directory.invalidate_project(project_id) for project_id in project_ids])
+        transaction.on_commit(lambda: invalidate_mailboxes(member_ids))
+        self.project_records = []
+
+    def flush_mails(self):
+        records, self.mail_records = self.mail_records, []
+        if not records:
+            return
+        contents = intern_contents({(record['subject'], record['body'] or '') for record in records})
+        threads, mails, replies = [], [], []
+        for record in records:
+            project = self.lookup(self.projects, record['project'], 'project')
+            sent_at = parse_datetime(record['sent_at'])
+            if record['thread'] != self.thread_key:
+                self.thread_key = record['thread']
+                self.thread = Thread(project=project, subject=record['subject'], created_at=sent_at)
+                self.thread_mails = {}
+                threads.append(self.thread)
+            mail = Mail(
+                sender=self.lookup(self.users, record['sender'], 'user'),
+                recipient=self.lookup(self.users, record['recipient'], 'user'),
+                project=project, subject=record['subject'], thread=self.thread,
+                sent_at=sent_at, is_read=record['is_read'],
+            )
+            use_content(mail, contents[(record['subject'], record['body'] or '')])
+            mail.search_document = build_mail_document(mail)
+            parent = self.thread_mails.get(record['in_reply_to'])
+            if parent is not None:
+                if parent.pk is not None:
+                    mail.in_reply_to = parent
+                else:
+                    # Answers a mail in this same batch, linked once both have ids
+                    replies.append((mail, parent))
+            self.thread_mails[record['id']] = mail
+            mails.append(mail)
+
+        with transaction.atomic():
+            Thread.objects.bulk_create(threads)
+            Mail.objects.bulk_create(mails)
+            for mail, parent in replies:
+                mail.in_reply_to = parent
+            Mail.objects.bulk_update([mail for mail, _ in replies], ['in_reply_to'])
+            counters.record_delivered(mails)
+            changelog.record(changelog.mail_changes(mails))
+        self.stats['mails'] += len(mails)
+
+    def flush_drafts(self):
+        records, self.draft_records = self.draft_records, []
+        if not records:
+            return
+        contents = intern_contents({(record['subject'], record['body'] or '') for record in records})
+        drafts = []
+        for record in records:
+            draft = Draft(
+                author=self.lookup(self.users, record['author'], 'user'),
+                project=self.lookup(self.projects, record['project'], 'project'),
+                recipient=self.lookup(self.users, record['recipient'], 'user') if record['recipient'] else None,
+                subject=record['subject'],
+                created_at=parse_datetime(record['created_at']),
+                updated_at=parse_datetime(record['updated_at']),
+            )
+            use_content(draft, contents[(record['subject'], record['body'] or '')])
+            draft.search_document = build_draft_document(draft)
+            draft.content_hash = draft_content_hash(draft)
+            drafts.append(draft)
+
+        with transaction.atomic():
+            Draft.objects.bulk_create(drafts)
+            changelog.record([(draft.author_id, changelog.DRAFT, draft.id, changelog.UPSERT) for draft in drafts])
+        self.stats['drafts'] += len(drafts)
+
+
+def import_mailbox(lines, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import a JSON Lines export read from ``lines``. Returns how many users,
+    projects, mails and drafts were created. Every batch commits on its own,
+    so a failed import keeps what it wrote before the error.
+    """
+    importer = MailImporter(batch_size)
+    with original_timestamps():
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise InvalidExport(f'Line {number} is not JSON') from None
+            importer.feed(record)
+        return importer.finish()
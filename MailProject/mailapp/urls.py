@@ -10,8 +10,21 @@ urlpatterns = [
     path('drafts/', views.drafts, name='drafts'),
     path('drafts/edit/<int:draft_id>/', views.edit_draft, name='edit_draft'),
     path('mail/<int:mail_id>/', views.read_mail, name='read_mail'),
+    path('thread/<int:thread_id>/', views.read_thread, name='read_thread'),
     path('api/project-users/', views.get_project_users, name='get_project_users'),
+    path('api/mail/bulk/', views.bulk_mail_action, name='bulk_mail_action'),
+    path('api/mail/batch-send/', views.batch_send_mail, name='batch_send_mail'),
+    path('api/mail/since/', views.mail_since, name='mail_since'),
+    path('api/mail/events/', views.mail_events, name='mail_events'),
+    path('api/sync/', views.sync_mailbox, name='sync_mailbox'),
+    path('export/', views.export_mail, name='export_mail'),
+    path('api/drafts/autosave/', views.autosave_draft_api, name='autosave_draft'),
+    path('api/drafts/<int:draft_id>/autosave/', views.autosave_draft_api, name='autosave_existing_draft'),
     path('api/generate-ai-draft/', views.generate_ai_draft, name='generate_ai_draft'),
+    path('api/ai-drafts/<int:job_id>/', views.ai_draft_job, name='ai_draft_job'),
+    path('api/ai-drafts/stream/', views.stream_ai_draft, name='stream_ai_draft'),
+    path('api/ops/counters/', views.ops_counters, name='ops_counters'),
+    path('api/ops/metrics/', views.ops_metrics, name='ops_metrics'),
     path('projects/', views.manage_projects, name='manage_projects'),
     path('projects/create/', views.create_project, name='create_project'),
 ]
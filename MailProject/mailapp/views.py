@@ -1,15 +1,51 @@
+import json
+from datetime import timedelta
+
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import JsonResponse
-from django.core.paginator import Paginator
-from django.db.models import Q
 from django.conf import settings
-import google.generativeai as genai
-from .models import Project, UserProfile, Mail, Draft
-from .forms import CustomUserCreationForm, ComposeMailForm, DraftForm
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.db import transaction
+from django.db.models import Max
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
+from .models import Project, UserProfile, Mail, ArchivedMail, Draft, AIDraftJob
+from .forms import CustomUserCreationForm, ComposeMailForm, DraftForm, BatchMailForm
+from .ai import (
+    AINotConfigured, cache_stats as ai_cache_stats, get_backend as get_ai_backend, stream_draft,
+    submit_job as submit_ai_job,
+)
+from .archive import find_archived, search_archive
+from .autosave import AutosaveConflict, AutosaveInvalid, autosave_draft
+from .batch_send import send_to_many
+from .changelog import (
+    DEFAULT_DRAFT_FIELDS, DEFAULT_MAIL_FIELDS, DRAFT_FIELDS, MAIL_FIELDS, SYNC_LIMIT, SYNC_OVERLAP_SECONDS,
+    changes_since, parse_fields,
+)
+from .bulk import BULK_ACTIONS, apply_bulk_action, select_mailbox
+from .counters import mailbox_summary, mark_mail_read
+from .directory import project_members, project_version, recipients_for
+from .mailbox_cache import page_etag, page_last_modified
+from .pagination import ApproximateCount, InvalidCursor, KeysetPaginator, approximate_count, decode_cursor, encode_cursor
+from .profiles import provision_user, request_profile
+from .profiling import metrics as request_metrics, render_counters
+from .push import mail_event_stream
+from .ratelimit import CapacityExceeded, rate_limit, stats as rate_limit_stats
+from .replicas import replica_reads
+from .search import search
+from .transfer import EXPORT_CONTENT_TYPES, EXPORT_FORMATS, ExportScope, export_mailbox, iterate_in_thread
+from .threads import (
+    FORWARD_PREFIX, REPLY_PREFIX, attach_latest, participant_mail, prefixed, quote, thread_messages,
+    threaded_mailbox,
+)
 
 def register(request):
     if request.method == 'POST':
@@ -39,13 +75,9 @@ def register(request):
                     if project:
                         profile.projects.add(project)
                     else:
-                        # Create a default project if none selected
-                        project = Project.objects.create(
-                            name=f"{user.username}'s Project",
-                            description="Default project",
-                            created_by=user
-                        )
-                        profile.projects.add(project)
+                        # No project chosen: provisioning gives the user a default one
+                        provision_user(user)
+                        project = profile.projects.first()
                 
                 # Authenticate and login
                 username = form.cleaned_data.get('username')
@@ -53,7 +85,8 @@ def register(request):
                 user = authenticate(username=username, password=password)
                 if user:
                     login(request, user)
-                    messages.success(request, f'Account created successfully! Welcome to {project.name}!')
+                    welcome = f' Welcome to {project.name}!' if project else ''
+                    messages.success(request, f'Account created successfully!{welcome}')
                     return redirect('inbox')
                 else:
                     messages.error(request, 'Authentication failed after registration.')
@@ -74,29 +107,19 @@ def register(request):
     return render(request, 'mailapp/register.html', {'form': form})
 
 @login_required
+@replica_reads
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
 def inbox(request):
     try:
-        # Ensure user has a UserProfile
-        profile, created = UserProfile.objects.get_or_create(user=request.user)
-        
-        # Get user's projects
-        user_projects = profile.projects.all()
-        
-        # If user has no projects, create a default one
-        if not user_projects.exists():
-            default_project = Project.objects.create(
-                name=f"{request.user.username}'s Project",
-                description="Default project",
-                created_by=request.user
-            )
-            profile.projects.add(default_project)
-            user_projects = profile.projects.all()
+        # Get user's projects; the profile and its default project were set up at registration or login
+        user_projects = list(request_profile(request).projects.all())
         
         # Get project filter from query params
         project_filter = request.GET.get('project', '').strip()
         
         # Get mails for the user
-        mails = Mail.objects.filter(recipient=request.user).order_by('-sent_at')
+        mails = Mail.objects.filter(recipient=request.user).for_list()
         
         # Handle project filtering
         if project_filter and project_filter.lower() != 'none' and project_filter != '':
@@ -115,41 +138,81 @@ def inbox(request):
         project_filter = ''
     
     # Search functionality
+    ordering = ('-sent_at', '-id')
     search_query = request.GET.get('search', '').strip()
-    if search_query and search_query.lower() != 'none':
-        mails = mails.filter(
-            Q(subject__icontains=search_query) |
-            Q(body__icontains=search_query) |
-            Q(sender__username__icontains=search_query) |
-            Q(sender__first_name__icontains=search_query) |
-            Q(sender__last_name__icontains=search_query)
-        )
+    searching = bool(search_query) and search_query.lower() != 'none'
+    if searching:
+        mails = search(mails, search_query)
+        ordering = ('-search_rank', '-id')
+    
+    # Archived mail is only searched when asked for, and only shown on the first page
+    include_archive = searching and request.GET.get('archive') == '1'
+    archived_mails = []
+    if include_archive and not request.GET.get('cursor'):
+        archived = ArchivedMail.objects.filter(recipient=request.user)
+        if project_filter:
+            archived = archived.filter(project_id=project_filter)
+        archived_mails = search_archive(archived, search_query)
+    
+    # Conversation view: one row per thread, newest activity first
+    threaded = request.GET.get('view') == 'threads' and not searching
+    if threaded:
+        mails = threaded_mailbox(request.user, project_filter or None)
+        ordering = ('-latest_at', '-id')
     
     # Pagination
-    paginator = Paginator(mails, 10)  # Show 10 mails per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = KeysetPaginator(mails, 10, ordering=ordering)  # Show 10 mails per page
+    page_obj = paginator.get_page(request.GET.get('cursor'))
+    if threaded:
+        attach_latest(page_obj.object_list)
+    
+    # The first page of the message view updates itself from the newest row it shows
+    live = not threaded and not searching and not request.GET.get('cursor')
+    since_cursor = ''
+    if live and page_obj.object_list:
+        since_cursor = encode_cursor([max(mail.id for mail in page_obj.object_list)], 'next')
+    
+    # Header and dropdown counts come from the denormalized counters
+    summary = mailbox_summary(request.user)
+    for project in user_projects:
+        counter = summary.get(project.id)
+        project.unread_count = counter.unread if counter else 0
+    counted = [c for project_id, c in summary.items() if not project_filter or project_id == project_filter]
+    if searching:
+        mail_count = approximate_count(mails)
+    else:
+        mail_count = ApproximateCount(sum(c.total for c in counted))
     
     context = {
         'page_obj': page_obj,
+        'mail_count': mail_count,
+        'unread_count': sum(c.unread for c in counted),
         'user_projects': user_projects,
         'current_project': str(project_filter) if project_filter else '',
         'search_query': search_query if search_query.lower() != 'none' else '',
+        'threaded': threaded,
+        'include_archive': include_archive,
+        'archived_mails': archived_mails,
+        'live': live,
+        'since_cursor': since_cursor,
     }
     
     return render(request, 'mailapp/inbox.html', context)
 
 @login_required
+@replica_reads
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
 def sent(request):
     """View to display sent mails"""
     # Get user's projects
-    user_projects = request.user.userprofile.projects.all() if hasattr(request.user, 'userprofile') else []
+    user_projects = list(request_profile(request).projects.all())
     
     # Get project filter from query params
     project_filter = request.GET.get('project', '').strip()
     
     # Get mails sent by the user
-    sent_mails = Mail.objects.filter(sender=request.user).order_by('-sent_at')
+    sent_mails = Mail.objects.filter(sender=request.user).for_list()
     
     # Handle project filtering
     if project_filter and project_filter.lower() != 'none' and project_filter != '':
@@ -162,53 +225,112 @@ def sent(request):
         project_filter = ''
     
     # Search functionality
+    ordering = ('-sent_at', '-id')
     search_query = request.GET.get('search', '').strip()
-    if search_query and search_query.lower() != 'none':
-        sent_mails = sent_mails.filter(
-            Q(subject__icontains=search_query) |
-            Q(body__icontains=search_query) |
-            Q(recipient__username__icontains=search_query) |
-            Q(recipient__first_name__icontains=search_query) |
-            Q(recipient__last_name__icontains=search_query)
-        )
+    searching = bool(search_query) and search_query.lower() != 'none'
+    if searching:
+        sent_mails = search(sent_mails, search_query)
+        ordering = ('-search_rank', '-id')
+    
+    # Archived mail is only searched when asked for, and only shown on the first page
+    include_archive = searching and request.GET.get('archive') == '1'
+    archived_mails = []
+    if include_archive and not request.GET.get('cursor'):
+        archived = ArchivedMail.objects.filter(sender=request.user)
+        if project_filter:
+            archived = archived.filter(project_id=project_filter)
+        archived_mails = search_archive(archived, search_query)
     
     # Pagination
-    paginator = Paginator(sent_mails, 10)  # Show 10 mails per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = KeysetPaginator(sent_mails, 10, ordering=ordering)  # Show 10 mails per page
+    page_obj = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'page_obj': page_obj,
+        'mail_count': approximate_count(sent_mails),
         'user_projects': user_projects,
         'current_project': str(project_filter) if project_filter else '',
         'search_query': search_query if search_query.lower() != 'none' else '',
+        'include_archive': include_archive,
+        'archived_mails': archived_mails,
     }
     
     return render(request, 'mailapp/sent.html', context)
 
+def _reply_initial(request):
+    """Compose form values for ?reply_to=<mail id> or ?forward=<mail id>"""
+    for param, forward in (('reply_to', False), ('forward', True)):
+        mail_id = request.GET.get(param, '')
+        if mail_id.isdigit():
+            break
+    else:
+        return {}
+    
+    original = participant_mail(request.user).select_related(
+        'sender', 'recipient', 'project', 'content',
+    ).filter(id=mail_id).first()
+    if original is None:
+        return {}
+    
+    initial = {
+        'project': original.project,
+        'subject': prefixed(FORWARD_PREFIX if forward else REPLY_PREFIX, original.subject),
+        'body': quote(original, forward=forward),
+        'in_reply_to': original,
+    }
+    if not forward:
+        # Reply to the other side of the conversation, even when replying to your own sent mail
+        initial['recipient'] = original.recipient if original.sender_id == request.user.id else original.sender
+    return initial
+
 @login_required
+@replica_reads
+@rate_limit('compose')
 def compose(request):
-    # Ensure user has a profile
-    if not hasattr(request.user, 'userprofile'):
-        UserProfile.objects.create(user=request.user)
-        messages.warning(request, 'User profile created. Please join a project first.')
+    # Loaded once here; the forms and the sidebar reuse it through request.user
+    profile = request_profile(request)
     
     if request.method == 'POST':
         action = request.POST.get('action')
         
-        if action == 'send':
+        # Draft already created by the autosave loop for this compose session, if any
+        autosaved_draft = None
+        if request.POST.get('draft_id', '').isdigit():
+            autosaved_draft = Draft.objects.filter(id=request.POST['draft_id'], author=request.user).first()
+        
+        if action == 'send' and request.POST.get('all_members'):
+            # Announcement to everyone in the project, sent in one batch
+            batch_form = BatchMailForm(user=request.user, data=request.POST)
+            if batch_form.is_valid():
+                with transaction.atomic():
+                    mails, _ = send_to_many(
+                        request.user, batch_form.cleaned_data['project'],
+                        batch_form.cleaned_data['subject'], batch_form.cleaned_data['body'], all_members=True,
+                    )
+                    if autosaved_draft:
+                        autosaved_draft.delete()
+                messages.success(request, f'Mail sent to {len(mails)} project member{"s" if len(mails) != 1 else ""}!')
+                return redirect('inbox')
+            for error in batch_form.non_field_errors():
+                messages.error(request, error)
+            form = ComposeMailForm(user=request.user, data=request.POST)
+        
+        elif action == 'send':
             form = ComposeMailForm(user=request.user, data=request.POST)
             if form.is_valid():
                 mail = form.save(commit=False)
                 mail.sender = request.user
-                mail.save()
+                with transaction.atomic():
+                    mail.save()
+                    if autosaved_draft:
+                        autosaved_draft.delete()
                 messages.success(request, 'Mail sent successfully!')
                 return redirect('inbox')
             # If form is invalid, it will fall through to render with errors
         
         elif action == 'draft':
-            # Save as draft
-            draft_form = DraftForm(user=request.user, data=request.POST)
+            # Save as draft, reusing the autosaved one rather than adding a duplicate
+            draft_form = DraftForm(user=request.user, data=request.POST, instance=autosaved_draft)
             if draft_form.is_valid():
                 draft = draft_form.save(commit=False)
                 draft.author = request.user
@@ -222,37 +344,29 @@ def compose(request):
             # For any other action, create a form with the posted data
             form = ComposeMailForm(user=request.user, data=request.POST)
     else:
-        form = ComposeMailForm(user=request.user)
+        form = ComposeMailForm(user=request.user, initial=_reply_initial(request))
     
     # Check if user has projects
-    user_projects_count = 0
-    if hasattr(request.user, 'userprofile'):
-        user_projects_count = request.user.userprofile.projects.count()
-    
-    if user_projects_count == 0:
+    if not profile.project_ids:
         messages.info(request, 'You are not a member of any projects. Please join or create a project first.')
     
     return render(request, 'mailapp/compose.html', {'form': form})
 
 @login_required
+@replica_reads
 def drafts(request):
-    user_drafts = Draft.objects.filter(author=request.user).order_by('-updated_at')
+    user_drafts = Draft.objects.filter(author=request.user).for_list()
     
     # Search functionality
+    ordering = ('-updated_at', '-id')
     search_query = request.GET.get('search', '').strip()
     if search_query and search_query.lower() != 'none':
-        user_drafts = user_drafts.filter(
-            Q(subject__icontains=search_query) |
-            Q(body__icontains=search_query) |
-            Q(recipient__username__icontains=search_query) |
-            Q(recipient__first_name__icontains=search_query) |
-            Q(recipient__last_name__icontains=search_query)
-        )
+        user_drafts = search(user_drafts, search_query)
+        ordering = ('-search_rank', '-id')
     
     # Pagination
-    paginator = Paginator(user_drafts, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = KeysetPaginator(user_drafts, 10, ordering=ordering)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'page_obj': page_obj,
@@ -269,20 +383,25 @@ def edit_draft(request, draft_id):
         action = request.POST.get('action')
         
         if action == 'send':
-            # Convert draft to mail
-            if draft.recipient and draft.project:
-                Mail.objects.create(
-                    sender=request.user,
-                    recipient=draft.recipient,
-                    project=draft.project,
-                    subject=draft.subject,
-                    body=draft.body
-                )
-                draft.delete()
+            # Convert draft to mail, as long as the recipient is still in the project
+            if draft.recipient and draft.project and \
+                    recipients_for(draft.project_id, request.user).filter(pk=draft.recipient_id).exists():
+                with transaction.atomic():
+                    Mail.objects.create(
+                        sender=request.user,
+                        recipient=draft.recipient,
+                        project=draft.project,
+                        subject=draft.subject,
+                        # Reuse the draft's stored content instead of copying the body
+                        content=draft.content,
+                        in_reply_to=draft.in_reply_to,
+                        in_reply_to_archived_id=draft.in_reply_to_archived_id,
+                    )
+                    draft.delete()
                 messages.success(request, 'Mail sent successfully!')
                 return redirect('inbox')
             else:
-                messages.error(request, 'Please select both project and recipient before sending.')
+                messages.error(request, 'Please select a project and one of its members before sending.')
         
         elif action == 'update':
             form = DraftForm(user=request.user, data=request.POST, instance=draft)
@@ -307,15 +426,61 @@ def edit_draft(request, draft_id):
     
     # If draft has a project, populate recipients
     if draft.project:
-        project_members = User.objects.filter(userprofile__projects=draft.project).exclude(id=request.user.id)
-        form.fields['recipient'].queryset = project_members
+        form.fields['recipient'].queryset = recipients_for(draft.project_id, request.user)
     
     return render(request, 'mailapp/edit_draft.html', {'form': form, 'draft': draft})
 
 @login_required
+@rate_limit('autosave')
+def autosave_draft_api(request, draft_id=None):
+    """AJAX view to create or update a draft from the compose/edit autosave loop"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    
+    # The client echoes the version it last saw, either as If-Match or a form field
+    expected_version = request.headers.get('If-Match', request.POST.get('version', '')).strip('"')
+    try:
+        expected_version = int(expected_version) if expected_version else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid version'}, status=400)
+    
+    try:
+        draft, saved = autosave_draft(request.user, request.POST, draft_id, expected_version)
+    except Draft.DoesNotExist:
+        return JsonResponse({'error': 'Draft not found'}, status=404)
+    except AutosaveConflict as e:
+        response = JsonResponse({
+            'error': 'This draft was changed in another window.',
+            'draft_id': e.draft.id,
+            'version': e.draft.version,
+        }, status=409)
+        response['ETag'] = f'"{e.draft.version}"'
+        return response
+    except AutosaveInvalid as e:
+        return JsonResponse({'error': 'Invalid draft', 'errors': e.errors}, status=400)
+    
+    response = JsonResponse({
+        'success': True,
+        'draft_id': draft.id,
+        'version': draft.version,
+        'saved': saved,
+        'edit_url': reverse('edit_draft', args=[draft.id]),
+    }, status=201 if saved and draft_id is None else 200)
+    response['ETag'] = f'"{draft.version}"'
+    return response
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
 def read_mail(request, mail_id):
     # Allow both sender and recipient to view the mail
-    mail = get_object_or_404(Mail, id=mail_id)
+    mail = Mail.objects.select_related('sender', 'recipient', 'project', 'content').filter(id=mail_id).first()
+    # Old mail lives in the archive under the same id
+    archived = mail is None
+    if archived:
+        mail = find_archived(mail_id)
+        if mail is None:
+            raise Http404('No such mail')
     
     # Check if user is either sender or recipient
     if mail.sender != request.user and mail.recipient != request.user:
@@ -323,42 +488,234 @@ def read_mail(request, mail_id):
         return redirect('inbox')
     
     # Mark as read only if user is the recipient
-    if mail.recipient == request.user and not mail.is_read:
-        mail.is_read = True
-        mail.save()
+    if not archived and mail.recipient == request.user and not mail.is_read:
+        mark_mail_read(mail)
+    
+    return render(request, 'mailapp/read_mail.html', {'mail': mail, 'archived': archived})
+
+@login_required
+def read_thread(request, thread_id):
+    """A whole conversation, oldest message first"""
+    thread_mails = list(thread_messages(thread_id, request.user))
+    if not thread_mails:
+        messages.error(request, 'You do not have permission to view this conversation.')
+        return redirect('inbox')
+    
+    # Opening the conversation reads everything in it that was sent to this user
+    unread_ids = [mail.id for mail in thread_mails if mail.recipient_id == request.user.id and not mail.is_read]
+    if unread_ids:
+        apply_bulk_action(select_mailbox(request.user, ids=unread_ids), 'mark_read')
+    
+    return render(request, 'mailapp/thread.html', {
+        'thread_mails': thread_mails,
+        'subject': thread_mails[0].subject,
+        'latest': thread_mails[-1],
+    })
+
+# Most rows one "since" call returns; the client asks again while has_more is set
+SINCE_LIMIT = 50
+
+@login_required
+def mail_since(request):
+    """AJAX view returning inbox mail that arrived after the client's cursor, as JSON and rendered rows"""
+    mails = Mail.objects.filter(recipient=request.user)
+    if request.GET.get('project', '').isdigit():
+        mails = mails.filter(project_id=int(request.GET['project']))
+    
+    cursor = request.GET.get('cursor')
+    if not cursor:
+        # A fresh page starts from the newest mail there is
+        last_id = mails.aggregate(last_id=Max('id'))['last_id'] or 0
+        return JsonResponse({'mails': [], 'cursor': encode_cursor([last_id], 'next'), 'has_more': False})
+    try:
+        values, _ = decode_cursor(cursor)
+        last_id = int(values[0])
+    except (InvalidCursor, IndexError, TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    # Ids only grow, so "after the cursor" is a primary key range
+    new_mails = list(mails.filter(id__gt=last_id).for_list().order_by('id')[:SINCE_LIMIT + 1])
+    has_more = len(new_mails) > SINCE_LIMIT
+    new_mails = new_mails[:SINCE_LIMIT]
+    # A lower id can commit after a higher one was returned, so recent mail is sent
+    # again and the page skips the rows it already shows
+    recent = list(
+        mails.filter(id__lte=last_id, sent_at__gte=timezone.now() - timedelta(seconds=SYNC_OVERLAP_SECONDS))
+        .for_list().order_by('id')[:SINCE_LIMIT]
+    )
+    if new_mails:
+        last_id = new_mails[-1].id
+    
+    summary = mailbox_summary(request.user)
+    return JsonResponse({
+        'mails': [{
+            'id': mail.id,
+            'thread_id': mail.thread_id,
+            'subject': mail.subject,
+            'preview': mail.preview,
+            'sender': mail.sender.username,
+            'project_id': mail.project_id,
+            'sent_at': mail.sent_at,
+            'is_read': mail.is_read,
+            'url': reverse('read_mail', args=[mail.id]),
+            'html': render_to_string('mailapp/_mail_row.html', {'mail': mail}, request=request),
+        } for mail in recent + new_mails],
+        'cursor': encode_cursor([last_id], 'next'),
+        'has_more': has_more,
+        'unread_count': sum(counter.unread for counter in summary.values()),
+    })
+
+@gzip_page
+@login_required
+@replica_reads
+def sync_mailbox(request):
+    """
+    JSON of what changed in the user's mailbox after ``cursor``: mail and
+    drafts with the requested ``mail_fields``/``draft_fields``, and deleted ids.
+    Start from cursor 0 and keep passing back the returned cursor.
+    """
+    try:
+        cursor = int(request.GET.get('cursor') or 0)
+        limit = int(request.GET.get('limit') or SYNC_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'cursor and limit must be integers'}, status=400)
+    if cursor < 0 or not 0 < limit <= SYNC_LIMIT:
+        return JsonResponse({'error': f'cursor must be positive and limit between 1 and {SYNC_LIMIT}'}, status=400)
+    
+    try:
+        mail_fields = parse_fields(request.GET.get('mail_fields'), MAIL_FIELDS, DEFAULT_MAIL_FIELDS)
+        draft_fields = parse_fields(request.GET.get('draft_fields'), DRAFT_FIELDS, DEFAULT_DRAFT_FIELDS)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    changes = changes_since(request.user, cursor, mail_fields, draft_fields, limit)
+    return JsonResponse(changes, json_dumps_params={'separators': (',', ':')})
+
+@login_required
+@rate_limit('export', methods=('GET',))
+def export_mail(request):
+    """Download the user's mail and drafts, or those of one of their projects, as mbox or JSON Lines"""
+    fmt = request.GET.get('format', 'mbox')
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({'error': f'format must be one of: {", ".join(EXPORT_FORMATS)}'}, status=400)
+    
+    project = None
+    project_id = request.GET.get('project', '')
+    if project_id:
+        project_id = int(project_id) if project_id.isdigit() else None
+        project = next((p for p in request_profile(request).projects.all() if p.id == project_id), None)
+        if project is None:
+            return JsonResponse({'error': 'You are not a member of this project'}, status=404)
+    
+    # Rows are read and written out a chunk at a time, never all at once
+    stream = export_mailbox(ExportScope(user=request.user, project=project), fmt)
+    if isinstance(request, ASGIRequest):
+        stream = iterate_in_thread(stream)
+    response = StreamingHttpResponse(stream, content_type=f'{EXPORT_CONTENT_TYPES[fmt]}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="flowmail-{request.user.username}.{fmt}"'
+    return response
+
+async def mail_events(request):
+    """Server-sent events telling the inbox page that new mail has arrived"""
+    if not isinstance(request, ASGIRequest):
+        # A long-lived stream would hold a whole WSGI worker. 204 tells
+        # EventSource not to reconnect, and the page polls mail_since instead.
+        return HttpResponse(status=204)
+    
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    
+    response = StreamingHttpResponse(mail_event_stream(user.pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+def bulk_mail_action(request):
+    """AJAX view to mark read/unread, delete or move (to ``to_project``) many inbox mails at once"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    
+    action = request.POST.get('action')
+    if action not in BULK_ACTIONS:
+        return JsonResponse({'error': f'Unknown action. Use one of: {", ".join(BULK_ACTIONS)}'}, status=400)
     
-    return render(request, 'mailapp/read_mail.html', {'mail': mail})
+    try:
+        ids = [int(pk) for pk in request.POST.getlist('ids')] or None
+        project_id = int(request.POST['project']) if request.POST.get('project') else None
+        older_than_days = int(request.POST['older_than_days']) if request.POST.get('older_than_days') else None
+        to_project = int(request.POST['to_project']) if request.POST.get('to_project') else None
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'ids, project, older_than_days and to_project must be integers'}, status=400)
+    search_query = request.POST.get('search', '').strip()
+    
+    # Refuse to act on the whole mailbox unless that was asked for explicitly
+    if ids is None and project_id is None and not search_query and older_than_days is None \
+            and request.POST.get('all') != 'true':
+        return JsonResponse({'error': 'Provide ids, a filter, or all=true'}, status=400)
+    
+    if action == 'move' and to_project not in request_profile(request).project_ids:
+        return JsonResponse({'error': 'Moving mail needs a to_project you are a member of'}, status=400)
+    
+    mails = select_mailbox(request.user, ids=ids, project_id=project_id,
+                           search_query=search_query, older_than_days=older_than_days)
+    changed = apply_bulk_action(mails, action, project_id=to_project)
+    return JsonResponse({'success': True, 'action': action, 'changed': changed})
 
 @login_required
+@rate_limit('compose')
+def batch_send_mail(request):
+    """AJAX view to send one message to a list of recipients or to the whole project"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    
+    form = BatchMailForm(user=request.user, data=request.POST)
+    if not form.is_valid():
+        return JsonResponse({'error': 'Invalid message', 'errors': form.errors}, status=400)
+    
+    mails, results = send_to_many(
+        request.user, form.cleaned_data['project'], form.cleaned_data['subject'], form.cleaned_data['body'],
+        recipient_ids=form.cleaned_data['recipients'], all_members=form.cleaned_data['all_members'],
+    )
+    # Report what happened to each requested recipient
+    mail_ids = {mail.recipient_id: mail.id for mail in mails}
+    return JsonResponse({
+        'success': True,
+        'sent': len(mails),
+        'results': [
+            {'recipient_id': recipient_id, 'status': status, 'mail_id': mail_ids.get(recipient_id)}
+            for recipient_id, status in results.items()
+        ],
+    }, status=201 if mails else 200)
+
+def _project_users_etag(request):
+    project_id = request.GET.get('project_id', '')
+    # Other processes may not have seen the latest version
+    if not project_id.isdigit() or not settings.MAIL_SHARED_CACHE:
+        return None
+    # The list excludes the requester, so they are part of the tag
+    return f'{project_id}.{project_version(project_id)}.{request.user.pk}'
+
+@login_required
+@condition(etag_func=_project_users_etag)
 def get_project_users(request):
     """AJAX view to get users for a specific project"""
     project_id = request.GET.get('project_id')
     if project_id:
         try:
-            project = Project.objects.get(id=project_id)
-            # Get users that are members of this project, excluding the current user
-            users = User.objects.filter(
-                userprofile__projects=project
-            ).exclude(id=request.user.id).values('id', 'username', 'first_name', 'last_name')
-            
-            user_list = []
-            for user in users:
-                display_name = f"{user['first_name']} {user['last_name']}".strip()
-                if display_name:
-                    display_name = f"{display_name} ({user['username']})"
-                else:
-                    display_name = user['username']
-                
-                user_list.append({
-                    'id': user['id'], 
-                    'name': display_name
-                })
-            
-            return JsonResponse({'users': user_list})
-        except Project.DoesNotExist:
+            members = project_members(int(project_id))
+        except ValueError:
+            members = None
+        if members is None:
             return JsonResponse({'error': 'Project not found', 'users': []})
-        except Exception as e:
-            return JsonResponse({'error': str(e), 'users': []})
+        
+        # Members of the project, excluding the current user
+        user_list = [member for member in members if member['id'] != request.user.id]
+        response = JsonResponse({'users': user_list})
+        # Let the browser keep the list but revalidate it with the ETag each time
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     
     return JsonResponse({'error': 'No project ID provided', 'users': []})
 
@@ -426,87 +783,95 @@ def home(request):
     return render(request, 'mailapp/home.html')
 
 @login_required
+@rate_limit('ai_draft')
 def generate_ai_draft(request):
-    """Generate AI-powered draft content using Gemini API"""
+    """Queue an AI-powered draft for generation; the client polls ai_draft_job for the result"""
     if request.method == 'POST':
+        # Get prompt from request
+        prompt = request.POST.get('prompt', '').strip()
+        if not prompt:
+            return JsonResponse({'error': 'Please provide a prompt for AI generation.'}, status=400)
+        
+        # Surface a missing API key now rather than after the job fails
         try:
-            # Get prompt from request
-            prompt = request.POST.get('prompt', '').strip()
-            if not prompt:
-                return JsonResponse({'error': 'Please provide a prompt for AI generation.'}, status=400)
-            
-            # Configure Gemini API
-            if hasattr(settings, 'GEMINI_API_KEY') and settings.GEMINI_API_KEY != 'your_gemini_api_key_here':
-                genai.configure(api_key=settings.GEMINI_API_KEY)
-                
-                # Create the model
-                model = genai.GenerativeModel('gemini-2.0-flash')
-                
-                # Enhanced prompt for email generation
-                enhanced_prompt = f"""
-                Generate a professional email based on the following request: {prompt}
-                
-                Please format the response as JSON with the following structure:
-                {{
-                    "subject": "appropriate email subject",
-                    "body": "email body content"
-                }}
-                
-                Guidelines:
-                - Keep the tone professional and courteous
-                - Make the subject concise and relevant
-                - Structure the body with proper greeting, content, and closing
-                - Ensure the content is appropriate for a business/project communication
-                """
-                
-                # Generate content
-                response = model.generate_content(enhanced_prompt)
-                
-                # Try to parse JSON response
-                import json
-                try:
-                    # Extract JSON from response text
-                    response_text = response.text.strip()
-                    if response_text.startswith('```json'):
-                        response_text = response_text.replace('```json', '').replace('```', '').strip()
-                    elif response_text.startswith('```'):
-                        response_text = response_text.replace('```', '').strip()
-                    
-                    ai_content = json.loads(response_text)
-                    
-                    return JsonResponse({
-                        'success': True,
-                        'subject': ai_content.get('subject', ''),
-                        'body': ai_content.get('body', '')
-                    })
-                    
-                except json.JSONDecodeError:
-                    # If JSON parsing fails, extract content manually
-                    content = response.text.strip()
-                    
-                    # Simple extraction - split by common patterns
-                    subject = ''
-                    body = content
-                    
-                    # Try to extract subject if present
-                    if 'Subject:' in content:
-                        lines = content.split('\n')
-                        for line in lines:
-                            if line.strip().lower().startswith('subject:'):
-                                subject = line.split(':', 1)[1].strip()
-                                body = content.replace(line, '').strip()
-                                break
-                    
-                    return JsonResponse({
-                        'success': True,
-                        'subject': subject,
-                        'body': body
-                    })
-                    
-            else:
-                return JsonResponse({'error': 'Gemini API key not configured. Please add your API key to settings.py'}, status=400)
-                
-        except Exception as e:
-            return JsonResponse({'error': f'Error generating AI content: {str(e)}'}, status=500)
+            get_ai_backend()
+        except AINotConfigured as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        job = submit_ai_job(request.user, prompt)
+        data = {
+            'success': True,
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': reverse('ai_draft_job', args=[job.id]),
+        }
+        # Cached prompts come back already done, so skip the polling round trip
+        if job.status == AIDraftJob.STATUS_DONE:
+            data.update(subject=job.subject, body=job.body)
+            return JsonResponse(data)
+        return JsonResponse(data, status=202)
     
     return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+def _sse(events):
+    """Format (event, data) pairs as server-sent events, closing the source when the client goes away"""
+    try:
+        for event, data in events:
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+    except CapacityExceeded as e:
+        yield f'event: error\ndata: {json.dumps({"error": str(e)})}\n\n'
+    except Exception as e:
+        yield f'event: error\ndata: {json.dumps({"error": f"Error generating AI content: {e}"})}\n\n'
+    finally:
+        events.close()
+
+@login_required
+@rate_limit('ai_draft')
+def stream_ai_draft(request):
+    """Generate an AI draft while the client waits, streaming subject and body as server-sent events"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    
+    prompt = request.POST.get('prompt', '').strip()
+    if not prompt:
+        return JsonResponse({'error': 'Please provide a prompt for AI generation.'}, status=400)
+    try:
+        get_ai_backend()
+    except AINotConfigured as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    events = _sse(stream_draft(prompt))
+    if isinstance(request, ASGIRequest):
+        # One event at a time, or Django would wait for the whole draft before sending any of it
+        events = iterate_in_thread(events, batch_size=1)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx-style proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+def ai_draft_job(request, job_id):
+    """AJAX view reporting the state of a queued AI draft"""
+    job = get_object_or_404(AIDraftJob, id=job_id, user=request.user)
+    data = {'job_id': job.id, 'status': job.status}
+    if job.status == AIDraftJob.STATUS_DONE:
+        data.update(success=True, subject=job.subject, body=job.body)
+    elif job.status == AIDraftJob.STATUS_FAILED:
+        data['error'] = job.error
+    return JsonResponse(data)
+
+@login_required
+def ops_counters(request):
+    """Staff-only JSON snapshot of rate limit and AI cache counters for monitoring"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Permission denied'}, status=403)
+    return JsonResponse({'rate_limits': rate_limit_stats(), 'ai_cache': ai_cache_stats()})
+
+@login_required
+def ops_metrics(request):
+    """Staff-only per-view request histograms and ops counters for this process, in Prometheus text format"""
+    if not request.user.is_staff:
+        return HttpResponse('Permission denied', status=403, content_type='text/plain')
+    body = request_metrics.render() + render_counters(rate_limit_stats(), ai_cache_stats())
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
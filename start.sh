@@ -2,4 +2,4 @@
 cd MailProject
 export DJANGO_SETTINGS_MODULE=MailProject.settings
 export PYTHONPATH="${PYTHONPATH}:$(pwd)"
-exec gunicorn MailProject.wsgi:application --bind 0.0.0.0:$PORT
+exec gunicorn MailProject.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
@@ -54,4 +54,4 @@ except Exception as e:
 
 # Start the server
 echo "🌟 Starting Gunicorn..."
-exec gunicorn MailProject.wsgi:application --bind 0.0.0.0:$PORT
+exec gunicorn MailProject.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT